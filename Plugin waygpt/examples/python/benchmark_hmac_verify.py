@@ -0,0 +1,69 @@
+"""
+Бенчмарк проверки HMAC-подписи входящих запросов (HMACVerifier)
+
+Меряет пропускную способность verify() в одном потоке с разными кешами nonce:
+RotatingNonceCache (по умолчанию), BloomNonceCache в памяти процесса и
+BloomNonceCache в общем mmap-файле. Каждый запрос подписан заново (свой nonce),
+как это делает WayGPTClient. Сервер не нужен — заголовки генерируются локально.
+
+Запуск:
+    python benchmark_hmac_verify.py
+"""
+
+import hashlib
+import hmac
+import os
+import sys
+import tempfile
+import time
+
+# Добавляем путь к SDK
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../../src/python'))
+
+from waygpt_client import BloomNonceCache, HMACVerifier, RotatingNonceCache, build_hmac_canonical
+
+N = 50000
+PROJECT = "project-uuid"
+SECRET = "hmac-secret"
+PATH = "/api/orders"
+BODY = b'{"order_id": 12345, "items": [{"sku": "A-1", "qty": 2}], "comment": "' + b"x" * 400 + b'"}'
+
+
+def make_requests(n):
+    """Подписанные заголовки n запросов с разными nonce"""
+    ts = int(time.time())
+    body_hash = hashlib.sha256(BODY).hexdigest()
+    requests = []
+    for i in range(n):
+        nonce = f"{i:032x}"
+        canonical = build_hmac_canonical("POST", PATH, body_hash, ts, nonce, PROJECT)
+        signature = hmac.new(SECRET.encode(), canonical.encode(), hashlib.sha256).hexdigest()
+        requests.append({"X-MB-Timestamp": str(ts), "X-MB-Nonce": nonce, "X-MB-Signature": signature})
+    return requests
+
+
+def measure(name, nonce_cache, requests):
+    verifier = HMACVerifier({PROJECT: SECRET}, nonce_cache=nonce_cache)
+    start = time.perf_counter()
+    for headers in requests:
+        verifier.verify("POST", PATH, BODY, headers)
+    elapsed = time.perf_counter() - start
+    print(f"{name:<28} {len(requests) / elapsed:10,.0f} запросов/с   {elapsed / len(requests) * 1e6:6.1f} мкс/запрос")
+
+
+def main():
+    requests = make_requests(N)
+    print(f"Запросов: {N}, тело: {len(BODY)} байт\n")
+
+    measure("RotatingNonceCache", RotatingNonceCache(window=300), requests)
+    measure("BloomNonceCache (память)", BloomNonceCache(window=300, capacity=N * 2), requests)
+    with tempfile.TemporaryDirectory() as tmp:
+        shared = BloomNonceCache(window=300, capacity=N * 2, path=os.path.join(tmp, "nonces"))
+        try:
+            measure("BloomNonceCache (mmap)", shared, requests)
+        finally:
+            shared.close()
+
+
+if __name__ == "__main__":
+    main()
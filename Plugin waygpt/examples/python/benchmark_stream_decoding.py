@@ -0,0 +1,78 @@
+"""
+Бенчмарк разбора чанков стрима chat completions (Python)
+
+Сравнивает обычный режим (полный JSON → Dict) и типизированный
+(chat_completions_stream(typed=True) → StreamDelta): время и число объектов
+в памяти на один чанк. Сервер не нужен — чанки генерируются локально.
+
+Запуск:
+    python benchmark_stream_decoding.py
+    pip install orjson  # необязательно: ускоряет оба режима
+"""
+
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+# Добавляем путь к SDK
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '../../src/python'))
+
+import waygpt_client
+from waygpt_client import ChatCompletionStream, _decode_stream_delta_full, _decode_stream_delta_scan
+
+N = 20000
+
+
+def make_payloads(n):
+    """Чанки в формате chat.completion.chunk, как их отдаёт сервер"""
+    words = ["Привет", " мир", ",", " это", " ответ", "\n", " модели", " \"в кавычках\""]
+    return [
+        json.dumps({
+            "id": "chatcmpl-7f3c",
+            "object": "chat.completion.chunk",
+            "created": 1760000000,
+            "model": "gpt-4o-mini",
+            "choices": [{"index": 0, "delta": {"content": words[i % len(words)]}, "finish_reason": None}],
+        }, ensure_ascii=False).encode("utf-8")
+        for i in range(n)
+    ]
+
+
+def measure(name, decode, payloads):
+    start = time.perf_counter()
+    for payload in payloads:
+        decode(payload)
+    elapsed = time.perf_counter() - start
+
+    # Память, которую занимают разобранные чанки, пока их держит потребитель
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    kept = [decode(payload) for payload in payloads]
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    diff = after.compare_to(before, "filename")
+    blocks = sum(stat.count_diff for stat in diff) - 1  # без самого списка kept
+    size = sum(stat.size_diff for stat in diff)
+    assert len(kept) == len(payloads)
+
+    print(f"{name:<30} {elapsed / len(payloads) * 1e6:7.2f} мкс/чанк"
+          f"   {blocks / len(payloads):5.1f} объектов/чанк   {size / len(payloads):6.0f} байт/чанк")
+
+
+def main():
+    payloads = make_payloads(N)
+    print(f"Чанков: {N}, orjson: {'да' if waygpt_client.orjson is not None else 'нет'}\n")
+
+    measure("Dict (json.loads)", lambda p: json.loads(p), payloads)
+    if waygpt_client.orjson is not None:
+        measure("Dict (orjson)", ChatCompletionStream._decode_chunk, payloads)
+    # typed=True использует orjson, если он установлен, иначе поиск по байтам
+    measure("StreamDelta (поиск по байтам)", _decode_stream_delta_scan, payloads)
+    if waygpt_client.orjson is not None:
+        measure("StreamDelta (orjson)", _decode_stream_delta_full, payloads)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,18 +1,489 @@
 """WayGPT Client - Python SDK для интеграции с AI Server."""
 from __future__ import annotations
 
+import asyncio
+import base64
+import contextvars
+import copy
+import gzip
 import hashlib
+import heapq
 import hmac
+import http
+import io
 import json
+import mimetypes
+import mmap
 import os
+import random
+import re
 import secrets
+import socket
+import sqlite3
+import struct
+import tempfile
+import threading
 import time
-from typing import Any, Dict, Iterator, List, Optional, Union, cast
+import zlib
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import IO, Any, Awaitable, Callable, Deque, Dict, Hashable, Iterable, Iterator, List, NamedTuple, Optional, Sequence, Tuple, TypeVar, Union, cast
+from urllib.parse import quote, urlencode, urlsplit
 
 import requests
+import urllib3
 from requests.adapters import HTTPAdapter
+from urllib3.connection import HTTPConnection, HTTPSConnection
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
 from urllib3.util.retry import Retry
 
+try:  # fcntl — только Unix (общий между процессами кеш nonce)
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None  # type: ignore[assignment]
+
+try:  # OpenTelemetry — опционально (pip install opentelemetry-api)
+    from opentelemetry import trace as otel_trace
+except ImportError:  # pragma: no cover
+    otel_trace = None  # type: ignore[assignment]
+
+try:  # Быстрый JSON — опционально (pip install orjson)
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore[assignment]
+
+try:  # zstd — опционально (pip install zstandard)
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None  # type: ignore[assignment]
+
+SUPPORTED_COMPRESSIONS = ("gzip", "zstd")
+
+_T = TypeVar("_T")
+
+# Разбор JSON ответов: orjson, если установлен
+_json_loads: Callable[[Union[bytes, str]], Any] = orjson.loads if orjson is not None else json.loads
+
+
+def build_hmac_canonical(
+    method: str,
+    path: str,
+    body_hash: str,
+    timestamp: Union[int, str],
+    nonce: str,
+    project_id: Optional[str]
+) -> str:
+    """
+    Canonical string для HMAC подписи запросов (клиент и HMACVerifier)
+
+    Args:
+        method: HTTP метод
+        path: Путь запроса (с query string, как отправлен)
+        body_hash: sha256 тела в hex
+        timestamp: Unix-время в секундах
+        nonce: Случайная строка запроса
+        project_id: ID проекта
+    """
+    return "\n".join([
+        method.upper(),
+        path,
+        f"sha256(body)={body_hash}",
+        f"timestamp={timestamp}",
+        f"nonce={nonce}",
+        f"project={project_id}",
+    ])
+
+# Адрес API: URL, (URL, вес) или {"url": ..., "weight": ...}
+EndpointSpec = Union[str, Tuple[str, float], Dict[str, Any]]
+
+
+# ==================== Типизированные ответы ====================
+
+class StreamDelta:
+    """
+    Чанк стрима в типизированном режиме (chat_completions_stream(typed=True))
+
+    Содержит только то, что нужно потребителю стрима: текст дельты и finish_reason.
+    """
+
+    __slots__ = ("content", "finish_reason")
+
+    def __init__(self, content: str = "", finish_reason: Optional[str] = None) -> None:
+        self.content = content
+        self.finish_reason = finish_reason
+
+    def to_dict(self) -> Dict[str, Any]:
+        """Чанк в обычном формате chat completions"""
+        delta = {"content": self.content} if self.content else {}
+        return {"choices": [{"index": 0, "delta": delta, "finish_reason": self.finish_reason}]}
+
+    def __repr__(self) -> str:
+        return f"StreamDelta(content={self.content!r}, finish_reason={self.finish_reason!r})"
+
+
+class ChatCompletion:
+    """Ответ chat completions в типизированном режиме (chat_completions(typed=True))"""
+
+    __slots__ = ("id", "model", "content", "finish_reason", "usage", "raw")
+
+    def __init__(
+        self,
+        id: Optional[str],
+        model: Optional[str],
+        content: str,
+        finish_reason: Optional[str],
+        usage: Dict[str, Any],
+        raw: Dict[str, Any]
+    ) -> None:
+        self.id = id
+        self.model = model
+        self.content = content
+        self.finish_reason = finish_reason
+        self.usage = usage
+        self.raw = raw
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "ChatCompletion":
+        try:
+            choice = data["choices"][0]
+            content = (choice.get("message") or {}).get("content") or ""
+            finish_reason = choice.get("finish_reason")
+        except (KeyError, IndexError, TypeError, AttributeError):
+            content, finish_reason = "", None
+        return cls(data.get("id"), data.get("model"), content, finish_reason, data.get("usage") or {}, data)
+
+    def __repr__(self) -> str:
+        return f"ChatCompletion(model={self.model!r}, content={self.content[:40]!r}, finish_reason={self.finish_reason!r})"
+
+
+# Точная форма полей чанка для поиска по байтам: всё остальное разбирается полностью.
+# content берётся только из "delta", и только если это первый ключ объекта delta
+_SCAN_DELTA = re.compile(rb'"delta": ?\{(?:"content": ?(?:"([^"\\]*)"|null))?[,}]')
+_SCAN_FINISH_REASON = re.compile(rb'"finish_reason": ?(?:"([^"\\]*)"|null)[,}]')
+
+
+def _decode_stream_delta_scan(payload: bytes) -> Optional[StreamDelta]:
+    """
+    Поиск content и finish_reason в байтах чанка (без orjson это быстрее json.loads)
+
+    Поиск принимает только однозначную форму: один choices, один delta, content —
+    первый ключ delta, строки без escape-последовательностей. Иначе (несколько
+    choices, role перед content, пробелы или переводы строк в другом месте,
+    экранирование) — полный разбор, поэтому результат всегда совпадает с ним.
+    """
+    if payload.count(b'"choices"') != 1 or payload.count(b'"delta"') != 1:
+        return _decode_stream_delta_full(payload)
+    delta = _SCAN_DELTA.search(payload)
+    # Кавычка перед ключом без "\" — ключ не внутри строки
+    if delta is None or payload[delta.start() - 1] == 0x5C or payload.find(b'"choices"') > delta.start():
+        return _decode_stream_delta_full(payload)
+
+    finish_reason: Optional[bytes] = None
+    finish_count = payload.count(b'"finish_reason"')
+    if finish_count > 1:
+        return _decode_stream_delta_full(payload)
+    if finish_count:
+        finish = _SCAN_FINISH_REASON.search(payload)
+        if finish is None or payload[finish.start() - 1] == 0x5C:
+            return _decode_stream_delta_full(payload)
+        finish_reason = finish.group(1)
+
+    try:
+        content = delta.group(1)
+        return StreamDelta(
+            content.decode("utf-8") if content else "",
+            finish_reason.decode("utf-8") if finish_reason is not None else None,
+        )
+    except UnicodeDecodeError:
+        return _decode_stream_delta_full(payload)
+
+
+def _decode_stream_delta_full(payload: bytes) -> Optional[StreamDelta]:
+    """Полный разбор чанка; в StreamDelta остаются только текст и finish_reason"""
+    try:
+        choice = _json_loads(payload)["choices"][0]
+        return StreamDelta((choice.get("delta") or {}).get("content") or "", choice.get("finish_reason"))
+    except (ValueError, KeyError, IndexError, TypeError, AttributeError):
+        return None
+
+
+# Разбор чанка в типизированном режиме: orjson строит и сразу освобождает дерево быстрее,
+# чем поиск по байтам на Python; без orjson поиск быстрее json.loads
+_decode_stream_delta: Callable[[bytes], Optional[StreamDelta]] = (
+    _decode_stream_delta_full if orjson is not None else _decode_stream_delta_scan
+)
+
+
+# ==================== Трассировка ====================
+
+class Span:
+    """
+    Span трассировки вызова SDK
+
+    Базовая реализация ничего не делает — так трассировка по умолчанию выключена.
+    """
+
+    __slots__ = ()
+
+    @property
+    def traceparent(self) -> Optional[str]:
+        """Заголовок W3C traceparent (None — не передавать)"""
+        return None
+
+    def add_event(self, name: str, attributes: Optional[Dict[str, Any]] = None) -> None:
+        """Событие внутри span (pool_acquire, connect, send, first_byte, first_token, stream_end)"""
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        """Атрибут span"""
+
+    def record_exception(self, error: BaseException) -> None:
+        """Ошибка вызова"""
+
+    def end(self, error: bool = False) -> None:
+        """Завершение span"""
+
+
+class Tracer:
+    """
+    Трассировщик SDK: базовый класс и реализация по умолчанию (ничего не записывает)
+
+    Свой трассировщик переопределяет start_span(); см. RecordingTracer и OpenTelemetryTracer.
+    """
+
+    def start_span(self, name: str, attributes: Optional[Dict[str, Any]] = None) -> Span:
+        """
+        Начало span вызова SDK
+
+        Args:
+            name: Имя span (например, "WayGPT POST /api/v1/waygpt/chat/completions")
+            attributes: Атрибуты (http.method, http.route, ...)
+        """
+        return _NOOP_SPAN
+
+
+_NOOP_SPAN = Span()
+
+# Span текущего вызова SDK: в него пишут события транспорта (_TracingHTTPAdapter)
+_current_span: "contextvars.ContextVar[Optional[Span]]" = contextvars.ContextVar("waygpt_span", default=None)
+# Span, открытый стримом до запроса: запрос пишет события в него, а не в новый span
+_stream_span: "contextvars.ContextVar[Optional[Span]]" = contextvars.ContextVar("waygpt_stream_span", default=None)
+
+
+def _span_event(name: str, attributes: Dict[str, Any]) -> None:
+    span = _current_span.get()
+    if span is not None:
+        span.add_event(name, attributes)
+
+
+class RecordingSpan(Span):
+    """Span RecordingTracer: время событий отсчитывается от начала span в секундах"""
+
+    __slots__ = (
+        "tracer", "name", "trace_id", "span_id", "parent_id", "attributes", "events",
+        "start_time", "duration", "error", "_started",
+    )
+
+    def __init__(self, tracer: "RecordingTracer", name: str, attributes: Dict[str, Any], parent: Optional["RecordingSpan"]) -> None:
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else secrets.token_hex(16)
+        self.span_id = secrets.token_hex(8)
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = attributes
+        self.events: List[Tuple[str, float, Dict[str, Any]]] = []
+        self.start_time = time.time()
+        self.duration: Optional[float] = None
+        self.error = False
+        self._started = time.perf_counter()
+
+    @property
+    def traceparent(self) -> Optional[str]:
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def add_event(self, name: str, attributes: Optional[Dict[str, Any]] = None) -> None:
+        self.events.append((name, time.perf_counter() - self._started, attributes or {}))
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def record_exception(self, error: BaseException) -> None:
+        self.error = True
+        self.add_event("exception", {"type": type(error).__name__, "message": str(error)})
+
+    def end(self, error: bool = False) -> None:
+        if self.duration is not None:
+            return
+        self.duration = time.perf_counter() - self._started
+        self.error = self.error or error
+        self.tracer._finish(self)
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_time": self.start_time,
+            "duration": self.duration,
+            "error": self.error,
+            "attributes": dict(self.attributes),
+            "events": [{"name": name, "at": at, **attrs} for name, at, attrs in self.events],
+        }
+
+
+class RecordingTracer(Tracer):
+    """
+    Трассировщик в памяти: последние max_spans завершённых span
+
+    Для отладки и выгрузки в свою систему (on_end получает span.to_dict()).
+    Вложенные вызовы SDK становятся дочерними span.
+
+    Пример:
+        tracer = RecordingTracer()
+        client = WayGPTClient(..., tracer=tracer)
+        client.chat_completions(messages=[...])
+        print(tracer.spans()[-1]["events"])
+    """
+
+    def __init__(self, max_spans: int = 1000, on_end: Optional[Callable[[Dict[str, Any]], None]] = None) -> None:
+        self._spans: Deque[RecordingSpan] = deque(maxlen=max_spans)
+        self._lock = threading.Lock()
+        self.on_end = on_end
+
+    def start_span(self, name: str, attributes: Optional[Dict[str, Any]] = None) -> Span:
+        parent = _current_span.get()
+        return RecordingSpan(
+            self, name, dict(attributes or {}), parent if isinstance(parent, RecordingSpan) else None
+        )
+
+    def _finish(self, span: RecordingSpan) -> None:
+        with self._lock:
+            self._spans.append(span)
+        if self.on_end is not None:
+            self.on_end(span.to_dict())
+
+    def spans(self) -> List[Dict[str, Any]]:
+        """Завершённые span (старые первыми)"""
+        with self._lock:
+            spans = list(self._spans)
+        return [span.to_dict() for span in spans]
+
+
+class _OpenTelemetrySpan(Span):
+    __slots__ = ("_span",)
+
+    def __init__(self, span: Any) -> None:
+        self._span = span
+
+    @property
+    def traceparent(self) -> Optional[str]:
+        ctx = self._span.get_span_context()
+        if not ctx.is_valid:
+            return None
+        return f"00-{ctx.trace_id:032x}-{ctx.span_id:016x}-{int(ctx.trace_flags):02x}"
+
+    def add_event(self, name: str, attributes: Optional[Dict[str, Any]] = None) -> None:
+        self._span.add_event(name, attributes or {})
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self._span.set_attribute(key, value)
+
+    def record_exception(self, error: BaseException) -> None:
+        self._span.record_exception(error)
+
+    def end(self, error: bool = False) -> None:
+        if error:
+            self._span.set_status(otel_trace.Status(otel_trace.StatusCode.ERROR))
+        self._span.end()
+
+
+class OpenTelemetryTracer(Tracer):
+    """
+    Трассировка через OpenTelemetry (pip install opentelemetry-api)
+
+    Span вызовов SDK становятся дочерними для текущего span приложения.
+    """
+
+    def __init__(self, tracer: Any = None) -> None:
+        """
+        Args:
+            tracer: opentelemetry.trace.Tracer (по умолчанию get_tracer("waygpt_client"))
+        """
+        if otel_trace is None:
+            raise ImportError("Для OpenTelemetryTracer установите пакет opentelemetry-api")
+        self._tracer = tracer or otel_trace.get_tracer("waygpt_client")
+
+    def start_span(self, name: str, attributes: Optional[Dict[str, Any]] = None) -> Span:
+        return _OpenTelemetrySpan(self._tracer.start_span(name, attributes=attributes))
+
+
+class _TracedConnectionMixin:
+    """Время TCP-подключения и TLS-рукопожатия для span"""
+
+    _waygpt_tcp_seconds = 0.0
+
+    def _new_conn(self) -> Any:
+        started = time.perf_counter()
+        sock = super()._new_conn()  # type: ignore[misc]
+        self._waygpt_tcp_seconds = time.perf_counter() - started
+        return sock
+
+    def connect(self) -> None:
+        started = time.perf_counter()
+        super().connect()  # type: ignore[misc]
+        total = time.perf_counter() - started
+        _span_event("connect", {
+            "host": getattr(self, "host", ""),
+            "tcp_seconds": self._waygpt_tcp_seconds,
+            "tls_seconds": max(0.0, total - self._waygpt_tcp_seconds) if isinstance(self, HTTPSConnection) else 0.0,
+        })
+
+
+class _TracedHTTPConnection(_TracedConnectionMixin, HTTPConnection):
+    pass
+
+
+class _TracedHTTPSConnection(_TracedConnectionMixin, HTTPSConnection):
+    pass
+
+
+class _TracedPoolMixin:
+    """Ожидание соединения из пула для span"""
+
+    def _get_conn(self, timeout: Optional[float] = None) -> Any:
+        started = time.perf_counter()
+        conn = super()._get_conn(timeout)  # type: ignore[misc]
+        _span_event("pool_acquire", {
+            "wait_seconds": time.perf_counter() - started,
+            "reused": getattr(conn, "sock", None) is not None,
+        })
+        return conn
+
+
+class _TracedHTTPConnectionPool(_TracedPoolMixin, HTTPConnectionPool):
+    ConnectionCls = _TracedHTTPConnection
+
+
+class _TracedHTTPSConnectionPool(_TracedPoolMixin, HTTPSConnectionPool):
+    ConnectionCls = _TracedHTTPSConnection
+
+
+class _TracingHTTPAdapter(HTTPAdapter):
+    """HTTPAdapter, который пишет события транспорта в span текущего вызова SDK"""
+
+    def init_poolmanager(self, *args: Any, **kwargs: Any) -> None:
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": _TracedHTTPConnectionPool,
+            "https": _TracedHTTPSConnectionPool,
+        }
+
+    def send(self, request: requests.PreparedRequest, *args: Any, **kwargs: Any) -> requests.Response:
+        _span_event("send", {"method": request.method or "", "url": request.url or ""})
+        response = super().send(request, *args, **kwargs)
+        _span_event("first_byte", {"status": response.status_code})
+        return response
+
 
 class WayGPTError(Exception):
     """Базовый класс для ошибок WayGPT API"""
@@ -23,38 +494,547 @@ class WayGPTError(Exception):
         super().__init__(self.message)
 
 
+class _FlightCall:
+    """Выполняющийся вызов SingleFlight"""
+
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self) -> None:
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """
+    Объединение одновременных одинаковых вызовов (single-flight)
+
+    Пока вызов с ключом key выполняется, повторные вызовы с тем же ключом
+    не выполняются, а ждут его и получают тот же результат или исключение.
+    Работает как из потоков (do), так и из asyncio (do_async).
+
+    Результат один на всех — если вызывающие его меняют, каждый должен
+    работать со своей копией (так делает WayGPTClient).
+    """
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _FlightCall] = {}
+        self._async_calls: Dict[Tuple[int, Hashable], "asyncio.Future[Any]"] = {}
+
+    def do(self, key: Hashable, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        Выполнение fn() или ожидание уже выполняющегося вызова с тем же ключом
+
+        Returns:
+            (результат, shared) — shared=True, если результат получен от чужого вызова
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if call is None:
+                call = self._calls[key] = _FlightCall()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+    async def do_async(self, key: Hashable, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        Асинхронный вариант do(): объединяются вызовы в пределах одного event loop
+
+        Returns:
+            (результат, shared)
+        """
+        loop = asyncio.get_running_loop()
+        loop_key = (id(loop), key)
+        future = self._async_calls.get(loop_key)
+        if future is not None:
+            return await asyncio.shield(future), True
+
+        future = loop.create_future()
+        self._async_calls[loop_key] = future
+        try:
+            result = await fn()
+        except BaseException as e:
+            future.set_exception(e)
+            # Исключение уже проброшено лидеру; помечаем его полученным
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+            return result, False
+        finally:
+            del self._async_calls[loop_key]
+
+    def in_flight(self) -> int:
+        """Количество выполняющихся вызовов"""
+        with self._lock:
+            return len(self._calls) + len(self._async_calls)
+
+
+class _Endpoint:
+    """Зеркало API и его состояние"""
+
+    __slots__ = ("url", "weight", "outstanding", "latency", "failures", "ejections",
+                 "ejected_until", "requests")
+
+    def __init__(self, url: str, weight: float) -> None:
+        self.url = url
+        self.weight = weight
+        self.outstanding = 0
+        self.latency: Optional[float] = None
+        self.failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+        self.requests = 0
+
+
+class _EndpointBalancer:
+    """
+    Балансировка запросов между зеркалами API
+
+    Выбор — "два случайных выбора" с вероятностью по весу; из двух кандидатов
+    берётся лучший по стратегии: "least_outstanding" — меньше запросов в работе
+    на единицу веса, "ewma" — минимальная EWMA задержки с учётом нагрузки. После eject_after ошибок
+    подряд зеркало исключается на время с экспоненциальным ростом; по истечении
+    получает пробный запрос или возвращается успешной фоновой проверкой.
+    """
+
+    STRATEGIES = ("least_outstanding", "ewma")
+
+    def __init__(
+        self,
+        endpoints: List[Tuple[str, float]],
+        strategy: str = "least_outstanding",
+        alpha: float = 0.2,
+        eject_after: int = 3,
+        eject_seconds: float = 10.0,
+        max_eject_seconds: float = 300.0
+    ) -> None:
+        if strategy not in self.STRATEGIES:
+            raise ValueError(f"Неизвестная стратегия балансировки: {strategy}")
+        self.endpoints = [_Endpoint(url, weight) for url, weight in endpoints]
+        self.strategy = strategy
+        self.alpha = alpha
+        self.eject_after = eject_after
+        self.eject_seconds = eject_seconds
+        self.max_eject_seconds = max_eject_seconds
+        self._lock = threading.Lock()
+        self._health_thread: Optional[threading.Thread] = None
+        self._health_stop = threading.Event()
+
+    @staticmethod
+    def parse(spec: Union[str, Sequence[EndpointSpec]]) -> List[Tuple[str, float]]:
+        """Нормализация api_url в список (URL без "/" в конце, вес)"""
+        items: Sequence[EndpointSpec] = [u for u in spec.split(",") if u.strip()] if isinstance(spec, str) else spec
+        endpoints: List[Tuple[str, float]] = []
+        for item in items:
+            if isinstance(item, str):
+                url, weight = item, 1.0
+            elif isinstance(item, dict):
+                url, weight = item["url"], float(item.get("weight", 1.0))
+            else:
+                url, weight = item[0], float(item[1])
+            if weight <= 0:
+                raise ValueError(f"Вес зеркала должен быть положительным: {url}")
+            endpoints.append((url.strip().rstrip("/"), weight))
+        if not endpoints:
+            raise ValueError("api_url не задан")
+        return endpoints
+
+    def _score(self, ep: _Endpoint) -> float:
+        if self.strategy == "ewma":
+            return (ep.latency or 0.0) * (ep.outstanding + 1) / ep.weight
+        return ep.outstanding / ep.weight
+
+    def acquire(self, exclude: Sequence[_Endpoint] = ()) -> _Endpoint:
+        """Выбор зеркала для запроса (учитывается как запрос в работе)"""
+        now = time.monotonic()
+        with self._lock:
+            pool = [ep for ep in self.endpoints if ep not in exclude] or list(self.endpoints)
+            available = [ep for ep in pool if ep.ejected_until <= now]
+            if available:
+                # "Два случайных выбора": два кандидата по весу, берём лучший по оценке.
+                # При равной нагрузке запросы распределяются пропорционально весам.
+                first, second = random.choices(available, weights=[e.weight for e in available], k=2)
+                ep = second if self._score(second) < self._score(first) else first
+            else:
+                # Все исключены — пробуем то, что вернётся раньше всех
+                ep = min(pool, key=lambda e: e.ejected_until)
+            ep.outstanding += 1
+            ep.requests += 1
+            return ep
+
+    def release(self, ep: _Endpoint, latency: float, failed: bool) -> None:
+        """Завершение запроса к зеркалу"""
+        with self._lock:
+            ep.outstanding = max(0, ep.outstanding - 1)
+            self._record(ep, latency, failed)
+
+    def observe(self, ep: _Endpoint, latency: float) -> None:
+        """Успешный ответ зеркала, запрос ещё в работе (стрим: заголовки получены)"""
+        with self._lock:
+            self._record(ep, latency, False)
+
+    def finish(self, ep: _Endpoint) -> None:
+        """Запрос к зеркалу больше не в работе (стрим закрыт)"""
+        with self._lock:
+            ep.outstanding = max(0, ep.outstanding - 1)
+
+    def _record(self, ep: _Endpoint, latency: float, failed: bool) -> None:
+        if failed:
+            # Счётчик ошибок не сбрасывается при исключении: если пробный запрос после
+            # возврата тоже неудачен, зеркало сразу исключается на вдвое больший срок.
+            # Пока зеркало исключено, ошибки (запросы в работе, проверки) срок не продлевают
+            ep.failures += 1
+            now = time.monotonic()
+            if ep.failures >= self.eject_after and ep.ejected_until <= now:
+                ep.ejections += 1
+                ep.ejected_until = now + min(
+                    self.eject_seconds * 2 ** (ep.ejections - 1), self.max_eject_seconds
+                )
+            return
+        ep.failures = 0
+        ep.ejections = 0
+        ep.ejected_until = 0.0
+        ep.latency = latency if ep.latency is None else (1 - self.alpha) * ep.latency + self.alpha * latency
+
+    def start_health_checks(self, client: "WayGPTClient", interval: float, path: str) -> None:
+        """Фоновая проверка зеркал подписанным GET-запросом"""
+
+        def check(ep: _Endpoint) -> None:
+            started = time.monotonic()
+            try:
+                resp = client.session.get(
+                    f"{ep.url}{path}",
+                    headers=client._prepare_headers("GET", path),
+                    timeout=min(client.timeout, max(interval, 1.0)),
+                )
+                resp.close()
+                failed = resp.status_code >= 500
+            except requests.exceptions.RequestException:
+                failed = True
+            with self._lock:
+                self._record(ep, time.monotonic() - started, failed)
+
+        def run() -> None:
+            while not self._health_stop.is_set():
+                for ep in list(self.endpoints):
+                    if self._health_stop.is_set():
+                        return
+                    check(ep)
+                self._health_stop.wait(interval)
+
+        self._health_stop.clear()
+        self._health_thread = threading.Thread(target=run, name="waygpt-endpoint-health", daemon=True)
+        self._health_thread.start()
+
+    def stop_health_checks(self) -> None:
+        """Остановка фоновой проверки (текущая проверка дожидается своего таймаута)"""
+        self._health_stop.set()
+        thread, self._health_thread = self._health_thread, None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join(timeout=5)
+
+    def stats(self) -> List[Dict[str, Any]]:
+        now = time.monotonic()
+        with self._lock:
+            return [
+                {
+                    "url": ep.url,
+                    "weight": ep.weight,
+                    "healthy": ep.ejected_until <= now,
+                    "outstanding": ep.outstanding,
+                    "latency_ewma": ep.latency,
+                    "failures": ep.failures,
+                    "requests": ep.requests,
+                }
+                for ep in self.endpoints
+            ]
+
+
+class FilePart:
+    """
+    Файл как часть content сообщения (мультимодальные запросы)
+
+    Файл не читается в память: при отправке он кодируется в base64 блоками
+    прямо в тело запроса. Изображения передаются как image_url (data URL),
+    остальные файлы — как {"type": "file", "file": {...}}.
+
+    Вместо FilePart в content можно передать pathlib.Path или открытый
+    бинарный файл — они оборачиваются автоматически.
+
+    Поток без seek (pipe, сокет, тело HTTP-ответа) сразу копируется во временный
+    файл (до SPOOL_MEMORY байт — в памяти): тело читается дважды (HMAC, затем
+    отправка) и повторно при retry и переключении зеркала.
+    """
+
+    # Блок чтения файла: кратен 3, чтобы base64 блоков склеивался без паддинга
+    READ_SIZE = 48 * 1024
+    # Сколько байт потока без seek держать в памяти, прежде чем перейти на диск
+    SPOOL_MEMORY = 8 * 1024 * 1024
+
+    def __init__(
+        self,
+        source: Union[str, "os.PathLike[str]", IO[bytes]],
+        mime_type: Optional[str] = None,
+        filename: Optional[str] = None
+    ) -> None:
+        """
+        Args:
+            source: Путь к файлу или открытый бинарный файл
+            mime_type: MIME тип (по умолчанию определяется по имени файла)
+            filename: Имя файла (по умолчанию из пути)
+
+        Raises:
+            ValueError: Файл открыт в текстовом режиме
+        """
+        self.source = source
+        self._is_path = isinstance(source, (str, os.PathLike))
+        self._fh: Optional[IO[bytes]] = None
+        self._start = 0
+        if self._is_path:
+            name = os.path.basename(os.fspath(cast(Union[str, "os.PathLike[str]"], source)))
+        else:
+            fh = cast(IO[bytes], source)
+            name = os.path.basename(str(getattr(fh, "name", "") or ""))
+            if isinstance(fh, io.TextIOBase) or "b" not in getattr(fh, "mode", "b"):
+                raise ValueError(f"Файл {name or 'в content'} открыт в текстовом режиме; откройте его как open(path, 'rb')")
+            if not fh.seekable():
+                fh = self._spool(fh)
+            self._fh = fh
+            self._start = fh.tell()
+        self.filename = filename or name or "file"
+        self.mime_type = mime_type or mimetypes.guess_type(self.filename)[0] or "application/octet-stream"
+
+    def to_part(self, data_placeholder: str) -> Dict[str, Any]:
+        """Часть content в формате API; base64 подставляется вместо data_placeholder"""
+        data_url = f"data:{self.mime_type};base64,{data_placeholder}"
+        if self.mime_type.startswith("image/"):
+            return {"type": "image_url", "image_url": {"url": data_url}}
+        return {"type": "file", "file": {"filename": self.filename, "file_data": data_url}}
+
+    @classmethod
+    def _spool(cls, fh: IO[bytes]) -> IO[bytes]:
+        """Копия потока без seek во временный файл, который можно перечитывать"""
+        spool = cast(IO[bytes], tempfile.SpooledTemporaryFile(max_size=cls.SPOOL_MEMORY))
+        while True:
+            block = fh.read(cls.READ_SIZE)
+            if not block:
+                break
+            spool.write(block)
+        spool.seek(0)
+        return spool
+
+    def size(self) -> int:
+        """Размер файла в байтах"""
+        if self._is_path:
+            return os.path.getsize(cast(Union[str, "os.PathLike[str]"], self.source))
+        fh = cast(IO[bytes], self._fh)
+        end = fh.seek(0, io.SEEK_END)
+        fh.seek(self._start)
+        return end - self._start
+
+    def iter_base64(self) -> Iterator[bytes]:
+        """Потоковое base64-кодирование содержимого файла (каждый вызов — с начала)"""
+        if self._is_path:
+            with open(cast(Union[str, "os.PathLike[str]"], self.source), "rb") as fh:
+                yield from self._encode(fh)
+            return
+
+        fh = cast(IO[bytes], self._fh)
+        fh.seek(self._start)
+        yield from self._encode(fh)
+
+    def _encode(self, fh: IO[bytes]) -> Iterator[bytes]:
+        pending = b""
+        while True:
+            block = fh.read(self.READ_SIZE)
+            if not block:
+                break
+            pending += block
+            usable = len(pending) - len(pending) % 3
+            if usable:
+                yield base64.b64encode(pending[:usable])
+                pending = pending[usable:]
+        if pending:
+            yield base64.b64encode(pending)
+
+
+class _StreamingBody:
+    """
+    Тело запроса из статических кусков JSON и файлов (FilePart)
+
+    Файловый объект для requests: read() отдаёт данные блоками, len — итоговая
+    длина, seek(0) позволяет urllib3 повторить запрос при retry.
+    """
+
+    def __init__(self, segments: List[Union[bytes, FilePart]]) -> None:
+        self.segments = segments
+        total = 0
+        for seg in segments:
+            total += (seg.size() + 2) // 3 * 4 if isinstance(seg, FilePart) else len(seg)
+        # Атрибут len читает requests.utils.super_len
+        self.len = total
+        self._iter: Optional[Iterator[bytes]] = None
+        self._buffer = b""
+        self._position = 0
+
+    def iter_chunks(self) -> Iterator[bytes]:
+        """Последовательные блоки тела (каждый вызов — с начала)"""
+        for seg in self.segments:
+            if isinstance(seg, FilePart):
+                yield from seg.iter_base64()
+            elif seg:
+                yield seg
+
+    def __iter__(self) -> Iterator[bytes]:
+        return self.iter_chunks()
+
+    def read(self, size: int = -1) -> bytes:
+        if self._iter is None:
+            self._iter = self.iter_chunks()
+        while size < 0 or len(self._buffer) < size:
+            chunk = next(self._iter, None)
+            if chunk is None:
+                break
+            self._buffer += chunk
+        if size < 0:
+            out, self._buffer = self._buffer, b""
+        else:
+            out, self._buffer = self._buffer[:size], self._buffer[size:]
+        self._position += len(out)
+        return out
+
+    def tell(self) -> int:
+        return self._position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if offset != 0 or whence != io.SEEK_SET:
+            raise io.UnsupportedOperation("Поддерживается только seek(0)")
+        self._iter = None
+        self._buffer = b""
+        self._position = 0
+        return 0
+
+
+class _StreamDecoder:
+    """Потоковая распаковка тела ответа; несколько подряд идущих gzip/zstd фреймов"""
+
+    def __init__(self, factory: Callable[[], Any]) -> None:
+        self._factory = factory
+        self._obj = factory()
+
+    def decompress(self, data: bytes) -> bytes:
+        out = []
+        try:
+            while data:
+                out.append(self._obj.decompress(data))
+                if not getattr(self._obj, "eof", False):
+                    break
+                data = self._obj.unused_data
+                self._obj = self._factory()
+        except Exception as e:  # zlib.error / zstandard.ZstdError
+            raise WayGPTError(f"Ошибка распаковки потока: {e}")
+        return b"".join(out)
+
+
+class _MediaResult(dict):  # type: ignore[type-arg]
+    """Ответ медиа-эндпоинта с адресом зеркала, которое его отдало (endpoint)"""
+
+    endpoint: Optional[str] = None
+
+    @classmethod
+    def tag(cls, result: _T, base_url: str) -> _T:
+        if not isinstance(result, dict):
+            return result
+        tagged = cls(result)
+        tagged.endpoint = base_url
+        return cast(_T, tagged)
+
+
 class WayGPTClient:
     """Клиент для работы с WayGPT API"""
 
+    # Размер блока чтения потоковых ответов (как у requests.iter_lines)
+    _STREAM_CHUNK_SIZE = 512
+    # Размер блока при скачивании медиа и декодировании base64 (кратен 4)
+    _MEDIA_CHUNK_SIZE = 64 * 1024
+    # Статусы задачи медиа, после которых опрос прекращается
+    _MEDIA_JOB_DONE_STATUSES = ("completed", "succeeded", "success", "done")
+    _MEDIA_JOB_FAILED_STATUSES = ("failed", "error", "cancelled", "canceled")
+    # Эндпоинты генерации медиа по виду задачи (также для MediaJobJournal)
+    _MEDIA_GENERATION_ENDPOINTS = {
+        "image": "/api/v1/waygpt/images/generations",
+        "video": "/api/v1/waygpt/videos/generations",
+    }
+    # Эндпоинты, в ответах которых бывают относительные URL файлов
+    _MEDIA_ENDPOINTS = ("/api/v1/waygpt/images/", "/api/v1/waygpt/videos/", "/api/v1/waygpt/media/")
+
     def __init__(
         self,
-        api_url: Optional[str] = None,
+        api_url: Optional[Union[str, Sequence[EndpointSpec]]] = None,
         project_key: Optional[str] = None,
         project_id: Optional[str] = None,
         hmac_secret: Optional[str] = None,
         use_hmac: bool = False,
         timeout: int = 60,
-        max_retries: int = 3
+        max_retries: int = 3,
+        compression: Optional[str] = None,
+        compression_threshold: int = 16384,
+        coalesce_requests: bool = False,
+        balancing: str = "least_outstanding",
+        health_check_interval: float = 0.0,
+        health_check_path: str = "/api/v1/waygpt/models",
+        tracer: Optional[Tracer] = None
     ) -> None:
         """
         Инициализация клиента
 
         Args:
-            api_url: URL API сервера (по умолчанию из WAYGPT_API_URL)
+            api_url: URL API сервера (по умолчанию из WAYGPT_API_URL). Для зеркал — список
+                URL, пар (URL, вес) или {"url": ..., "weight": ...}; в WAYGPT_API_URL — через запятую
             project_key: Project Key (по умолчанию из WAYGPT_PROJECT_KEY)
             project_id: Project ID для HMAC (по умолчанию из WAYGPT_PROJECT_ID)
             hmac_secret: HMAC Secret (по умолчанию из WAYGPT_HMAC_SECRET)
             use_hmac: Включить HMAC подпись (по умолчанию из WAYGPT_USE_HMAC)
             timeout: Таймаут запросов в секундах
             max_retries: Максимальное количество повторов при ошибках
+            compression: Сжатие тела запроса: "gzip", "zstd" или None (выключено)
+            compression_threshold: Минимальный размер тела в байтах, начиная с которого оно сжимается
+            coalesce_requests: Объединять одновременные одинаковые запросы (GET и
+                детерминированные chat completions с temperature=0) в один
+            balancing: Выбор зеркала: "least_outstanding" или "ewma" (по задержке)
+            health_check_interval: Период фоновой проверки зеркал в секундах (0 — выкл.)
+            health_check_path: Endpoint для проверки зеркал (подписанный GET)
+            tracer: Трассировка вызовов (RecordingTracer, OpenTelemetryTracer или свой Tracer);
+                по умолчанию выключена
         """
-        self.api_url = (api_url or os.getenv("WAYGPT_API_URL") or "https://app.waygpt.ru").rstrip("/")
+        endpoints = _EndpointBalancer.parse(api_url or os.getenv("WAYGPT_API_URL") or "https://app.waygpt.ru")
+        # Основной адрес (первый в списке) — для обратной совместимости
+        self.api_url = endpoints[0][0]
         _pk = project_key or os.getenv("WAYGPT_PROJECT_KEY")
         self.project_key = _pk
         self.project_id = project_id or os.getenv("WAYGPT_PROJECT_ID")
         self.hmac_secret = hmac_secret or os.getenv("WAYGPT_HMAC_SECRET")
         self.use_hmac = use_hmac or (os.getenv("WAYGPT_USE_HMAC", "false").lower() == "true")
         self.timeout = timeout
+        self.tracer = tracer or Tracer()
+        self._tracing = tracer is not None
 
         if not _pk or not str(_pk).strip():
             raise ValueError("project_key обязателен. Укажите при инициализации или через WAYGPT_PROJECT_KEY")
@@ -65,50 +1045,170 @@ class WayGPTClient:
             if not self.hmac_secret:
                 raise ValueError("hmac_secret обязателен при использовании HMAC")
 
+        if compression is not None and compression not in SUPPORTED_COMPRESSIONS:
+            raise ValueError(f"Неподдерживаемое сжатие: {compression}. Допустимо: {', '.join(SUPPORTED_COMPRESSIONS)}")
+        if compression == "zstd" and zstandard is None:
+            raise ValueError("Для compression='zstd' установите пакет zstandard")
+        self.compression = compression
+        self.compression_threshold = compression_threshold
+        # Сервер ответил 415 на сжатое тело — дальше отправляем без сжатия
+        self._compression_rejected = False
+
+        # Счётчики клиента (см. get_stats)
+        self._stats: Dict[str, float] = {}
+        self._stats_lock = threading.Lock()
+
+        # Объединение одновременных одинаковых запросов
+        self.coalesce_requests = coalesce_requests
+        self._single_flight = SingleFlight()
+        self._auth_identity = hashlib.sha256(str(_pk).encode("utf-8")).hexdigest()[:16]
+
+        # Клиентский выбор модели для model="auto" (см. enable_model_router)
+        self.model_router: Optional[ModelRouter] = None
+        # Очередь запросов с приоритетами (см. enable_scheduler)
+        self.scheduler: Optional[RequestScheduler] = None
+        # Общий для воркеров хоста кеш метаданных (см. shared_metadata)
+        self.metadata: Optional[SharedMetadataCache] = None
+
+        # Пулы widget-токенов по site_domain (см. widget_token_pool)
+        self._widget_pools: Dict[Optional[str], WidgetTokenPool] = {}
+        self._widget_pools_lock = threading.Lock()
+
         # Настройка сессии с retry
         self.session = requests.Session()
         retry_strategy = Retry(
             total=max_retries,
+            # С несколькими зеркалами ошибку соединения обрабатывает переключение на другое зеркало
+            connect=0 if len(endpoints) > 1 else None,
             backoff_factor=1,
             status_forcelist=[429, 500, 502, 503, 504],
             allowed_methods=["GET", "POST", "PUT"]
         )
-        adapter = HTTPAdapter(max_retries=retry_strategy)
+        # События пула и соединений пишутся в span, только если трассировка включена
+        adapter = (_TracingHTTPAdapter if self._tracing else HTTPAdapter)(max_retries=retry_strategy)
         self.session.mount("http://", adapter)
         self.session.mount("https://", adapter)
 
+        # Несколько зеркал: балансировка, исключение недоступных, фоновые проверки.
+        # HMAC не зависит от хоста (в подписи только путь), пулы соединений
+        # urllib3 ведёт отдельно для каждого хоста.
+        self._balancer: Optional[_EndpointBalancer] = None
+        if len(endpoints) > 1:
+            self._balancer = _EndpointBalancer(endpoints, strategy=balancing)
+            if health_check_interval > 0:
+                self._balancer.start_health_checks(self, health_check_interval, health_check_path)
+
+    def _with_endpoint(self, send: Callable[[str], _T], idempotent: bool = True) -> _T:
+        """
+        Выполнение send(base_url) на выбранном зеркале
+
+        При ошибке сети или 502/503/504 запрос повторяется на следующем зеркале.
+        Неидемпотентный запрос (idempotent=False) повторяется только при ошибке
+        соединения: после отправки зеркало могло его выполнить, и повтор создал бы
+        вторую платную задачу. Стрим (requests.Response) занимает зеркало до закрытия ответа.
+        """
+        balancer = self._balancer
+        if balancer is None:
+            return send(self.api_url)
+
+        tried: List[_Endpoint] = []
+        while True:
+            ep = balancer.acquire(exclude=tried)
+            started = time.monotonic()
+            try:
+                result = send(ep.url)
+            except WayGPTError as e:
+                unavailable = e.status_code is None or e.status_code in (502, 503, 504)
+                failover = unavailable and (idempotent or _is_connect_error(e.__cause__))
+                balancer.release(ep, time.monotonic() - started, failed=unavailable)
+                tried.append(ep)
+                if not failover or len(tried) >= len(balancer.endpoints):
+                    raise
+                self._record_stats(endpoint_failovers=1)
+                continue
+            if isinstance(result, requests.Response):
+                # Задержка — до заголовков, а в работе стрим до закрытия ответа
+                balancer.observe(ep, time.monotonic() - started)
+                close = result.close
+                released = False
+
+                def release_on_close() -> None:
+                    nonlocal released
+                    try:
+                        close()
+                    finally:
+                        if not released:
+                            released = True
+                            balancer.finish(ep)
+
+                result.close = release_on_close  # type: ignore[method-assign]
+                return result
+            balancer.release(ep, time.monotonic() - started, failed=False)
+            return result
+
+    def close(self) -> None:
+        """
+        Освобождение ресурсов клиента: фоновая проверка зеркал, пулы widget-токенов,
+        общий кеш метаданных и пул соединений
+        """
+        if self._balancer is not None:
+            self._balancer.stop_health_checks()
+        with self._widget_pools_lock:
+            pools, self._widget_pools = list(self._widget_pools.values()), {}
+        for pool in pools:
+            pool.close()
+        if self.metadata is not None:
+            self.metadata.close()
+        self.session.close()
+
+    def __enter__(self) -> "WayGPTClient":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    def endpoint_stats(self) -> List[Dict[str, Any]]:
+        """
+        Состояние зеркал API
+
+        Returns:
+            List[Dict]: url, weight, healthy, outstanding, latency_ewma, failures, requests
+        """
+        if self._balancer is None:
+            return [{"url": self.api_url, "weight": 1.0, "healthy": True}]
+        return self._balancer.stats()
+
     def _generate_hmac_signature(
         self,
         method: str,
         path: str,
-        body: Optional[Union[str, bytes, Dict[str, Any]]],
+        body: Optional[Union[str, bytes, Dict[str, Any], _StreamingBody]],
         timestamp: int,
         nonce: str
     ) -> str:
         """Генерация HMAC подписи"""
-        # Преобразуем body в bytes (используем стандартную сериализацию как в requests)
-        if isinstance(body, dict):
-            body_string = json.dumps(body, ensure_ascii=False, sort_keys=False)
-            body_bytes = body_string.encode("utf-8")
-        elif isinstance(body, str):
-            body_bytes = body.encode("utf-8")
-        elif isinstance(body, bytes):
-            body_bytes = body
+        if isinstance(body, _StreamingBody):
+            # Потоковое тело хешируем по блокам, не собирая его в памяти
+            hasher = hashlib.sha256()
+            for chunk in body.iter_chunks():
+                hasher.update(chunk)
+            body_hash = hasher.hexdigest()
         else:
-            body_bytes = b""
+            # Преобразуем body в bytes (та же сериализация, что и в _serialize_body)
+            if isinstance(body, dict):
+                body_bytes = self._serialize_body(body)
+            elif isinstance(body, str):
+                body_bytes = body.encode("utf-8")
+            elif isinstance(body, bytes):
+                body_bytes = body
+            else:
+                body_bytes = b""
 
-        # Хешируем body
-        body_hash = hashlib.sha256(body_bytes).hexdigest()
+            # Хешируем body
+            body_hash = hashlib.sha256(body_bytes).hexdigest()
 
         # Формируем canonical string
-        canonical = "\n".join([
-            method.upper(),
-            path,
-            f"sha256(body)={body_hash}",
-            f"timestamp={timestamp}",
-            f"nonce={nonce}",
-            f"project={self.project_id}",
-        ])
+        canonical = build_hmac_canonical(method, path, body_hash, timestamp, nonce, self.project_id)
 
         # Создаём подпись (вызывается только при use_hmac; secret и project_id проверены в __init__)
         _secret = self.hmac_secret if self.hmac_secret is not None else ""
@@ -120,7 +1220,12 @@ class WayGPTClient:
 
         return signature
 
-    def _prepare_headers(self, method: str, path: str, body: Optional[Dict[str, Any]] = None) -> Dict[str, str]:
+    def _prepare_headers(
+        self,
+        method: str,
+        path: str,
+        body: Optional[Union[bytes, Dict[str, Any], _StreamingBody]] = None
+    ) -> Dict[str, str]:
         """Подготовка заголовков запроса"""
         headers: Dict[str, str] = {
             "Content-Type": "application/json",
@@ -138,8 +1243,149 @@ class WayGPTClient:
                 "X-MB-Signature": signature,
             })
 
+        if self._tracing:
+            self._inject_traceparent(headers)
+
         return headers
 
+    # ==================== Трассировка ====================
+
+    def _traced(self, name: str, attributes: Dict[str, Any], call: Callable[[], _T]) -> _T:
+        """Выполнение call() в span (если стрим уже открыл span — в нём)"""
+        span = _stream_span.get()
+        owned = span is None
+        if span is None:
+            span = self.tracer.start_span(name, attributes)
+        token = _current_span.set(span)
+        try:
+            result = call()
+        except BaseException as e:
+            span.record_exception(e)
+            if owned:
+                span.end(error=True)
+            raise
+        finally:
+            _current_span.reset(token)
+        if owned:
+            span.end()
+        return result
+
+    @staticmethod
+    def _inject_traceparent(headers: Dict[str, str]) -> None:
+        """W3C traceparent текущего span; заголовки готовятся заново для каждой попытки"""
+        span = _current_span.get()
+        traceparent = span.traceparent if span is not None else None
+        if traceparent:
+            headers["traceparent"] = traceparent
+
+    # ==================== Статистика ====================
+
+    def _record_stats(self, **deltas: float) -> None:
+        """Потокобезопасное увеличение счётчиков клиента"""
+        with self._stats_lock:
+            for name, value in deltas.items():
+                self._stats[name] = self._stats.get(name, 0) + value
+
+    def get_stats(self) -> Dict[str, Any]:
+        """
+        Снимок счётчиков клиента
+
+        Returns:
+            Dict со счётчиками. Для сжатия дополнительно вычисляются
+            request_compression_ratio и response_compression_ratio (raw / wire).
+        """
+        with self._stats_lock:
+            stats: Dict[str, Any] = dict(self._stats)
+        if stats.get("request_bytes_compressed"):
+            stats["request_compression_ratio"] = stats["request_bytes_raw"] / stats["request_bytes_compressed"]
+        if stats.get("response_bytes_wire"):
+            stats["response_compression_ratio"] = stats["response_bytes_decoded"] / stats["response_bytes_wire"]
+        return stats
+
+    # ==================== Сжатие ====================
+
+    @staticmethod
+    def _serialize_body(data: Dict[str, Any]) -> bytes:
+        """Сериализация тела запроса (те же байты подписываются HMAC и уходят в сеть)"""
+        return json.dumps(data, ensure_ascii=False, sort_keys=False).encode("utf-8")
+
+    @staticmethod
+    def _encode_body(data: Dict[str, Any]) -> Union[bytes, _StreamingBody]:
+        """
+        Кодирование тела запроса
+
+        Если в данных есть файлы (FilePart, pathlib.Path, открытый файл), возвращается
+        потоковое тело: JSON с вставками base64, который генерируется при отправке.
+        """
+        files: List[FilePart] = []
+        marker = f"@@waygpt-file-{secrets.token_hex(8)}-"
+
+        def _default(obj: Any) -> Any:
+            if isinstance(obj, (os.PathLike, io.IOBase)):
+                obj = FilePart(cast(Any, obj))
+            if isinstance(obj, FilePart):
+                files.append(obj)
+                return obj.to_part(f"{marker}{len(files) - 1}@@")
+            raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+        text = json.dumps(data, ensure_ascii=False, sort_keys=False, default=_default)
+        if not files:
+            return text.encode("utf-8")
+
+        segments: List[Union[bytes, FilePart]] = []
+        for i, piece in enumerate(re.split(re.escape(marker) + r"\d+@@", text)):
+            if i:
+                segments.append(files[i - 1])
+            segments.append(piece.encode("utf-8"))
+        return _StreamingBody(segments)
+
+    def _compress_body(self, body: bytes) -> Tuple[bytes, Optional[str]]:
+        """
+        Сжатие тела запроса, если оно включено и тело не меньше порога
+
+        Returns:
+            (тело, Content-Encoding или None)
+        """
+        if not self.compression or self._compression_rejected or len(body) < self.compression_threshold:
+            return body, None
+
+        started = time.perf_counter()
+        if self.compression == "zstd":
+            compressed = zstandard.ZstdCompressor(level=3).compress(body)
+        else:
+            compressed = gzip.compress(body, compresslevel=6)
+        elapsed = time.perf_counter() - started
+
+        # Несжимаемые данные (например, уже base64 JPEG) отправляем как есть
+        if len(compressed) >= len(body):
+            return body, None
+
+        self._record_stats(
+            requests_compressed=1,
+            request_bytes_raw=len(body),
+            request_bytes_compressed=len(compressed),
+            compression_seconds=elapsed,
+        )
+        return compressed, self.compression
+
+    def _record_response_encoding(
+        self,
+        response: requests.Response,
+        decoded_bytes: int,
+        wire_bytes: Optional[int] = None
+    ) -> None:
+        """Учёт степени сжатия ответа (по умолчанию байты из сети считает urllib3)"""
+        if not response.headers.get("Content-Encoding"):
+            return
+        if wire_bytes is None:
+            wire_bytes = response.raw.tell() if response.raw is not None else 0
+        if wire_bytes:
+            self._record_stats(
+                responses_compressed=1,
+                response_bytes_wire=wire_bytes,
+                response_bytes_decoded=decoded_bytes,
+            )
+
     def _make_request(
         self,
         method: str,
@@ -162,29 +1408,156 @@ class WayGPTClient:
         Raises:
             WayGPTError: При ошибках API
         """
-        url = f"{self.api_url}{endpoint}"
-        headers = self._prepare_headers(method, endpoint, data)
+        if method not in ("GET", "POST", "PUT"):
+            raise ValueError(f"Неподдерживаемый метод: {method}")
+
+        body = self._encode_body(data) if data is not None and method != "GET" else None
+        use_case = data.get("use_case") if data is not None and self.scheduler is not None else None
+        # POST повторяется на другом зеркале после отправки, только если сервер может
+        # распознать повтор по idempotency_key
+        idempotent = method != "POST" or (data is not None and bool(data.get("idempotency_key")))
+
+        if self.coalesce_requests and not stream and self._is_coalescable(method, endpoint, data, body):
+            body_hash = hashlib.sha256(body).hexdigest() if isinstance(body, bytes) else ""
+            key = (method, endpoint, body_hash, self._auth_identity)
+            return self._coalesced(
+                key, lambda: self._scheduled(use_case, False, lambda: self._execute_request(method, endpoint, body, False, idempotent))
+            )
+
+        return self._scheduled(use_case, stream, lambda: self._execute_request(method, endpoint, body, stream, idempotent))
+
+    def _coalesced(
+        self, key: Hashable, call: Callable[[], Union[Dict[str, Any], List[Any]]]
+    ) -> Union[Dict[str, Any], List[Any]]:
+        """
+        Выполнение call() через SingleFlight
+
+        Каждый вызывающий, включая выполнившего запрос, получает свою копию результата:
+        общий результат не меняется, пока его копируют остальные. Присоединившиеся
+        вызовы (с результатом или с исключением) считаются в requests_coalesced.
+        """
+        executed = False
+
+        def run() -> Union[Dict[str, Any], List[Any]]:
+            nonlocal executed
+            executed = True
+            return call()
 
         try:
-            if method == "GET":
-                response = self.session.get(url, headers=headers, timeout=self.timeout, stream=stream)
-            elif method == "POST":
-                response = self.session.post(
+            result, _ = self._single_flight.do(key, run)
+        finally:
+            if not executed:
+                self._record_stats(requests_coalesced=1)
+        return cast(Union[Dict[str, Any], List[Any]], copy.deepcopy(result))
+
+    def _scheduled(self, use_case: Optional[str], stream: bool, call: Callable[[], _T]) -> _T:
+        """Выполнение call() через очередь с приоритетами (если она включена)"""
+        scheduler = self.scheduler
+        if scheduler is None:
+            return call()
+        ticket = scheduler.acquire(use_case)
+        try:
+            result = call()
+        except BaseException:
+            scheduler.release(ticket)
+            raise
+        if stream and isinstance(result, requests.Response):
+            # Стрим занимает место до закрытия ответа
+            close = result.close
+
+            def release_on_close() -> None:
+                try:
+                    close()
+                finally:
+                    scheduler.release(ticket)
+
+            result.close = release_on_close  # type: ignore[method-assign]
+        else:
+            scheduler.release(ticket)
+        return result
+
+    @staticmethod
+    def _is_coalescable(
+        method: str,
+        endpoint: str,
+        data: Optional[Dict[str, Any]],
+        body: Optional[Union[bytes, _StreamingBody]]
+    ) -> bool:
+        """
+        Можно ли объединить запрос с одинаковыми одновременными
+
+        Только запросы без побочных эффектов: GET и chat completions с temperature=0.
+        """
+        if method == "GET":
+            return True
+        return (
+            endpoint == "/api/v1/waygpt/chat/completions"
+            and isinstance(body, bytes)
+            and data is not None
+            and data.get("temperature") == 0
+        )
+
+    def _execute_request(
+        self,
+        method: str,
+        endpoint: str,
+        body: Optional[Union[bytes, _StreamingBody]],
+        stream: bool,
+        idempotent: bool = True
+    ) -> Union[Dict[str, Any], List[Any], requests.Response]:
+        """Отправка запроса с уже закодированным телом и разбор ответа"""
+        if endpoint.startswith(self._MEDIA_ENDPOINTS):
+            # Относительные URL файлов в ответе — на том зеркале, которое его отдало
+            send = lambda: self._with_endpoint(  # noqa: E731
+                lambda base_url: _MediaResult.tag(self._send_request(base_url, method, endpoint, body, stream), base_url),
+                idempotent,
+            )
+        else:
+            send = lambda: self._with_endpoint(  # noqa: E731
+                lambda base_url: self._send_request(base_url, method, endpoint, body, stream), idempotent
+            )
+        if not self._tracing:
+            return send()
+        return self._traced(f"WayGPT {method} {endpoint}", {"http.method": method, "http.route": endpoint, "stream": stream}, send)
+
+    def _send_request(
+        self,
+        base_url: str,
+        method: str,
+        endpoint: str,
+        body: Optional[Union[bytes, _StreamingBody]],
+        stream: bool
+    ) -> Union[Dict[str, Any], List[Any], requests.Response]:
+        """Один запрос к конкретному адресу API"""
+        url = f"{base_url}{endpoint}"
+
+        try:
+            while True:
+                # HMAC подписывает несжатое тело; новый nonce на каждую попытку
+                headers = self._prepare_headers(method, endpoint, body)
+                # Потоковое тело (файлы) не сжимаем: его размер и так ограничен файлами
+                payload, encoding = self._compress_body(body) if isinstance(body, bytes) else (body, None)
+                if isinstance(payload, _StreamingBody):
+                    payload.seek(0)
+                if encoding:
+                    headers["Content-Encoding"] = encoding
+
+                response = self.session.request(
+                    method,
                     url,
                     headers=headers,
-                    json=data,
+                    data=payload,
                     timeout=self.timeout,
                     stream=stream
                 )
-            elif method == "PUT":
-                response = self.session.put(
-                    url,
-                    headers=headers,
-                    json=data,
-                    timeout=self.timeout
-                )
-            else:
-                raise ValueError(f"Неподдерживаемый метод: {method}")
+
+                # Сервер не принимает сжатое тело — запоминаем и повторяем без сжатия
+                if encoding and response.status_code == 415:
+                    response.close()
+                    self._compression_rejected = True
+                    self._record_stats(compression_rejected=1)
+                    continue
+                break
 
             # Обработка ошибок
             if response.status_code >= 400:
@@ -204,10 +1577,12 @@ class WayGPTClient:
             if stream:
                 return response
 
-            return response.json()
+            result = _json_loads(response.content)
+            self._record_response_encoding(response, len(response.content))
+            return result
 
         except requests.exceptions.RequestException as e:
-            raise WayGPTError(f"Ошибка сети: {str(e)}")
+            raise WayGPTError(f"Ошибка сети: {str(e)}") from e
         except WayGPTError:
             raise
         except Exception as e:
@@ -224,23 +1599,33 @@ class WayGPTClient:
         temperature: Optional[float] = None,
         max_tokens: Optional[int] = None,
         stream: bool = False,
+        stop_sequences: Optional[List[str]] = None,
+        stop_when: Optional[Callable[[str], bool]] = None,
+        typed: bool = False,
         **kwargs: Any
-    ) -> Union[Dict[str, Any], Iterator[Dict[str, Any]]]:
+    ) -> Union[Dict[str, Any], "ChatCompletion", "ChatCompletionStream"]:
         """
         Создание текстового ответа
 
         Args:
             model: ID модели или "auto"
-            messages: Список сообщений [{"role": "user", "content": "..."}]
+            messages: Список сообщений [{"role": "user", "content": "..."}].
+                В content-списке можно передавать FilePart, pathlib.Path или открытый
+                бинарный файл — они отправляются потоково (base64 без копии в памяти).
             use_case_id: Устаревший алиас. Используйте use_case (ключ сценария).
             use_case: Ключ сценария (например "support_chat"). См. get_use_cases().
             temperature: Температура генерации (0.0-2.0)
             max_tokens: Максимальная длина ответа
             stream: Включить стриминг
+            stop_sequences: (стриминг) Остановить стрим на клиенте, как только в тексте
+                появится одна из строк; сама строка в ответ не попадает
+            stop_when: (стриминг) Остановить стрим, когда функция от накопленного текста вернёт True
+            typed: Типизированный ответ: ChatCompletion вместо Dict, а в стриме — StreamDelta
+                (только текст и finish_reason, без разбора всего JSON чанка)
             **kwargs: Дополнительные параметры
 
         Returns:
-            Dict с ответом или Iterator для стриминга
+            Dict (или ChatCompletion) с ответом или ChatCompletionStream (итератор чанков с cancel()) для стриминга
         """
         if messages is None:
             messages = []
@@ -261,34 +1646,124 @@ class WayGPTClient:
         if stream:
             data["stream"] = True
 
-        if stream:
-            return self._chat_completions_stream(data)
-        out = self._make_request("POST", "/api/v1/waygpt/chat/completions", data)
-        return cast(Dict[str, Any], out)
+        # Клиентский роутер: кандидаты по убыванию предпочтения (None — решает сервер)
+        router = self.model_router
+        candidates: List[Optional[str]] = [None]
+        if router is not None and model == "auto":
+            candidates = list(router.route(data.get("use_case"), stream=stream)) or [None]
 
-    def _chat_completions_stream(self, data: Dict[str, Any]) -> Iterator[Dict[str, Any]]:
-        """Стриминг ответов chat completions"""
-        resp = self._make_request("POST", "/api/v1/waygpt/chat/completions", data, stream=True)
-        assert isinstance(resp, requests.Response)
+        if stream:
+            chosen = candidates[0]
+            if chosen is not None:
+                data["model"] = chosen
+            on_finish = (
+                (lambda ttft, total, error: cast(ModelRouter, router).observe(cast(str, chosen), total, ttft, error))
+                if chosen is not None else None
+            )
+            return self._chat_completions_stream(
+                data, stop_sequences=stop_sequences, stop_when=stop_when, on_finish=on_finish, typed=typed
+            )
+
+        if candidates[0] is None:
+            out = cast(Dict[str, Any], self._make_request("POST", "/api/v1/waygpt/chat/completions", data))
+        else:
+            out = self._chat_completions_routed(data, cast(List[str], candidates))
+        return ChatCompletion.from_dict(out) if typed else out
+
+    def _chat_completions_routed(self, data: Dict[str, Any], candidates: List[str]) -> Dict[str, Any]:
+        """Chat completions с моделью от роутера; при 5xx/429/ошибке сети — следующий кандидат"""
+        router = cast(ModelRouter, self.model_router)
+        last_error: Optional[WayGPTError] = None
+        for chosen in candidates:
+            if last_error is not None:
+                self._record_stats(router_fallbacks=1)
+            data["model"] = chosen
+            started = time.monotonic()
+            try:
+                out = self._make_request("POST", "/api/v1/waygpt/chat/completions", data)
+            except WayGPTError as e:
+                # Ошибка запроса (4xx) — не вина модели; 429 — повод попробовать другую
+                if _is_model_failure(e):
+                    router.observe(chosen, time.monotonic() - started, error=True)
+                elif e.status_code != 429:
+                    raise
+                last_error = e
+                continue
+            router.observe(chosen, time.monotonic() - started)
+            return cast(Dict[str, Any], out)
+        raise cast(WayGPTError, last_error)
+
+    @staticmethod
+    def _stream_decoder(encoding: Optional[str]) -> Optional["_StreamDecoder"]:
+        """Распаковщик потокового ответа (None — тело не сжато или его распаковывает urllib3)"""
+        encoding = (encoding or "").strip().lower()
+        if encoding in ("gzip", "x-gzip"):
+            return _StreamDecoder(lambda: zlib.decompressobj(16 + zlib.MAX_WBITS))
+        if encoding == "zstd" and zstandard is not None:
+            return _StreamDecoder(lambda: zstandard.ZstdDecompressor().decompressobj())
+        return None
+
+    def _iter_stream_lines(self, resp: requests.Response) -> Iterator[bytes]:
+        """
+        Построчное чтение потокового ответа
 
+        Сжатый поток (gzip/zstd) распаковывается по мере чтения, без буферизации
+        всего ответа; байты из сети считаются здесь же (у chunked-ответов urllib3
+        их не считает).
+        """
+        decoded_bytes = 0
+        wire_bytes: Optional[int] = None
+        decoder = self._stream_decoder(resp.headers.get("Content-Encoding"))
+        # Незавершённая строка; "\n" ищется только в новых байтах, поэтому
+        # длинная строка из многих блоков собирается за линейное время
+        pending = bytearray()
         try:
-            for line in resp.iter_lines():
-                if not line:
+            if decoder is None:
+                chunks: Iterable[bytes] = resp.iter_content(chunk_size=self._STREAM_CHUNK_SIZE)
+            else:
+                wire_bytes = 0
+                chunks = resp.raw.stream(self._STREAM_CHUNK_SIZE, decode_content=False)
+            for chunk in chunks:
+                if decoder is not None:
+                    wire_bytes = cast(int, wire_bytes) + len(chunk)
+                    chunk = decoder.decompress(chunk)
+                if not chunk:
                     continue
-
-                line_str = line.decode("utf-8")
-                if line_str.startswith('data: '):
-                    data_str = line_str[6:]  # Убираем "data: "
-                    if data_str.strip() == '[DONE]':
+                decoded_bytes += len(chunk)
+                scan = len(pending)
+                pending += chunk
+                start = 0
+                while True:
+                    end = pending.find(b"\n", scan)
+                    if end < 0:
                         break
-
-                    try:
-                        chunk = json.loads(data_str)
-                        yield chunk
-                    except json.JSONDecodeError:
-                        continue
+                    yield bytes(pending[start:end]).rstrip(b"\r")
+                    start = scan = end + 1
+                if start:
+                    del pending[:start]
+            if pending:
+                yield bytes(pending).rstrip(b"\r")
         finally:
-            resp.close()
+            self._record_response_encoding(resp, decoded_bytes, wire_bytes)
+
+    def _chat_completions_stream(
+        self,
+        data: Dict[str, Any],
+        stop_sequences: Optional[List[str]] = None,
+        stop_when: Optional[Callable[[str], bool]] = None,
+        on_finish: Optional[Callable[[Optional[float], float, bool], None]] = None,
+        typed: bool = False
+    ) -> "ChatCompletionStream":
+        """Стриминг ответов chat completions"""
+        return ChatCompletionStream(
+            self,
+            lambda: self._make_request("POST", "/api/v1/waygpt/chat/completions", data, stream=True),
+            stop_sequences=stop_sequences,
+            stop_when=stop_when,
+            max_tokens=data.get("max_tokens"),
+            on_finish=on_finish,
+            typed=typed,
+        )
 
     def chat_completions_stream(
         self,
@@ -298,8 +1773,11 @@ class WayGPTClient:
         use_case: Optional[str] = None,
         temperature: Optional[float] = None,
         max_tokens: Optional[int] = None,
+        stop_sequences: Optional[List[str]] = None,
+        stop_when: Optional[Callable[[str], bool]] = None,
+        typed: bool = False,
         **kwargs: Any
-    ) -> Iterator[Dict[str, Any]]:
+    ) -> "ChatCompletionStream":
         """
         Стриминг ответов (удобный метод)
 
@@ -310,10 +1788,14 @@ class WayGPTClient:
             use_case: Ключ сценария (например "support_chat")
             temperature: Температура генерации
             max_tokens: Максимальная длина ответа
+            stop_sequences: Остановить стрим на клиенте на одной из строк
+            stop_when: Остановить стрим, когда функция от накопленного текста вернёт True
+            typed: Отдавать StreamDelta (content, finish_reason) вместо Dict — быстрее и
+                без лишних объектов на каждый чанк
             **kwargs: Дополнительные параметры
 
         Yields:
-            Dict с чанками ответа
+            Dict (или StreamDelta) с чанками ответа; у итератора есть cancel() и stats()
         """
         gen = self.chat_completions(
             model=model,
@@ -323,9 +1805,38 @@ class WayGPTClient:
             temperature=temperature,
             max_tokens=max_tokens,
             stream=True,
+            stop_sequences=stop_sequences,
+            stop_when=stop_when,
+            typed=typed,
             **kwargs
         )
-        return cast(Iterator[Dict[str, Any]], gen)
+        return cast(ChatCompletionStream, gen)
+
+    def chat_completions_multicast(
+        self,
+        replay_size: int = 256,
+        subscriber_buffer: int = 1024,
+        backpressure: str = "coalesce",
+        **kwargs: Any
+    ) -> "StreamMulticast":
+        """
+        Одна генерация для многих получателей (например, общий чат-рум)
+
+        Args:
+            replay_size: Сколько последних чанков хранить для поздно подключившихся
+            subscriber_buffer: Очередь одного подписчика
+            backpressure: Политика для медленных подписчиков: "coalesce", "drop_oldest", "disconnect"
+            **kwargs: Параметры chat_completions_stream (model, messages, use_case, ...)
+
+        Returns:
+            Запущенный StreamMulticast; подписка — через subscribe()
+        """
+        return StreamMulticast(
+            self.chat_completions_stream(**kwargs),
+            replay_size=replay_size,
+            subscriber_buffer=subscriber_buffer,
+            backpressure=backpressure,
+        ).start()
 
     # ==================== Image Generations ====================
 
@@ -350,6 +1861,12 @@ class WayGPTClient:
         Returns:
             Dict с результатами генерации
         """
+        data = self._image_generation_data(prompt, model, size, n, **kwargs)
+        return cast(Dict[str, Any], self._make_request("POST", self._MEDIA_GENERATION_ENDPOINTS["image"], data))
+
+    @staticmethod
+    def _image_generation_data(prompt: str, model: Optional[str], size: str, n: int, **kwargs: Any) -> Dict[str, Any]:
+        """Тело запроса генерации изображений"""
         data = {
             "prompt": prompt,
             "size": size,
@@ -359,8 +1876,7 @@ class WayGPTClient:
 
         if model:
             data["model"] = model
-
-        return cast(Dict[str, Any], self._make_request("POST", "/api/v1/waygpt/images/generations", data))
+        return data
 
     # ==================== Video Generations ====================
 
@@ -383,6 +1899,12 @@ class WayGPTClient:
         Returns:
             Dict с job_id задачи
         """
+        data = self._video_generation_data(prompt, model, duration, **kwargs)
+        return cast(Dict[str, Any], self._make_request("POST", self._MEDIA_GENERATION_ENDPOINTS["video"], data))
+
+    @staticmethod
+    def _video_generation_data(prompt: str, model: Optional[str], duration: Optional[int], **kwargs: Any) -> Dict[str, Any]:
+        """Тело запроса генерации видео"""
         data = {
             "prompt": prompt,
             **kwargs
@@ -392,8 +1914,7 @@ class WayGPTClient:
             data["model"] = model
         if duration:
             data["duration"] = duration
-
-        return cast(Dict[str, Any], self._make_request("POST", "/api/v1/waygpt/videos/generations", data))
+        return data
 
     # ==================== Media Jobs ====================
 
@@ -421,6 +1942,251 @@ class WayGPTClient:
         """
         return cast(Dict[str, Any], self._make_request("POST", f"/api/v1/waygpt/media/jobs/{job_id}/cancel"))
 
+    # ==================== Media Download ====================
+
+    @staticmethod
+    def _extract_media_items(result: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """
+        Извлечение элементов медиа из ответа генерации или задачи
+
+        Поддерживаются {"data": [{"url" | "b64_json": ...}]}, вложенный "result"
+        и одиночные поля url / b64_json на верхнем уровне.
+        """
+        sources: List[Any] = [result]
+        if isinstance(result.get("result"), dict):
+            sources.append(result["result"])
+
+        items: List[Dict[str, Any]] = []
+        for src in sources:
+            for key in ("data", "images", "videos", "outputs"):
+                value = src.get(key)
+                if isinstance(value, list):
+                    items.extend(
+                        item if isinstance(item, dict) else {"url": item}
+                        for item in value
+                        if isinstance(item, (dict, str))
+                    )
+            if not items and (src.get("url") or src.get("b64_json")):
+                items.append(src)
+            if items:
+                break
+        return [item for item in items if item.get("url") or item.get("b64_json")]
+
+    def _decode_media_b64(self, encoded: str, part_path: str) -> Tuple[int, Optional[str]]:
+        """
+        Декодирование base64 блоками прямо в файл (без полной копии в памяти)
+
+        Пробелы и переводы строк (base64 с переносом по 76 символов) пропускаются:
+        блок декодируется только по целому числу четвёрок символов, остаток
+        переносится в следующий блок.
+
+        Returns:
+            (записано байт, MIME из data URL или None)
+        """
+        mime: Optional[str] = None
+        start = 0
+        if encoded.startswith("data:"):
+            comma = encoded.find(",")
+            mime = encoded[5:comma].split(";")[0] or None
+            start = comma + 1
+
+        written = 0
+        data_len = 0
+        padding = 0
+        carry = ""
+        with open(part_path, "wb") as fh:
+            for pos in range(start, len(encoded), self._MEDIA_CHUNK_SIZE):
+                piece = carry + "".join(encoded[pos:pos + self._MEDIA_CHUNK_SIZE].split())
+                cut = len(piece) - len(piece) % 4
+                carry = piece[cut:]
+                if not cut:
+                    continue
+                block = base64.b64decode(piece[:cut], validate=True)
+                fh.write(block)
+                written += len(block)
+                data_len += cut
+                padding = piece[cut - 2:cut].count("=")
+        if carry:
+            raise ValueError("длина base64 не кратна 4")
+
+        expected = data_len // 4 * 3 - padding
+        if written != expected:
+            raise WayGPTError(f"Размер декодированного файла {written} не совпадает с ожидаемым {expected}")
+        return written, mime
+
+    def _download_media_url(
+        self, url: str, part_path: str, resume: bool, base_url: Optional[str] = None
+    ) -> Tuple[int, Optional[str]]:
+        """
+        Потоковое скачивание по URL с докачкой частично загруженного файла
+
+        Returns:
+            (размер файла, Content-Type или None)
+        """
+        headers: Dict[str, str] = {}
+        source_url = url
+        if url.startswith("/"):
+            # Относительный URL — файл на сервере API, нужна авторизация проекта
+            headers.update(self._prepare_headers("GET", url))
+            url = f"{base_url or self.api_url}{url}"
+
+        offset = os.path.getsize(part_path) if resume and os.path.exists(part_path) else 0
+        if offset:
+            headers["Range"] = f"bytes={offset}-"
+
+        with self.session.get(url, headers=headers, timeout=self.timeout, stream=True) as response:
+            if response.status_code == 416 and offset:
+                # Файл уже скачан целиком при прошлой попытке — если сервер подтверждает
+                # размер ("bytes */<размер>"); иначе .part не от этого файла, качаем заново
+                if response.headers.get("Content-Range", "").strip() == f"bytes */{offset}":
+                    return offset, response.headers.get("Content-Type")
+                os.remove(part_path)
+                return self._download_media_url(source_url, part_path, False, base_url)
+            if response.status_code >= 400:
+                raise WayGPTError(f"Не удалось скачать {url}", status_code=response.status_code)
+
+            if response.status_code == 206:
+                self._record_stats(media_resumed=1)
+                mode = "ab"
+            else:
+                offset = 0
+                mode = "wb"
+
+            expected: Optional[int] = None
+            content_range = response.headers.get("Content-Range", "")
+            if "/" in content_range and not content_range.endswith("/*"):
+                expected = int(content_range.rsplit("/", 1)[1])
+            elif response.headers.get("Content-Length") and not response.headers.get("Content-Encoding"):
+                expected = offset + int(response.headers["Content-Length"])
+
+            with open(part_path, mode) as fh:
+                for chunk in response.iter_content(chunk_size=self._MEDIA_CHUNK_SIZE):
+                    fh.write(chunk)
+
+            size = os.path.getsize(part_path)
+            if expected is not None and size != expected:
+                # .part остаётся на диске — следующий вызов докачает файл
+                raise WayGPTError(f"Файл {url} скачан не полностью: {size} из {expected} байт")
+            return size, response.headers.get("Content-Type")
+
+    def _save_media_item(
+        self, item: Dict[str, Any], dest_dir: str, name: str, resume: bool, base_url: Optional[str] = None
+    ) -> str:
+        """Сохранение одного элемента медиа; возвращает путь к файлу"""
+        part_path = os.path.join(dest_dir, f"{name}.part")
+        url = item.get("url")
+        try:
+            if url:
+                size, mime = self._download_media_url(str(url), part_path, resume, base_url)
+                ext = os.path.splitext(str(url).split("?", 1)[0])[1]
+            else:
+                size, mime = self._decode_media_b64(str(item["b64_json"]), part_path)
+                ext = ""
+        except requests.exceptions.RequestException as e:
+            raise WayGPTError(f"Ошибка сети: {str(e)}") from e
+        except (ValueError, OSError) as e:
+            raise WayGPTError(f"Ошибка сохранения медиа: {str(e)}")
+
+        expected_size = item.get("size") or item.get("bytes")
+        if isinstance(expected_size, int) and expected_size != size:
+            raise WayGPTError(f"Размер файла {size} не совпадает с заявленным {expected_size}")
+
+        if not ext and mime:
+            ext = mimetypes.guess_extension(mime.split(";")[0].strip()) or ""
+        path = os.path.join(dest_dir, f"{name}{ext or '.bin'}")
+        os.replace(part_path, path)
+        self._record_stats(media_files_saved=1, media_bytes_saved=size)
+        return path
+
+    def save_media(
+        self,
+        result: Dict[str, Any],
+        dest_dir: str,
+        prefix: str = "media",
+        max_workers: int = 4,
+        resume: bool = True
+    ) -> List[str]:
+        """
+        Сохранение сгенерированных медиа на диск
+
+        URL скачиваются потоково через пул соединений клиента (параллельно при n>1),
+        base64 декодируется блоками прямо в файл. Пиковая память не зависит от размера файла.
+        Относительный URL скачивается с того зеркала API, которое вернуло result.
+
+        Args:
+            result: Ответ image_generations() или get_media_job()
+            dest_dir: Папка для сохранения (создаётся при необходимости)
+            prefix: Префикс имён файлов (prefix_0.png, prefix_1.png, ...)
+            max_workers: Максимум параллельных загрузок
+            resume: Докачивать частично скачанные файлы (*.part)
+
+        Returns:
+            List[str] с путями сохранённых файлов (в порядке элементов ответа)
+        """
+        items = self._extract_media_items(result)
+        if not items:
+            raise WayGPTError("В ответе нет медиа (url или b64_json)")
+
+        os.makedirs(dest_dir, exist_ok=True)
+        names = [f"{prefix}_{i}" for i in range(len(items))]
+        base_url = getattr(result, "endpoint", None)
+        if len(items) == 1:
+            return [self._save_media_item(items[0], dest_dir, names[0], resume, base_url)]
+
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(items)))) as pool:
+            futures = [
+                pool.submit(self._save_media_item, item, dest_dir, name, resume, base_url)
+                for item, name in zip(items, names)
+            ]
+            return [f.result() for f in futures]
+
+    def download_media_job(
+        self,
+        job_id: str,
+        dest_dir: str,
+        poll_interval: float = 5.0,
+        wait_timeout: Optional[float] = None,
+        **kwargs: Any
+    ) -> List[str]:
+        """
+        Ожидание завершения задачи генерации медиа и сохранение результата
+
+        Args:
+            job_id: ID задачи
+            dest_dir: Папка для сохранения
+            poll_interval: Интервал опроса статуса в секундах
+            wait_timeout: Максимальное время ожидания (None — без ограничения)
+            **kwargs: Параметры save_media (prefix, max_workers, resume)
+
+        Returns:
+            List[str] с путями сохранённых файлов
+        """
+        deadline = time.monotonic() + wait_timeout if wait_timeout is not None else None
+        kwargs.setdefault("prefix", job_id)
+        while True:
+            job = self.get_media_job(job_id)
+            status = str(job.get("status", "")).lower()
+            if status in self._MEDIA_JOB_DONE_STATUSES:
+                return self.save_media(job, dest_dir, **kwargs)
+            if status in self._MEDIA_JOB_FAILED_STATUSES:
+                raise WayGPTError(f"Задача {job_id} завершилась со статусом {status}", response=job)
+            if deadline is not None and time.monotonic() >= deadline:
+                raise WayGPTError(f"Задача {job_id} не завершилась за {wait_timeout} с", response=job)
+            time.sleep(poll_interval)
+
+    def media_journal(self, path: str, **kwargs: Any) -> "MediaJobJournal":
+        """
+        Журнал задач генерации медиа с отслеживанием после перезапуска
+
+        Args:
+            path: Файл sqlite
+            **kwargs: Параметры MediaJobJournal (dedupe_window, poll_interval, on_finish, ...)
+
+        Returns:
+            Запущенный MediaJobJournal
+        """
+        return MediaJobJournal(self, path, **kwargs).start()
+
     # ==================== Models ====================
 
     def get_models(self) -> List[str]:
@@ -436,11 +2202,63 @@ class WayGPTClient:
         """
         Получение полной информации о моделях
 
+        При подключённом shared_metadata список берётся из общего снимка хоста
+        (возвращается копия: её можно изменять).
+
         Returns:
             List[Dict] с информацией о моделях
         """
+        if self.metadata is not None:
+            return copy.deepcopy(self.metadata.models())
+        return self._fetch_models_full()
+
+    def _fetch_models_full(self) -> List[Dict[str, Any]]:
         return cast(List[Dict[str, Any]], self._make_request("GET", "/api/v1/waygpt/models/full"))
 
+    def enable_model_router(self, **kwargs: Any) -> "ModelRouter":
+        """
+        Включение клиентского выбора модели для model="auto"
+
+        Args:
+            **kwargs: Параметры ModelRouter (policy, max_cost, fallback_chain, ...)
+
+        Returns:
+            ModelRouter, подключённый к клиенту
+        """
+        self.model_router = ModelRouter(self, **kwargs)
+        return self.model_router
+
+    def enable_scheduler(self, **kwargs: Any) -> "RequestScheduler":
+        """
+        Включение очереди запросов с приоритетами и справедливым разделением по use_case
+
+        Args:
+            **kwargs: Параметры RequestScheduler (max_concurrency, reserved, use_case_priorities, weights, ...)
+
+        Returns:
+            RequestScheduler, подключённый к клиенту
+        """
+        self.scheduler = RequestScheduler(**kwargs)
+        return self.scheduler
+
+    def shared_metadata(self, path: str, **kwargs: Any) -> "SharedMetadataCache":
+        """
+        Включение общего для воркеров хоста кеша метаданных (модели, сценарии, проекты)
+
+        После подключения get_models_full(), get_use_cases(detailed=True) и
+        client_get_project() для проектов снимка (с тем же jwt_token) читают
+        снимок, а не API; ModelRouter получает метаданные через них же.
+
+        Args:
+            path: Файл снимка, общий для процессов (например, /dev/shm/waygpt-meta)
+            **kwargs: Параметры SharedMetadataCache (ttl, check_interval, jwt_token, project_ids, ...)
+
+        Returns:
+            SharedMetadataCache, подключённый к клиенту
+        """
+        self.metadata = SharedMetadataCache(self, path, **kwargs)
+        return self.metadata
+
     # ==================== Use Cases ====================
 
     def get_use_cases(self, detailed: bool = False) -> List[Dict[str, Any]]:
@@ -456,8 +2274,14 @@ class WayGPTClient:
             - name: Название сценария
             - kind: Тип сценария (chat, image_generation, video_generation, etc.)
             - config: Конфигурация сценария (system_prompt, models, parameters, и т.д.)
-            При detailed=True также может содержать id, description, created_at, updated_at
+            При detailed=True также может содержать id, description, created_at, updated_at.
+            При подключённом shared_metadata detailed=True читается из общего снимка хоста.
         """
+        if detailed and self.metadata is not None:
+            return copy.deepcopy(self.metadata.use_cases())
+        return self._fetch_use_cases(detailed)
+
+    def _fetch_use_cases(self, detailed: bool) -> List[Dict[str, Any]]:
         endpoint = "/api/v1/waygpt/use-cases"
         if detailed:
             endpoint += "?detailed=true"
@@ -485,15 +2309,69 @@ class WayGPTClient:
             data["site_domain"] = site_domain
         return cast(Dict[str, Any], self._make_request("POST", "/api/v1/widget/token", data))
 
+    def widget_token_pool(self, site_domain: Optional[str] = None, **kwargs: Any) -> "WidgetTokenPool":
+        """
+        Пул заранее выпущенных widget-токенов для домена (один на site_domain)
+
+        Args:
+            site_domain: Домен сайта (опционально)
+            **kwargs: Параметры WidgetTokenPool при первом создании (ttl_seconds, size, ...)
+
+        Returns:
+            Запущенный WidgetTokenPool
+        """
+        with self._widget_pools_lock:
+            pool = self._widget_pools.get(site_domain)
+            if pool is None:
+                pool = WidgetTokenPool(self, site_domain=site_domain, **kwargs)
+                self._widget_pools[site_domain] = pool
+        pool.start()
+        return pool
+
+    def uam_sessions(self, uam_url: Optional[str] = None, **kwargs: Any) -> "UAMSessionClient":
+        """
+        Клиент проверки сессий UAM
+
+        У него своя requests.Session: пул соединений к UAM без повторов не смешивается
+        с настройками retry этого клиента.
+
+        Args:
+            uam_url: URL UAM (по умолчанию UAM_URL или https://auth.markbase.ru)
+            **kwargs: Параметры UAMSessionClient (fresh_ttl, max_age, negative_ttl, ...)
+
+        Returns:
+            UAMSessionClient (создавайте один на процесс — кеш хранится в нём)
+        """
+        return UAMSessionClient(uam_url=uam_url, **kwargs)
+
+    def markbase_modules(self, plugins_dir: Optional[str] = None, **kwargs: Any) -> "MarkBaseModules":
+        """
+        Реестр модулей MarkBase из контрактов plugin.json на транспорте этого клиента
+
+        Args:
+            plugins_dir: Каталог PUBLIC/plugins (по умолчанию MARKBASE_PLUGINS_DIR)
+            **kwargs: Параметры MarkBaseModules (api_key, base_urls, sign_requests, timeout)
+
+        Returns:
+            MarkBaseModules (создавайте один на процесс)
+        """
+        plugins_dir = plugins_dir or os.getenv("MARKBASE_PLUGINS_DIR")
+        if not plugins_dir:
+            raise ValueError("Не указан каталог плагинов (plugins_dir или MARKBASE_PLUGINS_DIR)")
+        return MarkBaseModules.from_directory(self, plugins_dir, **kwargs)
+
     # ==================== Client API (JWT) ====================
     # Методы для управления проектами и сценариями через Client API с JWT авторизацией
 
     def _prepare_client_headers(self, jwt_token: str) -> Dict[str, str]:
         """Подготовка заголовков для Client API с JWT токеном"""
-        return {
+        headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {jwt_token}",
         }
+        if self._tracing:
+            self._inject_traceparent(headers)
+        return headers
 
     def _make_client_request(
         self,
@@ -517,7 +2395,37 @@ class WayGPTClient:
         Raises:
             WayGPTError: При ошибках API
         """
-        url = f"{self.api_url}{endpoint}"
+        if self.coalesce_requests and method == "GET":
+            key = (method, endpoint, "", hashlib.sha256(jwt_token.encode("utf-8")).hexdigest()[:16])
+            return self._coalesced(key, lambda: self._execute_client_request(method, endpoint, jwt_token, data))
+
+        return self._execute_client_request(method, endpoint, jwt_token, data)
+
+    def _execute_client_request(
+        self,
+        method: str,
+        endpoint: str,
+        jwt_token: str,
+        data: Optional[Dict[str, Any]] = None
+    ) -> Union[Dict[str, Any], List[Any]]:
+        """Отправка запроса к Client API и разбор ответа"""
+        send = lambda: self._with_endpoint(  # noqa: E731
+            lambda base_url: self._send_client_request(base_url, method, endpoint, jwt_token, data), method != "POST"
+        )
+        if not self._tracing:
+            return send()
+        return self._traced(f"WayGPT {method} {endpoint}", {"http.method": method, "http.route": endpoint}, send)
+
+    def _send_client_request(
+        self,
+        base_url: str,
+        method: str,
+        endpoint: str,
+        jwt_token: str,
+        data: Optional[Dict[str, Any]] = None
+    ) -> Union[Dict[str, Any], List[Any]]:
+        """Один запрос к Client API на конкретном адресе"""
+        url = f"{base_url}{endpoint}"
         headers = self._prepare_client_headers(jwt_token)
 
         try:
@@ -549,7 +2457,7 @@ class WayGPTClient:
             return response.json()
 
         except requests.exceptions.RequestException as e:
-            raise WayGPTError(f"Ошибка сети: {str(e)}")
+            raise WayGPTError(f"Ошибка сети: {str(e)}") from e
         except WayGPTError:
             raise
         except Exception as e:
@@ -566,8 +2474,18 @@ class WayGPTClient:
         Returns:
             Dict с токеном и информацией о сроке действия
         """
-        url = f"{self.api_url}/api/v1/auth/login/access-token"
+        send = lambda: self._with_endpoint(lambda base_url: self._send_login(base_url, email, password))  # noqa: E731
+        if not self._tracing:
+            return send()
+        endpoint = "/api/v1/auth/login/access-token"
+        return self._traced(f"WayGPT POST {endpoint}", {"http.method": "POST", "http.route": endpoint}, send)
+
+    def _send_login(self, base_url: str, email: str, password: str) -> Dict[str, Any]:
+        """Запрос авторизации на конкретном адресе"""
+        url = f"{base_url}/api/v1/auth/login/access-token"
         headers = {"Content-Type": "application/x-www-form-urlencoded"}
+        if self._tracing:
+            self._inject_traceparent(headers)
         data = {
             "username": email,
             "password": password
@@ -599,7 +2517,7 @@ class WayGPTClient:
             return result
 
         except requests.exceptions.RequestException as e:
-            raise WayGPTError(f"Ошибка сети: {str(e)}")
+            raise WayGPTError(f"Ошибка сети: {str(e)}") from e
         except WayGPTError:
             raise
         except Exception as e:
@@ -628,8 +2546,16 @@ class WayGPTClient:
             jwt_token: JWT токен для авторизации
 
         Returns:
-            Dict с информацией о проекте
+            Dict с информацией о проекте (из общего снимка, если проект в него входит
+            и jwt_token совпадает с токеном снимка — см. shared_metadata)
         """
+        if self.metadata is not None and self.metadata.covers_project(project_id, jwt_token):
+            cached = self.metadata.project(project_id)
+            if cached is not None:
+                return cast(Dict[str, Any], copy.deepcopy(cached))
+        return self._fetch_project(project_id, jwt_token)
+
+    def _fetch_project(self, project_id: str, jwt_token: str) -> Dict[str, Any]:
         return cast(Dict[str, Any], self._make_client_request("GET", f"/api/v1/client/projects/{project_id}/settings", jwt_token))
 
     def client_create_project(self, name: str, jwt_token: str) -> Dict[str, Any]:
@@ -830,3 +2756,3682 @@ class WayGPTClient:
             Dict с результатом удаления
         """
         return cast(Dict[str, Any], self._make_client_request("DELETE", f"/api/v1/client/projects/{project_id}/use-cases/{use_case_id}", jwt_token))
+
+    def client_snapshot(
+        self,
+        jwt_token: str,
+        previous: Optional["ClientSnapshot"] = None,
+        max_workers: int = 8
+    ) -> "ClientSnapshot":
+        """
+        Все проекты пользователя с настройками и сценариями
+
+        Список проектов запрашивается один раз, затем настройки и сценарии всех
+        проектов загружаются параллельно, не более max_workers запросов сразу.
+        Ошибка по одному проекту не прерывает снимок и попадает в errors.
+
+        Args:
+            jwt_token: JWT токен для авторизации
+            previous: Предыдущий снимок: проекты с неизменным updated_at берутся из него без запросов
+            max_workers: Максимум одновременных запросов
+
+        Returns:
+            ClientSnapshot
+        """
+        return self._traced(
+            "WayGPT client_snapshot",
+            {"incremental": previous is not None},
+            lambda: self._build_client_snapshot(jwt_token, previous, max_workers),
+        )
+
+    def _build_client_snapshot(
+        self,
+        jwt_token: str,
+        previous: Optional["ClientSnapshot"],
+        max_workers: int
+    ) -> "ClientSnapshot":
+        started = time.monotonic()
+        snapshot = ClientSnapshot()
+        order: List[str] = []
+        entries: Dict[str, Dict[str, Any]] = {}
+        for project in self.client_list_projects(jwt_token):
+            project_id = str(project.get("id") or project.get("project_id") or "")
+            if not project_id:
+                continue
+            order.append(project_id)
+            old = previous.projects.get(project_id) if previous is not None else None
+            updated_at = project.get("updated_at")
+            if (
+                old is not None and updated_at is not None
+                and project_id not in cast(ClientSnapshot, previous).errors
+                and old["project"].get("updated_at") == updated_at
+            ):
+                entries[project_id] = {**old, "project": project}
+                snapshot.reused.append(project_id)
+            else:
+                entries[project_id] = {"project": project}
+
+        tasks: List[Tuple[str, str, Callable[[str, str], Any]]] = [
+            (pid, field, fetch)
+            for field, fetch in (("settings", self.client_get_project), ("use_cases", self.client_list_use_cases))
+            for pid in order if pid not in snapshot.reused
+        ]
+        if tasks:
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(tasks)))) as pool:
+                # Контекст вызывающего (span трассировки, приоритет) — в каждый поток
+                futures = [
+                    (pid, field, pool.submit(contextvars.copy_context().run, fetch, pid, jwt_token))
+                    for pid, field, fetch in tasks
+                ]
+                for pid, field, future in futures:
+                    try:
+                        entries[pid][field] = future.result()
+                    except WayGPTError as e:
+                        snapshot.errors.setdefault(pid, e)
+                    except Exception as e:  # noqa: BLE001 — сбой одного проекта не прерывает снимок
+                        error = WayGPTError(f"Ошибка загрузки проекта {pid} ({field}): {e}")
+                        error.__cause__ = e
+                        snapshot.errors.setdefault(pid, error)
+
+        for pid in order:
+            if pid in snapshot.errors:
+                old = previous.projects.get(pid) if previous is not None else None
+                if old is not None:
+                    snapshot.projects[pid] = old
+            else:
+                snapshot.projects[pid] = entries[pid]
+                if pid not in snapshot.reused:
+                    snapshot.refetched.append(pid)
+        snapshot.elapsed = time.monotonic() - started
+        return snapshot
+
+
+def _abort_response(resp: requests.Response) -> None:
+    """
+    Закрытие потокового ответа, в том числе когда его читает другой поток
+
+    resp.close() не прерывает уже начатое блокирующее чтение сокета; shutdown()
+    прерывает его сразу (чтение получает конец потока).
+    """
+    sock = getattr(getattr(resp.raw, "_connection", None), "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    resp.close()
+
+
+class ChatCompletionStream:
+    """
+    Итератор чанков стрима chat completions
+
+    Запрос отправляется при первой итерации. cancel() можно вызвать из любого
+    потока: соединение закрывается сразу, итерация завершается без ошибки.
+    stop_sequences / stop_when останавливают стрим на клиенте.
+
+    stop-последовательность может прийти разрезанной между чанками, поэтому
+    конец текста, совпадающий с началом одной из них, придерживается до
+    следующего чанка (или конца стрима). Полный текст (text) собирается только
+    при stop_when — предикату он нужен целиком.
+    """
+
+    def __init__(
+        self,
+        client: WayGPTClient,
+        open_response: Callable[[], Any],
+        stop_sequences: Optional[List[str]] = None,
+        stop_when: Optional[Callable[[str], bool]] = None,
+        max_tokens: Optional[int] = None,
+        on_finish: Optional[Callable[[Optional[float], float, bool], None]] = None,
+        typed: bool = False
+    ) -> None:
+        self._client = client
+        self._open_response = open_response
+        self._stop_sequences = [seq for seq in (stop_sequences or []) if seq]
+        # Сколько символов конца текста может оказаться началом stop-последовательности
+        self._hold = max((len(seq) for seq in self._stop_sequences), default=1) - 1
+        self._stop_when = stop_when
+        self._max_tokens = max_tokens
+        self._lock = threading.Lock()
+        self._resp: Optional[requests.Response] = None
+        self._cancelled = False
+        self._finished = False
+        self._on_finish = on_finish
+        self.stop_reason: Optional[str] = None
+        self.chunks = 0
+        self.chars = 0
+        # Отданный текст (только при stop_when) и придержанный конец
+        self._parts: List[str] = []
+        self._pending = ""
+        # Время до первого чанка и общее время стрима, секунды
+        self.ttft: Optional[float] = None
+        self.duration: Optional[float] = None
+        self._span: Optional[Span] = None
+        # Типизированный режим: чанки — StreamDelta, JSON целиком не разбирается
+        self._decode: Callable[[bytes], Any] = _decode_stream_delta if typed else self._decode_chunk
+        self._gen = self._iterate()
+
+    @property
+    def text(self) -> str:
+        """Текст ответа, полученный к этому моменту (собирается только при stop_when)"""
+        return "".join(self._parts) + self._pending
+
+    def __iter__(self) -> "ChatCompletionStream":
+        return self
+
+    def __next__(self) -> Any:
+        return next(self._gen)
+
+    def __enter__(self) -> "ChatCompletionStream":
+        return self
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    def cancel(self) -> None:
+        """Немедленная остановка стрима и закрытие соединения (потокобезопасно)"""
+        with self._lock:
+            if self._finished or self._cancelled:
+                return
+            self._cancelled = True
+            resp = self._resp
+        self._stop("cancelled")
+        if resp is not None:
+            _abort_response(resp)
+
+    def close(self) -> None:
+        """Завершение стрима; соединение закрывается"""
+        self.cancel()
+        try:
+            self._gen.close()
+        except ValueError:
+            # Генератор выполняется в другом потоке — он завершится сам после cancel()
+            pass
+
+    def json_events(self, items_key: Optional[str] = None) -> Iterator["JSONEvent"]:
+        """
+        Разбор JSON из текста ответа по мере поступления
+
+        Каждый завершённый элемент массива (или поле объекта верхнего уровня)
+        отдаётся сразу после его закрывающей скобки, не дожидаясь [DONE].
+
+        Args:
+            items_key: Если ответ — объект вида {"products": [...]}, ключ массива,
+                элементы которого отдаются по одному
+
+        Yields:
+            JSONEvent(kind="item" | "field", key, value)
+        """
+        parser = IncrementalJSONParser(items_key=items_key)
+        for chunk in self:
+            content = self._delta_content(chunk)
+            if content and not parser.done:
+                yield from parser.feed(content)
+        if self.stop_reason in ("done", "stop_sequence", "stop_when"):
+            parser.close()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Метрики стрима
+
+        Returns:
+            Dict: chunks (получено чанков ≈ токенов), chars, stop_reason и
+            tokens_saved — оценка несгенерированных токенов (max_tokens - chunks) при досрочной остановке
+        """
+        return {
+            "chunks": self.chunks,
+            "chars": self.chars,
+            "stop_reason": self.stop_reason,
+            "tokens_saved": self._tokens_saved(),
+            "ttft": self.ttft,
+            "duration": self.duration,
+        }
+
+    def _tokens_saved(self) -> Optional[int]:
+        if self.stop_reason is None or self.stop_reason == "done" or not self._max_tokens:
+            return None
+        return max(0, int(self._max_tokens) - self.chunks)
+
+    def _stop(self, reason: str) -> None:
+        with self._lock:
+            if self.stop_reason is not None:
+                return
+            self.stop_reason = reason
+        if reason == "done":
+            return
+        self._client._record_stats(streams_stopped_early=1, stream_tokens_saved=self._tokens_saved() or 0)
+
+    def _match_stop_sequence(self, text: str) -> Optional[int]:
+        """Позиция самой ранней stop-последовательности в тексте"""
+        found: Optional[int] = None
+        for seq in self._stop_sequences:
+            pos = text.find(seq)
+            if pos != -1 and (found is None or pos < found):
+                found = pos
+        return found
+
+    def _held_length(self, text: str) -> int:
+        """Длина конца текста, с которого может начинаться stop-последовательность"""
+        for size in range(min(self._hold, len(text)), 0, -1):
+            tail = text[-size:]
+            if any(seq.startswith(tail) for seq in self._stop_sequences):
+                return size
+        return 0
+
+    def _emit(self, text: str) -> None:
+        self.chars += len(text)
+        if self._stop_when is not None:
+            self._parts.append(text)
+
+    def _iterate(self) -> Iterator[Any]:
+        with self._lock:
+            if self._cancelled:
+                return
+        started = time.monotonic()
+        token = None
+        if self._client._tracing:
+            # Span на весь стрим: запрос пишет в него события транспорта
+            self._span = self._client.tracer.start_span(
+                "WayGPT chat.completions stream", {"http.method": "POST", "stream": True}
+            )
+            token = _stream_span.set(self._span)
+        try:
+            resp = self._open_response()
+        except WayGPTError as e:
+            self._finish_timing(started, error=True, observed=_is_model_failure(e))
+            raise
+        finally:
+            if token is not None:
+                _stream_span.reset(token)
+        assert isinstance(resp, requests.Response)
+        with self._lock:
+            self._resp = resp
+            cancelled = self._cancelled
+        if cancelled:
+            resp.close()
+            return
+
+        error = False
+        try:
+            decode = self._decode
+            for line in self._client._iter_stream_lines(resp):
+                if not line.startswith(b"data: "):
+                    continue
+                payload = line[6:]  # Убираем "data: "
+                if payload.strip() == b"[DONE]":
+                    break
+
+                chunk = decode(payload)
+                if chunk is None:
+                    continue
+
+                self.chunks += 1
+                if self.ttft is None:
+                    self.ttft = time.monotonic() - started
+                    if self._span is not None:
+                        self._span.add_event("first_token", {"ttft_seconds": self.ttft})
+                if not (self._stop_sequences or self._stop_when):
+                    self.chars += len(self._delta_content(chunk))
+                    yield chunk
+                    continue
+                if not self._has_delta(chunk):
+                    yield chunk
+                    continue
+
+                text = self._pending + self._delta_content(chunk)
+                self._pending = ""
+                cut = self._match_stop_sequence(text) if self._stop_sequences else None
+                if cut is not None:
+                    # Отдаём текст до stop-последовательности и останавливаемся
+                    self._emit(text[:cut])
+                    self._set_delta_content(chunk, text[:cut], "stop")
+                    self._stop("stop_sequence")
+                    yield chunk
+                    return
+                if self._stop_when is not None and self._stop_when("".join(self._parts) + text):
+                    self._emit(text)
+                    self._set_delta_content(chunk, text)
+                    self._stop("stop_when")
+                    yield chunk
+                    return
+                # На последнем чанке (с finish_reason) придерживать нечего
+                held = 0 if self._finish_reason(chunk) else self._held_length(text)
+                if held:
+                    self._pending = text[-held:]
+                    text = text[:-held]
+                self._emit(text)
+                self._set_delta_content(chunk, text)
+                yield chunk
+            if self._pending:
+                text, self._pending = self._pending, ""
+                self._emit(text)
+                yield StreamDelta(text) if self._decode is _decode_stream_delta else StreamDelta(text).to_dict()
+            self._stop("done")
+        except Exception:
+            if self._cancelled:
+                return
+            error = True
+            raise
+        finally:
+            with self._lock:
+                self._finished = True
+            resp.close()
+            self._finish_timing(started, error)
+
+    def _finish_timing(self, started: float, error: bool, observed: bool = True) -> None:
+        self.duration = time.monotonic() - started
+        # observed=False — запрос отклонён (4xx): в метрики модели не попадает
+        if self._on_finish is not None and observed:
+            self._on_finish(self.ttft, self.duration, error)
+        if self._span is not None:
+            self._span.add_event("stream_end", {
+                "chunks": self.chunks,
+                "stop_reason": self.stop_reason or ("error" if error else "closed"),
+                "duration_seconds": self.duration,
+            })
+            self._span.end(error=error)
+
+    @staticmethod
+    def _decode_chunk(payload: bytes) -> Optional[Dict[str, Any]]:
+        try:
+            chunk = _json_loads(payload)
+        except ValueError:
+            return None
+        return chunk if isinstance(chunk, dict) else None
+
+    @staticmethod
+    def _delta_content(chunk: Any) -> str:
+        if isinstance(chunk, StreamDelta):
+            return chunk.content
+        try:
+            return chunk["choices"][0]["delta"].get("content") or ""
+        except (KeyError, IndexError, TypeError, AttributeError):
+            return ""
+
+    @staticmethod
+    def _has_delta(chunk: Any) -> bool:
+        if isinstance(chunk, StreamDelta):
+            return True
+        try:
+            return isinstance(chunk["choices"][0]["delta"], dict)
+        except (KeyError, IndexError, TypeError):
+            return False
+
+    @staticmethod
+    def _finish_reason(chunk: Any) -> Optional[str]:
+        if isinstance(chunk, StreamDelta):
+            return chunk.finish_reason
+        return chunk["choices"][0].get("finish_reason")
+
+    @staticmethod
+    def _set_delta_content(chunk: Any, content: str, finish_reason: Optional[str] = None) -> None:
+        if isinstance(chunk, StreamDelta):
+            chunk.content = content
+            if finish_reason is not None:
+                chunk.finish_reason = finish_reason
+            return
+        choice = chunk["choices"][0]
+        choice["delta"]["content"] = content
+        if finish_reason is not None:
+            choice["finish_reason"] = finish_reason
+
+
+class JSONEvent(NamedTuple):
+    """Событие IncrementalJSONParser"""
+
+    kind: str  # "item" — элемент массива, "field" — поле объекта верхнего уровня
+    key: Union[int, str]  # индекс элемента или имя поля
+    value: Any
+
+
+class IncrementalJSONParser:
+    """
+    Потоковый разбор JSON-массива или объекта, приходящего частями
+
+    feed() принимает очередной кусок текста (границы произвольные, в том числе
+    посреди строки или escape-последовательности) и возвращает события для
+    элементов, закрытых этим куском. Каждый символ сканируется один раз; в памяти
+    остаётся только текст текущего незавершённого элемента (для items_key — элемента
+    массива, а не всего поля). Текст до первой "[" или "{" (например, ```json) пропускается.
+
+    Пример:
+        parser = IncrementalJSONParser()
+        for piece in ('[{"id": 1}, {"i', 'd": 2}]'):
+            for event in parser.feed(piece):
+                print(event.key, event.value)
+        parser.close()
+    """
+
+    _STRUCTURAL = re.compile(r'["\[\]{},]')
+    _STRING_SPECIAL = re.compile(r'["\\]')
+    _ROOT_START = re.compile(r'[\[{]')
+
+    def __init__(self, items_key: Optional[str] = None) -> None:
+        """
+        Args:
+            items_key: Для объекта верхнего уровня — ключ массива, элементы которого
+                отдаются по одному (kind="item"), а не целым полем
+        """
+        self.items_key = items_key
+        self.done = False
+        self._depth = 0
+        self._in_string = False
+        # Предыдущий кусок закончился на "\" внутри строки: первый символ следующего экранирован
+        self._escape = False
+        self._root: Optional[str] = None
+        self._item_depth: Optional[int] = None
+        self._field_streamed = False
+        self._index = 0
+        # Текст текущего незавершённого элемента или поля: куски из прошлых feed()
+        # и начало в текущем куске (None — текст сейчас не нужен)
+        self._parts: List[str] = []
+        self._seg_start: Optional[int] = None
+
+    def feed(self, text: str) -> List[JSONEvent]:
+        """
+        Добавление куска текста
+
+        Returns:
+            List[JSONEvent] для элементов, завершённых этим куском
+        """
+        if self.done or not text:
+            return []
+        events: List[JSONEvent] = []
+        pos = 0
+        end = len(text)
+        if self._escape:
+            self._escape = False
+            pos = 1
+
+        while pos < end and not self.done:
+            if self._in_string:
+                m = self._STRING_SPECIAL.search(text, pos)
+                if m is None:
+                    pos = end
+                    break
+                if m.group() == "\\":
+                    if m.end() >= end:
+                        # Escape разорван между кусками — пропустим первый символ следующего
+                        self._escape = True
+                        pos = end
+                        break
+                    pos = m.end() + 1
+                    continue
+                self._in_string = False
+                pos = m.end()
+                continue
+
+            if self._root is None:
+                m = self._ROOT_START.search(text, pos)
+                if m is None:
+                    pos = end
+                    break
+                self._root = m.group()
+                self._depth = 1
+                pos = m.end()
+                if self._root == "[":
+                    self._item_depth = 1
+                self._start_segment(pos)
+                continue
+
+            m = self._STRUCTURAL.search(text, pos)
+            if m is None:
+                pos = end
+                break
+            char, at, pos = m.group(), m.start(), m.end()
+
+            if char == '"':
+                self._in_string = True
+            elif char in "[{":
+                self._depth += 1
+                if (
+                    char == "[" and self._depth == 2 and self._root == "{"
+                    and self.items_key is not None and self._item_depth is None
+                    and self._field_key(self._segment(text, at)) == self.items_key
+                ):
+                    # Массив items_key: дальше храним только текущий элемент, а не всё поле
+                    self._item_depth = 2
+                    self._field_streamed = True
+                    self._start_segment(pos)
+            elif char == ",":
+                if self._depth == self._item_depth:
+                    events.append(self._item(self._segment(text, at)))
+                    self._start_segment(pos)
+                elif self._depth == 1:
+                    self._emit_field(self._segment(text, at), events)
+                    self._start_segment(pos)
+            else:
+                if self._depth == self._item_depth:
+                    item = self._segment(text, at)
+                    if item.strip():
+                        events.append(self._item(item))
+                    self._item_depth = None
+                    # Остаток поля items_key (до "," или "}") не нужен
+                    self._seg_start = None
+                    self._parts = []
+                elif self._depth == 1 and self._root == "{":
+                    self._emit_field(self._segment(text, at), events)
+                if self._depth == 1:
+                    self.done = True
+                self._depth -= 1
+
+        # Сохраняем только начало незавершённого элемента; разобранный префикс отброшен
+        if self._seg_start is not None and not self.done:
+            if self._seg_start < end:
+                self._parts.append(text[self._seg_start:])
+            self._seg_start = 0
+        return events
+
+    def close(self) -> None:
+        """Проверка, что JSON завершён (вызывается после последнего куска)"""
+        if not self.done:
+            raise ValueError("JSON в ответе не завершён")
+
+    def _start_segment(self, pos: int) -> None:
+        self._parts = []
+        self._seg_start = pos
+
+    def _segment(self, text: str, at: int) -> str:
+        """Текст текущего элемента от его начала до позиции at текущего куска"""
+        if self._seg_start is None:
+            return ""
+        if self._parts:
+            return "".join(self._parts) + text[self._seg_start:at]
+        return text[self._seg_start:at]
+
+    def _item(self, text: str) -> JSONEvent:
+        event = JSONEvent("item", self._index, json.loads(text))
+        self._index += 1
+        return event
+
+    def _emit_field(self, text: str, events: List[JSONEvent]) -> None:
+        if self._field_streamed:
+            # Массив items_key уже отдан по элементам
+            self._field_streamed = False
+            return
+        if text.strip():
+            field = json.loads("{" + text + "}")
+            for key, value in field.items():
+                events.append(JSONEvent("field", key, value))
+
+    @staticmethod
+    def _field_key(text: str) -> Optional[str]:
+        """Имя поля из текста вида ' "key" : '"""
+        text = text.strip()
+        if not text.endswith(":"):
+            return None
+        try:
+            key = json.loads(text[:-1])
+        except ValueError:
+            return None
+        return key if isinstance(key, str) else None
+
+
+def _is_connect_error(error: Optional[BaseException]) -> bool:
+    """Ошибка установки соединения: запрос до сервера точно не дошёл"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError) and error.args:
+        # urllib3: MaxRetryError(reason=NewConnectionError | ConnectTimeoutError)
+        return isinstance(getattr(error.args[0], "reason", None), urllib3.exceptions.ConnectTimeoutError)
+    return False
+
+
+def _is_model_failure(error: WayGPTError) -> bool:
+    """Ошибка, которую ModelRouter засчитывает модели: сеть, таймаут или 5xx"""
+    return error.status_code is None or error.status_code >= 500
+
+
+class _ModelHealth:
+    """EWMA-метрики одной модели для ModelRouter"""
+
+    __slots__ = ("latency", "ttft", "error_rate", "samples", "last_seen")
+
+    def __init__(self) -> None:
+        self.latency: Optional[float] = None
+        self.ttft: Optional[float] = None
+        self.error_rate = 0.0
+        self.samples = 0
+        self.last_seen = 0.0
+
+
+class ModelRouter:
+    """
+    Клиентский выбор модели для model="auto"
+
+    Кандидаты — модели сценария (config.models, по priority) или все модели из
+    get_models_full(). Клиент сообщает о каждом вызове (observe), роутер ведёт
+    EWMA задержки, времени до первого токена и доли ошибок по моделям. Обычные
+    вызовы ранжируются по задержке ответа, стримы — по времени до первого токена;
+    ошибкой модели считаются только сеть, таймаут и 5xx.
+
+    Политики:
+    - "lowest_latency" — минимальная задержка с учётом ошибок (TTFT для стримов);
+    - "cost_ceiling" — то же среди моделей с ценой не выше max_cost;
+    - "fallback" — первая здоровая модель из fallback_chain (или из списка сценария).
+
+    Модели без наблюдений пробуются первыми, а каждый explore_every-й выбор
+    отдаётся давно не проверявшейся модели, чтобы метрики не устаревали.
+    """
+
+    POLICIES = ("lowest_latency", "cost_ceiling", "fallback")
+    # Поля стоимости в get_models_full(), по порядку приоритета
+    COST_FIELDS = ("price_per_1k", "price", "cost", "input_price", "prompt_price")
+
+    def __init__(
+        self,
+        client: WayGPTClient,
+        policy: str = "lowest_latency",
+        max_cost: Optional[float] = None,
+        fallback_chain: Optional[List[str]] = None,
+        max_attempts: int = 2,
+        alpha: float = 0.2,
+        error_penalty: float = 5.0,
+        unhealthy_error_rate: float = 0.5,
+        explore_every: int = 50,
+        refresh_interval: float = 300.0
+    ) -> None:
+        """
+        Args:
+            client: Клиент WayGPT (метаданные моделей и сценариев)
+            policy: Политика выбора (см. POLICIES)
+            max_cost: Потолок стоимости для policy="cost_ceiling"
+            fallback_chain: Порядок моделей для policy="fallback"
+            max_attempts: Сколько моделей пробовать при ошибке 5xx/429/сети (без стриминга)
+            alpha: Коэффициент EWMA (0..1, больше — быстрее реакция)
+            error_penalty: Штраф задержки за долю ошибок: latency * (1 + penalty * error_rate)
+            unhealthy_error_rate: Доля ошибок, выше которой модель пропускается в "fallback"
+            explore_every: Каждый N-й выбор — проверка давно не использованной модели (0 — выкл.)
+            refresh_interval: Период обновления метаданных, секунды
+        """
+        if policy not in self.POLICIES:
+            raise ValueError(f"Неизвестная политика: {policy}")
+        if policy == "cost_ceiling" and max_cost is None:
+            raise ValueError("Для policy='cost_ceiling' укажите max_cost")
+        self.client = client
+        self.policy = policy
+        self.max_cost = max_cost
+        self.fallback_chain = list(fallback_chain or [])
+        self.max_attempts = max(1, max_attempts)
+        self.alpha = alpha
+        self.error_penalty = error_penalty
+        self.unhealthy_error_rate = unhealthy_error_rate
+        self.explore_every = explore_every
+        self.refresh_interval = refresh_interval
+
+        self._lock = threading.Lock()
+        self._health: Dict[str, _ModelHealth] = {}
+        self._models: Dict[str, Dict[str, Any]] = {}
+        self._use_case_models: Dict[str, List[str]] = {}
+        self._loaded_at: Optional[float] = None
+        self._refresh_lock = threading.Lock()
+        self._decisions: Dict[Tuple[Optional[str], str], int] = {}
+        self._decision_count = 0
+
+    # ---- метаданные ----
+
+    def refresh(self) -> None:
+        """
+        Загрузка моделей (get_models_full) и списков моделей сценариев (get_use_cases)
+
+        При включённом client.shared_metadata данные берутся из общего снимка хоста.
+        """
+        models: Dict[str, Dict[str, Any]] = {}
+        for meta in self.client.get_models_full():
+            model_id = meta.get("id") or meta.get("model_id")
+            if model_id:
+                models[str(model_id)] = meta
+
+        use_case_models: Dict[str, List[str]] = {}
+        for uc in self.client.get_use_cases(detailed=True):
+            entries = ((uc.get("config") or {}).get("models") or [])
+            ordered = sorted(
+                (e for e in entries if isinstance(e, dict) and e.get("model_id")),
+                key=lambda e: e.get("priority", 0),
+            )
+            if uc.get("key") and ordered:
+                use_case_models[str(uc["key"])] = [str(e["model_id"]) for e in ordered]
+
+        with self._lock:
+            self._models = models
+            self._use_case_models = use_case_models
+            self._loaded_at = time.monotonic()
+
+    def _is_fresh(self) -> bool:
+        loaded_at = self._loaded_at
+        return loaded_at is not None and time.monotonic() - loaded_at < self.refresh_interval
+
+    def _ensure_fresh(self) -> None:
+        if self._is_fresh():
+            return
+        # Обновляет один поток. Без метаданных остальные ждут его, со старыми — не блокируются
+        if not self._refresh_lock.acquire(blocking=self._loaded_at is None):
+            return
+        try:
+            if self._is_fresh():
+                return
+            try:
+                self.refresh()
+            except WayGPTError:
+                # Нет метаданных — работаем со старыми; при первом запуске решает сервер
+                with self._lock:
+                    self._loaded_at = time.monotonic()
+        finally:
+            self._refresh_lock.release()
+
+    def _cost(self, model_id: str) -> Optional[float]:
+        meta = self._models.get(model_id) or {}
+        sources = [meta]
+        if isinstance(meta.get("pricing"), dict):
+            sources.append(meta["pricing"])
+        for src in sources:
+            for name in self.COST_FIELDS + ("input", "prompt"):
+                value = src.get(name)
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    return float(value)
+        return None
+
+    # ---- выбор ----
+
+    def candidates(self, use_case: Optional[str] = None) -> List[str]:
+        """Разрешённые модели для сценария (без учёта метрик)"""
+        self._ensure_fresh()
+        with self._lock:
+            if use_case and use_case in self._use_case_models:
+                return list(self._use_case_models[use_case])
+            return list(self._models)
+
+    def _score(self, model_id: str, stream: bool) -> float:
+        health = self._health.get(model_id)
+        if health is None or health.samples == 0:
+            return 0.0
+        base = health.ttft if stream else health.latency
+        if base is None:
+            if health.ttft is not None or health.latency is not None:
+                # Наблюдения есть, но для другого режима вызова — модель ещё не проверена
+                return 0.0
+            # Только ошибки — считаем, что модель отвечает не быстрее таймаута
+            base = float(self.client.timeout)
+        return base * (1 + self.error_penalty * health.error_rate)
+
+    def rank(self, use_case: Optional[str] = None, stream: bool = False) -> List[str]:
+        """Кандидаты в порядке предпочтения по текущей политике (stream — по времени до первого токена)"""
+        allowed = self.candidates(use_case)
+        with self._lock:
+            if self.policy == "fallback":
+                chain = [m for m in self.fallback_chain if m in allowed] if self.fallback_chain else allowed
+                healthy = [
+                    m for m in chain
+                    if m not in self._health or self._health[m].error_rate < self.unhealthy_error_rate
+                ]
+                return healthy + [m for m in chain if m not in healthy]
+
+            if self.policy == "cost_ceiling":
+                ceiling = cast(float, self.max_cost)
+                allowed = [m for m in allowed if (self._cost(m) if self._cost(m) is not None else float("inf")) <= ceiling]
+            ranked = sorted(allowed, key=lambda m: self._score(m, stream))
+
+            self._decision_count += 1
+            if self.explore_every and len(ranked) > 1 and self._decision_count % self.explore_every == 0:
+                stalest = min(ranked[1:], key=lambda m: self._health[m].last_seen if m in self._health else 0.0)
+                ranked.remove(stalest)
+                ranked.insert(0, stalest)
+            return ranked
+
+    def route(self, use_case: Optional[str] = None, stream: bool = False) -> List[str]:
+        """
+        Выбор моделей для вызова: первая — основная, остальные — запасные
+
+        Args:
+            use_case: Сценарий вызова
+            stream: Вызов стриминговый (ранжирование по времени до первого токена)
+
+        Returns:
+            List[str] длиной до max_attempts (пустой — решает сервер)
+
+        Raises:
+            WayGPTError: policy="cost_ceiling", а моделей не дороже max_cost нет
+                (или метаданные не загружены) — запрос без модели обошёл бы потолок
+        """
+        ranked = self.rank(use_case, stream)[:self.max_attempts]
+        if not ranked and self.policy == "cost_ceiling":
+            raise WayGPTError(f"Нет моделей со стоимостью не выше max_cost={self.max_cost} для сценария {use_case or '*'}")
+        if ranked:
+            with self._lock:
+                key = (use_case, ranked[0])
+                self._decisions[key] = self._decisions.get(key, 0) + 1
+            self.client._record_stats(router_decisions=1)
+        return ranked
+
+    def observe(self, model_id: str, latency: float, ttft: Optional[float] = None, error: bool = False) -> None:
+        """Учёт результата вызова модели"""
+        a = self.alpha
+        with self._lock:
+            health = self._health.setdefault(model_id, _ModelHealth())
+            health.error_rate = (1 - a) * health.error_rate + a * (1.0 if error else 0.0)
+            if not error:
+                health.latency = latency if health.latency is None else (1 - a) * health.latency + a * latency
+                if ttft is not None:
+                    health.ttft = ttft if health.ttft is None else (1 - a) * health.ttft + a * ttft
+            health.samples += 1
+            health.last_seen = time.monotonic()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Метрики роутера
+
+        Returns:
+            Dict: models — EWMA по моделям (latency, ttft, error_rate, samples, cost),
+            decisions — число выборов по (use_case, model)
+        """
+        with self._lock:
+            return {
+                "policy": self.policy,
+                "models": {
+                    model_id: {
+                        "latency": h.latency,
+                        "ttft": h.ttft,
+                        "error_rate": h.error_rate,
+                        "samples": h.samples,
+                        "cost": self._cost(model_id),
+                    }
+                    for model_id, h in self._health.items()
+                },
+                "decisions": {f"{uc or '*'}:{model}": n for (uc, model), n in self._decisions.items()},
+            }
+
+
+class WidgetTokenPool:
+    """
+    Запас заранее выпущенных widget-токенов для одного site_domain
+
+    Фоновый поток поддерживает в запасе size действующих токенов и заменяет их
+    до истечения срока. get() отдаёт токен из запаса за O(1); если запас пуст,
+    токен выпускается синхронно (промах).
+
+    Пример:
+        pool = client.widget_token_pool("shop.example.com", ttl_seconds=600)
+        token = pool.get()["token"]
+    """
+
+    def __init__(
+        self,
+        client: WayGPTClient,
+        site_domain: Optional[str] = None,
+        ttl_seconds: int = 600,
+        size: int = 4,
+        refresh_margin: float = 60.0,
+        single_use: bool = True
+    ) -> None:
+        """
+        Args:
+            client: Клиент WayGPT
+            site_domain: Домен сайта (опционально)
+            ttl_seconds: Время жизни выпускаемых токенов
+            size: Сколько токенов держать в запасе
+            refresh_margin: За сколько секунд до истечения токен считается устаревшим
+            single_use: Токен одноразовый — выдаётся один раз. Иначе один токен
+                выдаётся всем до истечения, а запас состоит из одного токена.
+        """
+        if refresh_margin >= ttl_seconds:
+            raise ValueError("refresh_margin должен быть меньше ttl_seconds")
+        self.client = client
+        self.site_domain = site_domain
+        self.ttl_seconds = ttl_seconds
+        self.size = max(1, size) if single_use else 1
+        self.refresh_margin = refresh_margin
+        self.single_use = single_use
+
+        # (время, после которого токен не выдаётся, ответ API)
+        self._stock: Deque[Tuple[float, Dict[str, Any]]] = deque()
+        self._cond = threading.Condition()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self._counters: Dict[str, float] = {
+            "hits": 0, "misses": 0, "refills": 0, "refill_errors": 0, "refill_seconds": 0.0,
+        }
+        self._last_refill_seconds = 0.0
+
+    def _mint(self) -> Tuple[float, Dict[str, Any]]:
+        """Выпуск токена через API; возвращает (срок выдачи, токен)"""
+        started = time.monotonic()
+        token = self.client.create_widget_token(ttl_seconds=self.ttl_seconds, site_domain=self.site_domain)
+        finished = time.monotonic()
+        ttl = float(token.get("expires_in") or self.ttl_seconds)
+        with self._cond:
+            self._counters["refills"] += 1
+            self._counters["refill_seconds"] += finished - started
+            self._last_refill_seconds = finished - started
+        # Срок отсчитываем от момента запроса — консервативно
+        return started + ttl - self.refresh_margin, token
+
+    def _drop_expired(self, now: float) -> None:
+        while self._stock and self._stock[0][0] <= now:
+            self._stock.popleft()
+
+    def _run(self) -> None:
+        """Фоновое пополнение запаса"""
+        backoff = 1.0
+        while True:
+            with self._cond:
+                while not self._closed:
+                    now = time.monotonic()
+                    self._drop_expired(now)
+                    if len(self._stock) < self.size:
+                        break
+                    self._cond.wait(timeout=max(0.0, self._stock[0][0] - now))
+                if self._closed:
+                    return
+            try:
+                entry = self._mint()
+            except WayGPTError:
+                with self._cond:
+                    self._counters["refill_errors"] += 1
+                    self._cond.wait(timeout=backoff)
+                backoff = min(backoff * 2, 30.0)
+                continue
+            backoff = 1.0
+            with self._cond:
+                # Токены выпускаются по порядку, поэтому очередь отсортирована по сроку
+                self._stock.append(entry)
+
+    def start(self) -> "WidgetTokenPool":
+        """Запуск фонового пополнения (повторный вызов ничего не делает)"""
+        with self._cond:
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(
+                    target=self._run, name=f"waygpt-widget-pool-{self.site_domain or 'default'}", daemon=True
+                )
+                self._thread.start()
+        return self
+
+    def close(self) -> None:
+        """Остановка фонового потока; невыданные токены отбрасываются"""
+        with self._cond:
+            self._closed = True
+            self._stock.clear()
+            self._cond.notify_all()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+
+    def __enter__(self) -> "WidgetTokenPool":
+        return self.start()
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    def get(self) -> Dict[str, Any]:
+        """
+        Получение действующего токена
+
+        Returns:
+            Dict с токеном (как create_widget_token)
+        """
+        with self._cond:
+            self._drop_expired(time.monotonic())
+            if self._stock:
+                self._counters["hits"] += 1
+                if self.single_use:
+                    token = self._stock.popleft()[1]
+                    self._cond.notify_all()
+                else:
+                    token = self._stock[0][1]
+                return token
+            self._counters["misses"] += 1
+            self._cond.notify_all()
+
+        entry = self._mint()
+        if not self.single_use:
+            with self._cond:
+                if not self._stock:
+                    self._stock.append(entry)
+        return entry[1]
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Метрики пула
+
+        Returns:
+            Dict: hits, misses, hit_rate, stock (текущий запас), refills, refill_errors,
+            refill_latency_avg и refill_latency_last (секунды)
+        """
+        with self._cond:
+            counters = dict(self._counters)
+            stock = len(self._stock)
+            last = self._last_refill_seconds
+        served = counters["hits"] + counters["misses"]
+        return {
+            "site_domain": self.site_domain,
+            "hits": int(counters["hits"]),
+            "misses": int(counters["misses"]),
+            "hit_rate": counters["hits"] / served if served else 0.0,
+            "stock": stock,
+            "refills": int(counters["refills"]),
+            "refill_errors": int(counters["refill_errors"]),
+            "refill_latency_avg": counters["refill_seconds"] / counters["refills"] if counters["refills"] else 0.0,
+            "refill_latency_last": last,
+        }
+
+
+class _UAMSession:
+    """Запись кеша сессий UAM"""
+
+    __slots__ = ("user", "validated_at", "checked_at", "invalid_until")
+
+    def __init__(self, user: Optional[Dict[str, Any]], now: float, invalid_until: float = 0.0) -> None:
+        self.user = user
+        self.validated_at = now  # последний ответ 200 от UAM
+        self.checked_at = now  # последняя попытка проверки (в том числе неудачная)
+        self.invalid_until = invalid_until  # для недействительных сессий (user=None)
+
+
+class UAMSessionClient:
+    """
+    Проверка сессий UAM (Маркбэйс id) с локальным отказоустойчивым кешем
+
+    Сессии проверяются через GET /api/uam/v1/session/validate и кешируются (LRU + TTL):
+    - свежая запись (моложе fresh_ttl) отдаётся без запроса к UAM;
+    - устаревшая отдаётся сразу, а проверка выполняется в фоне (stale-while-revalidate);
+    - недействительные сессии кешируются на negative_ttl;
+    - при недоступности UAM (сеть, 5xx, 401 not_found/expired) отдаётся запись из кеша
+      не старше max_age (режим grace); из кеша удаляет только 401 с reason=revoked.
+    Одновременные проверки одной сессии объединяются (SingleFlight). В кеше хранится
+    хеш cookie, а не сама cookie.
+
+    Пример:
+        sessions = client.uam_sessions()
+        user = sessions.validate(request.cookies.get("uam_session"))
+        if user is None:
+            return redirect(f"{sessions.uam_url}/login?return_url=...")
+    """
+
+    def __init__(
+        self,
+        uam_url: Optional[str] = None,
+        session: Optional[requests.Session] = None,
+        cookie_name: str = "uam_session",
+        fresh_ttl: float = 60.0,
+        max_age: float = 72 * 3600.0,
+        negative_ttl: float = 30.0,
+        max_entries: int = 10_000,
+        timeout: float = 3.0,
+        refresh_workers: int = 4
+    ) -> None:
+        """
+        Args:
+            uam_url: URL UAM (по умолчанию UAM_URL или https://auth.markbase.ru)
+            session: requests.Session для запросов. По умолчанию своя, с пулом
+                соединений без повторов; переданная используется как есть (не изменяется)
+            cookie_name: Имя cookie сессии
+            fresh_ttl: Сколько секунд запись считается свежей
+            max_age: Сколько секунд после последней успешной проверки запись отдаётся
+                при недоступности UAM (по умолчанию TTL сессии — 72 часа)
+            negative_ttl: Сколько секунд кешируется недействительная сессия
+            max_entries: Максимум записей в кеше (вытесняются давно не использованные)
+            timeout: Таймаут запроса к UAM
+            refresh_workers: Потоков для фоновых проверок
+        """
+        if fresh_ttl > max_age:
+            raise ValueError("fresh_ttl должен быть не больше max_age")
+        self.uam_url = (uam_url or os.getenv("UAM_URL") or "https://auth.markbase.ru").rstrip("/")
+        self.api_base = f"{self.uam_url}/api/uam/v1"
+        self._owns_session = session is None
+        if session is None:
+            session = requests.Session()
+            # Без повторов с backoff: при сбое UAM быстрее отдать сессию из кеша
+            session.mount(f"{self.uam_url}/", HTTPAdapter(max_retries=0, pool_maxsize=max(10, refresh_workers)))
+        self.session = session
+        self.cookie_name = cookie_name
+        self.fresh_ttl = fresh_ttl
+        self.max_age = max_age
+        self.negative_ttl = negative_ttl
+        self.max_entries = max(1, max_entries)
+        self.timeout = timeout
+
+        self._cache: "OrderedDict[str, _UAMSession]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._flight = SingleFlight()
+        self._refreshing: set = set()
+        self._executor = ThreadPoolExecutor(max_workers=max(1, refresh_workers), thread_name_prefix="waygpt-uam")
+        self._counters: Dict[str, float] = {
+            "hits": 0, "stale_hits": 0, "negative_hits": 0, "misses": 0, "grace_hits": 0,
+            "validations": 0, "validation_errors": 0, "validation_seconds": 0.0, "evictions": 0,
+        }
+
+    @staticmethod
+    def _key(token: str) -> str:
+        return hashlib.sha256(token.encode("utf-8")).hexdigest()[:32]
+
+    def _store(self, key: str, entry: _UAMSession) -> None:
+        """Запись в кеш с вытеснением (вызывается под _lock)"""
+        self._cache[key] = entry
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_entries:
+            self._cache.popitem(last=False)
+            self._counters["evictions"] += 1
+
+    def validate(self, token: Optional[str]) -> Optional[Dict[str, Any]]:
+        """
+        Проверка сессии
+
+        Args:
+            token: Значение cookie uam_session
+
+        Returns:
+            Пользователь (ответ session/validate) или None, если сессия недействительна
+            (или UAM недоступен и сессии нет в кеше)
+        """
+        if not token:
+            return None
+        key = self._key(token)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is not None:
+                if entry.user is None:
+                    if now < entry.invalid_until:
+                        self._cache.move_to_end(key)
+                        self._counters["negative_hits"] += 1
+                        return None
+                    entry = None
+                elif now - entry.validated_at > self.max_age:
+                    entry = None
+                if entry is None:
+                    del self._cache[key]
+            if entry is not None:
+                self._cache.move_to_end(key)
+                if now - entry.checked_at < self.fresh_ttl:
+                    self._counters["hits"] += 1
+                    return entry.user
+                self._counters["stale_hits"] += 1
+                refresh = key not in self._refreshing
+                if refresh:
+                    self._refreshing.add(key)
+                user = entry.user
+            else:
+                self._counters["misses"] += 1
+
+        if entry is None:
+            return self._refresh(key, token)
+        if refresh:
+            self._executor.submit(self._refresh_background, key, token)
+        return user
+
+    def _refresh_background(self, key: str, token: str) -> None:
+        try:
+            self._refresh(key, token)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _refresh(self, key: str, token: str) -> Optional[Dict[str, Any]]:
+        user, _ = self._flight.do(key, lambda: self._fetch(key, token))
+        return cast(Optional[Dict[str, Any]], user)
+
+    def _fetch(self, key: str, token: str) -> Optional[Dict[str, Any]]:
+        """Запрос к UAM и обновление кеша"""
+        started = time.monotonic()
+        try:
+            resp = self.session.get(
+                f"{self.api_base}/session/validate",
+                cookies={self.cookie_name: token},
+                timeout=self.timeout,
+            )
+            status = resp.status_code
+            data = resp.json() if status in (200, 401) else None
+        except (requests.exceptions.RequestException, ValueError):
+            status, data = 0, None
+        now = time.monotonic()
+
+        with self._lock:
+            self._counters["validations"] += 1
+            self._counters["validation_seconds"] += now - started
+            entry = self._cache.get(key)
+            if entry is not None and (entry.user is None or now - entry.validated_at > self.max_age):
+                entry = None
+
+            if status == 200 and isinstance(data, dict):
+                self._store(key, _UAMSession(data, now))
+                return data
+            if status == 401:
+                reason = data.get("reason") if isinstance(data, dict) else None
+                if reason == "revoked" or entry is None:
+                    self._store(key, _UAMSession(None, now, invalid_until=now + self.negative_ttl))
+                    return None
+            else:
+                self._counters["validation_errors"] += 1
+
+            # UAM недоступен или потерял сессию (wipe, рестарт) — работаем из кеша
+            if entry is None:
+                return None
+            entry.checked_at = now
+            self._counters["grace_hits"] += 1
+            return entry.user
+
+    def me(self, token: str) -> Dict[str, Any]:
+        """
+        Текущий пользователь (GET /api/uam/v1/me, без кеша)
+
+        Args:
+            token: Значение cookie uam_session
+
+        Returns:
+            Dict с данными пользователя
+        """
+        try:
+            resp = self.session.get(
+                f"{self.api_base}/me", cookies={self.cookie_name: token}, timeout=self.timeout
+            )
+        except requests.exceptions.RequestException as e:
+            raise WayGPTError(f"Ошибка соединения с UAM: {str(e)}")
+        try:
+            data = resp.json()
+        except ValueError:
+            data = {}
+        if resp.status_code >= 400:
+            message = data.get("error") if isinstance(data, dict) else None
+            raise WayGPTError(message or f"HTTP {resp.status_code}", status_code=resp.status_code, response=data)
+        return cast(Dict[str, Any], data)
+
+    def invalidate(self, token: str) -> None:
+        """Удаление сессии из кеша (например, при выходе пользователя)"""
+        with self._lock:
+            self._cache.pop(self._key(token), None)
+
+    def close(self) -> None:
+        """Остановка фоновых проверок и закрытие своей requests.Session"""
+        self._executor.shutdown(wait=False)
+        if self._owns_session:
+            self.session.close()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Метрики кеша
+
+        Returns:
+            Dict: hits, stale_hits, negative_hits, misses, hit_rate (доля ответов без
+            ожидания UAM), grace_hits, validations, validation_errors,
+            validation_latency_avg, evictions, size
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            size = len(self._cache)
+        lookups = counters["hits"] + counters["stale_hits"] + counters["negative_hits"] + counters["misses"]
+        served_from_cache = lookups - counters["misses"]
+        return {
+            "hits": int(counters["hits"]),
+            "stale_hits": int(counters["stale_hits"]),
+            "negative_hits": int(counters["negative_hits"]),
+            "misses": int(counters["misses"]),
+            "hit_rate": served_from_cache / lookups if lookups else 0.0,
+            "grace_hits": int(counters["grace_hits"]),
+            "validations": int(counters["validations"]),
+            "validation_errors": int(counters["validation_errors"]),
+            "validation_latency_avg": (
+                counters["validation_seconds"] / counters["validations"] if counters["validations"] else 0.0
+            ),
+            "evictions": int(counters["evictions"]),
+            "size": size,
+        }
+
+
+class ModuleEndpoint(NamedTuple):
+    """Эндпоинт модуля MarkBase из plugin.json"""
+
+    module: str
+    name: str
+    method: str
+    path: str  # шаблон пути без query, например /api/crm/v1/clients/:id
+    params: Tuple[str, ...]  # параметры пути по порядку
+    query: Tuple[str, ...]  # параметры query из описания (справочно)
+    description: str
+
+
+class _CompiledRoute:
+    """Эндпоинт, разобранный один раз: сегменты пути и счётчики"""
+
+    __slots__ = ("endpoint", "segments", "calls", "errors", "seconds")
+
+    _PARAM_RE = re.compile(r":([A-Za-z_][A-Za-z0-9_]*)|\{([A-Za-z_][A-Za-z0-9_]*)\}")
+    _SPEC_RE = re.compile(r"^\s*([A-Z]+)\s+(\S+)\s*(.*)$")
+
+    def __init__(self, endpoint: ModuleEndpoint, segments: List[str]) -> None:
+        self.endpoint = endpoint
+        # Чётные элементы — литералы, нечётные — имена параметров
+        self.segments = segments
+        self.calls = 0
+        self.errors = 0
+        self.seconds = 0.0
+
+    @classmethod
+    def parse(cls, module: str, name: str, spec: str) -> Optional["_CompiledRoute"]:
+        """Разбор строки вида "GET /api/crm/v1/clients/:id — описание" (None — не эндпоинт)"""
+        match = cls._SPEC_RE.match(spec)
+        if not match or not match.group(2).startswith("/"):
+            return None
+        method, target, tail = match.groups()
+        path, _, query = target.partition("?")
+        segments = cls._PARAM_RE.split(path)
+        # split с двумя группами: литерал, :param, {param}, литерал, ...
+        compiled: List[str] = [segments[0]]
+        for i in range(1, len(segments), 3):
+            compiled.append(segments[i] or segments[i + 1])
+            compiled.append(segments[i + 2])
+        endpoint = ModuleEndpoint(
+            module=module,
+            name=name,
+            method=method,
+            path=path,
+            params=tuple(compiled[1::2]),
+            query=tuple(part.split("=", 1)[0] for part in query.split("&") if part),
+            description=tail.lstrip("—- ").strip(),
+        )
+        return cls(endpoint, compiled)
+
+    def build_path(self, args: Sequence[Any], kwargs: Dict[str, Any]) -> str:
+        """Подстановка параметров пути (позиционных по порядку и именованных)"""
+        params = self.endpoint.params
+        if len(args) > len(params):
+            raise TypeError(f"{self.endpoint.module}.{self.endpoint.name}: лишние параметры пути")
+        values = dict(zip(params, args))
+        for name in params[len(args):]:
+            if name not in kwargs:
+                raise TypeError(f"{self.endpoint.module}.{self.endpoint.name}: не указан параметр пути '{name}'")
+            values[name] = kwargs.pop(name)
+        if kwargs:
+            raise TypeError(f"{self.endpoint.module}.{self.endpoint.name}: неизвестные параметры {sorted(kwargs)}")
+        if not params:
+            return self.segments[0]
+        parts = list(self.segments)
+        for i in range(1, len(parts), 2):
+            parts[i] = quote(str(values[parts[i]]), safe="")
+        return "".join(parts)
+
+
+class MarkBaseModule:
+    """
+    Клиент одного модуля MarkBase: методы эндпоинтов из plugin.json
+
+    Методы создаются по ключам endpoints: modules.crm.client_get("42").
+    Ключи, которые не являются идентификаторами Python, вызываются через call().
+    """
+
+    def __init__(self, registry: "MarkBaseModules", slug: str, contract: Dict[str, Any], base_url: str) -> None:
+        self.registry = registry
+        self.slug = slug
+        self.name: str = contract.get("name", slug)
+        self.version: Optional[str] = contract.get("version")
+        self.api_base: str = contract.get("api_base", "")
+        self.base_url = base_url
+        self._routes: Dict[str, _CompiledRoute] = {}
+        self._methods: Dict[str, Callable[..., Any]] = {}
+
+    def _add_route(self, name: str, route: _CompiledRoute) -> None:
+        self._routes[name] = route
+
+        def method(*args: Any, **kwargs: Any) -> Any:
+            return self.registry._call(self, route, args, kwargs)
+
+        method.__name__ = name
+        method.__doc__ = f"{route.endpoint.method} {route.endpoint.path}" + (
+            f" — {route.endpoint.description}" if route.endpoint.description else ""
+        )
+        self._methods[name] = method
+
+    @property
+    def endpoints(self) -> Dict[str, ModuleEndpoint]:
+        """Эндпоинты модуля по именам"""
+        return {name: route.endpoint for name, route in self._routes.items()}
+
+    def call(self, name: str, *args: Any, **kwargs: Any) -> Any:
+        """
+        Вызов эндпоинта по имени
+
+        Args:
+            name: Ключ из endpoints в plugin.json
+            *args: Параметры пути по порядку
+            **kwargs: Параметры пути по имени и params, data, headers, jwt_token, timeout
+
+        Returns:
+            Ответ модуля (JSON, текст или None для пустого ответа)
+        """
+        route = self._routes.get(name)
+        if route is None:
+            raise AttributeError(f"У модуля '{self.slug}' нет эндпоинта '{name}'")
+        return self.registry._call(self, route, args, kwargs)
+
+    def __getattr__(self, name: str) -> Callable[..., Any]:
+        methods = self.__dict__.get("_methods", {})
+        if name in methods:
+            return methods[name]
+        raise AttributeError(f"У модуля '{self.__dict__.get('slug')}' нет эндпоинта '{name}'")
+
+    def __dir__(self) -> List[str]:
+        return sorted(set(super().__dir__()) | set(self._methods))
+
+    def __repr__(self) -> str:
+        return f"<MarkBaseModule {self.slug} ({len(self._routes)} endpoints)>"
+
+
+class MarkBaseModules:
+    """
+    Реестр модулей MarkBase, собранный из контрактов plugin.json
+
+    Контракты читаются один раз; строки endpoints разбираются в таблицу маршрутов.
+    Все модули работают через пул соединений, политику повторов, HMAC-подпись
+    и счётчики WayGPTClient.
+
+    Пример:
+        modules = client.markbase_modules("PUBLIC/plugins", api_key="mk_...")
+        plans = modules.billing.plans()
+        card = modules.crm.client_get("42", jwt_token=jwt)
+        modules.wallet.call("wallet_create", data={"currency": "RUB"})
+    """
+
+    def __init__(
+        self,
+        client: WayGPTClient,
+        contracts: Iterable[Dict[str, Any]],
+        api_key: Optional[str] = None,
+        base_urls: Optional[Dict[str, str]] = None,
+        sign_requests: Optional[bool] = None,
+        timeout: Optional[float] = None
+    ) -> None:
+        """
+        Args:
+            client: Клиент WayGPT (транспорт, HMAC, счётчики)
+            contracts: Содержимое plugin.json модулей
+            api_key: Ключ модулей (заголовок X-Api-Key)
+            base_urls: Переопределение адресов модулей {slug: url} (например, внутренняя сеть)
+            sign_requests: Подписывать запросы HMAC (по умолчанию — как client.use_hmac)
+            timeout: Таймаут запросов (по умолчанию client.timeout)
+        """
+        self.client = client
+        self.api_key = api_key
+        self.sign_requests = client.use_hmac if sign_requests is None else sign_requests
+        self.timeout = timeout or client.timeout
+        self._modules: Dict[str, MarkBaseModule] = {}
+        self._lock = threading.Lock()
+        base_urls = base_urls or {}
+
+        for contract in contracts:
+            if not isinstance(contract, dict):
+                continue
+            slug = contract.get("slug")
+            endpoints = contract.get("endpoints")
+            if not slug or not contract.get("api_base") or not isinstance(endpoints, dict):
+                continue
+            api_base = urlsplit(contract["api_base"])
+            base_url = (base_urls.get(slug) or f"{api_base.scheme}://{api_base.netloc}").rstrip("/")
+            module = MarkBaseModule(self, slug, contract, base_url)
+            for name, spec in endpoints.items():
+                route = _CompiledRoute.parse(slug, name, spec) if isinstance(spec, str) else None
+                if route is not None:
+                    module._add_route(name, route)
+            self._modules[slug] = module
+
+    @classmethod
+    def from_directory(cls, client: WayGPTClient, plugins_dir: str, **kwargs: Any) -> "MarkBaseModules":
+        """
+        Реестр из каталога плагинов (<plugins_dir>/<slug>/plugin.json)
+
+        Args:
+            client: Клиент WayGPT
+            plugins_dir: Каталог PUBLIC/plugins
+            **kwargs: Параметры MarkBaseModules (api_key, base_urls, ...)
+
+        Raises:
+            ValueError: Если plugin.json не читается как JSON-объект
+        """
+        contracts = []
+        for entry in sorted(os.listdir(plugins_dir)):
+            path = os.path.join(plugins_dir, entry, "plugin.json")
+            if os.path.isfile(path):
+                try:
+                    with open(path, "r", encoding="utf-8") as f:
+                        contract = json.load(f)
+                except ValueError as e:
+                    raise ValueError(f"Некорректный {path}: {e}") from e
+                if not isinstance(contract, dict):
+                    raise ValueError(f"Некорректный {path}: ожидается JSON-объект")
+                contracts.append(contract)
+        return cls(client, contracts, **kwargs)
+
+    @property
+    def modules(self) -> Dict[str, MarkBaseModule]:
+        """Модули по slug"""
+        return dict(self._modules)
+
+    def __getitem__(self, slug: str) -> MarkBaseModule:
+        return self._modules[slug]
+
+    def __getattr__(self, slug: str) -> MarkBaseModule:
+        modules = self.__dict__.get("_modules", {})
+        if slug in modules:
+            return modules[slug]
+        raise AttributeError(f"Модуль '{slug}' не найден в реестре")
+
+    def __dir__(self) -> List[str]:
+        return sorted(set(super().__dir__()) | set(self._modules))
+
+    def _call(self, module: MarkBaseModule, route: _CompiledRoute, args: Sequence[Any], kwargs: Dict[str, Any]) -> Any:
+        """Выполнение запроса к эндпоинту модуля"""
+        params: Optional[Dict[str, Any]] = kwargs.pop("params", None)
+        data: Optional[Any] = kwargs.pop("data", None)
+        extra_headers: Optional[Dict[str, str]] = kwargs.pop("headers", None)
+        jwt_token: Optional[str] = kwargs.pop("jwt_token", None)
+        timeout: float = kwargs.pop("timeout", None) or self.timeout
+        method = route.endpoint.method
+
+        path = route.build_path(args, kwargs)
+        if params:
+            path = f"{path}?{urlencode(params, doseq=True)}"
+        body = self.client._serialize_body(data) if data is not None else None
+
+        headers: Dict[str, str] = {"Accept": "application/json"}
+        if body is not None:
+            headers["Content-Type"] = "application/json"
+        if self.api_key:
+            headers["X-Api-Key"] = self.api_key
+        if jwt_token:
+            headers["Authorization"] = f"Bearer {jwt_token}"
+        if self.sign_requests and self.client.hmac_secret:
+            timestamp = int(time.time())
+            nonce = secrets.token_hex(16)
+            headers.update({
+                "X-MB-Timestamp": str(timestamp),
+                "X-MB-Nonce": nonce,
+                "X-MB-Signature": self.client._generate_hmac_signature(method, path, body, timestamp, nonce),
+            })
+            if self.client.project_id:
+                headers["X-MB-Project"] = str(self.client.project_id)
+        if extra_headers:
+            headers.update(extra_headers)
+
+        if not self.client._tracing:
+            return self._send(module, route, path, body, headers, timeout)
+        return self.client._traced(
+            f"MarkBase {method} {module.slug}.{route.endpoint.name}",
+            {"http.method": method, "http.route": route.endpoint.path, "markbase.module": module.slug},
+            lambda: self._send(module, route, path, body, self._with_traceparent(headers), timeout),
+        )
+
+    @staticmethod
+    def _with_traceparent(headers: Dict[str, str]) -> Dict[str, str]:
+        WayGPTClient._inject_traceparent(headers)
+        return headers
+
+    def _send(
+        self,
+        module: MarkBaseModule,
+        route: _CompiledRoute,
+        path: str,
+        body: Optional[bytes],
+        headers: Dict[str, str],
+        timeout: float
+    ) -> Any:
+        """Отправка запроса к модулю и разбор ответа"""
+        method = route.endpoint.method
+        started = time.monotonic()
+        failed = True
+        try:
+            try:
+                response = self.client.session.request(
+                    method, f"{module.base_url}{path}", data=body, headers=headers, timeout=timeout
+                )
+            except requests.exceptions.RequestException as e:
+                raise WayGPTError(f"Ошибка сети ({module.slug}): {str(e)}")
+
+            if response.status_code >= 400:
+                error_data: Optional[Dict[str, Any]] = None
+                try:
+                    error_data = response.json()
+                    error_message = (
+                        error_data.get("detail") or error_data.get("message") or error_data.get("error") or "Unknown error"
+                    ) if isinstance(error_data, dict) else "Unknown error"
+                except Exception:
+                    error_message = response.text or f"HTTP {response.status_code}"
+                raise WayGPTError(message=str(error_message), status_code=response.status_code, response=error_data)
+
+            failed = False
+            if response.status_code == 204 or not response.content:
+                return None
+            if "json" in response.headers.get("Content-Type", ""):
+                return response.json()
+            return response.text
+        finally:
+            elapsed = time.monotonic() - started
+            with self._lock:
+                route.calls += 1
+                route.errors += int(failed)
+                route.seconds += elapsed
+            self.client._record_stats(module_requests=1, module_errors=int(failed))
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Метрики вызванных эндпоинтов
+
+        Returns:
+            Dict {"slug.endpoint": {"calls", "errors", "latency_avg"}}
+        """
+        result: Dict[str, Dict[str, Any]] = {}
+        with self._lock:
+            for module in self._modules.values():
+                for name, route in module._routes.items():
+                    if route.calls:
+                        result[f"{module.slug}.{name}"] = {
+                            "calls": route.calls,
+                            "errors": route.errors,
+                            "latency_avg": route.seconds / route.calls,
+                        }
+        return result
+
+
+class MediaJobJournal:
+    """
+    Журнал задач генерации медиа в sqlite, переживающий перезапуск процесса
+
+    Каждая отправка записывается до запроса к API (статус "submitting"), затем
+    сохраняется job_id. После перезапуска незавершённые задачи снова отслеживаются
+    через get_media_job, а повторная отправка тех же параметров возвращает уже
+    созданную задачу (без повторной оплаты). Файл можно разделять между процессами.
+
+    Запрос уходит с idempotency_key записи. Отказ 4xx означает, что задача не
+    создана ("failed"). После ошибки сети, таймаута или 5xx сервер мог успеть
+    создать (и оплатить) задачу, поэтому запись получает статус "unknown" и
+    сверяется по idempotency_key со списком задач API при опросе. Если API не
+    подтверждает задачу, запись остаётся "unknown" и передаётся в on_finish:
+    отправлять ли заново, решает вызывающий код.
+
+    Пример:
+        journal = client.media_journal("media_jobs.sqlite3", on_finish=handle)
+        job = journal.video_generations(prompt="Закат над морем", duration=5)
+        print(journal.stats())  # queue_depth, oldest_pending_age, ...
+    """
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS media_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            kind TEXT NOT NULL,
+            request_hash TEXT NOT NULL,
+            request TEXT NOT NULL,
+            job_id TEXT,
+            status TEXT NOT NULL,
+            response TEXT,
+            error TEXT,
+            submitted_at REAL NOT NULL,
+            updated_at REAL NOT NULL,
+            finished_at REAL,
+            idempotency_key TEXT
+        );
+        CREATE INDEX IF NOT EXISTS media_jobs_request_hash ON media_jobs (request_hash);
+        CREATE INDEX IF NOT EXISTS media_jobs_finished_at ON media_jobs (finished_at);
+    """
+    # Статусы сверяемой записи без job_id
+    _UNRESOLVED_STATUSES = ("submitting", "unknown")
+
+    def __init__(
+        self,
+        client: WayGPTClient,
+        path: str,
+        dedupe_window: Optional[float] = 24 * 3600.0,
+        poll_interval: float = 5.0,
+        submit_timeout: Optional[float] = None,
+        on_finish: Optional[Callable[[Dict[str, Any]], None]] = None
+    ) -> None:
+        """
+        Args:
+            client: Клиент WayGPT
+            path: Файл sqlite
+            dedupe_window: Сколько секунд одинаковая отправка возвращает существующую
+                задачу (None — всегда, 0 — не объединять). Неудачные задачи не объединяются.
+            poll_interval: Интервал опроса незавершённых задач фоновым потоком
+            submit_timeout: Через сколько секунд запись "submitting" без job_id считается
+                потерянной (процесс упал во время отправки); по умолчанию 2 * client.timeout
+            on_finish: Вызывается с записью журнала, когда задача завершилась
+        """
+        self.client = client
+        self.path = path
+        self.dedupe_window = dedupe_window
+        self.poll_interval = poll_interval
+        self.submit_timeout = submit_timeout if submit_timeout is not None else 2 * client.timeout
+        self.on_finish = on_finish
+
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(self._SCHEMA)
+        columns = {row["name"] for row in self._db.execute("PRAGMA table_info(media_jobs)")}
+        if "idempotency_key" not in columns:
+            # Журнал предыдущей версии
+            self._db.execute("ALTER TABLE media_jobs ADD COLUMN idempotency_key TEXT")
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self._counters: Dict[str, int] = {
+            "submitted": 0, "deduplicated": 0, "polls": 0, "poll_errors": 0, "reconciled": 0,
+            "unconfirmed": 0,
+        }
+        self._counters["resumed"] = len(self._pending())
+
+    # ---------- Отправка ----------
+
+    @staticmethod
+    def _request_hash(kind: str, data: Dict[str, Any]) -> str:
+        canonical = json.dumps([kind, data], ensure_ascii=False, sort_keys=True, separators=(",", ":"), default=str)
+        return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+    def _submit(self, kind: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        request_hash = self._request_hash(kind, data)
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                existing = None
+                if self.dedupe_window != 0:
+                    since = now - self.dedupe_window if self.dedupe_window is not None else 0.0
+                    failed = WayGPTClient._MEDIA_JOB_FAILED_STATUSES + ("lost",)
+                    existing = self._db.execute(
+                        "SELECT * FROM media_jobs WHERE request_hash = ? AND submitted_at >= ? "
+                        f"AND status NOT IN ({', '.join('?' * len(failed))}) ORDER BY id DESC LIMIT 1",
+                        (request_hash, since, *failed),
+                    ).fetchone()
+                if existing is None:
+                    idempotency_key = secrets.token_hex(16)
+                    row_id = self._db.execute(
+                        "INSERT INTO media_jobs (kind, request_hash, request, status, submitted_at, updated_at, idempotency_key) "
+                        "VALUES (?, ?, ?, 'submitting', ?, ?, ?)",
+                        (kind, request_hash, json.dumps(data, ensure_ascii=False, default=str), now, now, idempotency_key),
+                    ).lastrowid
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            if existing is not None:
+                self._counters["deduplicated"] += 1
+        if existing is not None:
+            self.client._record_stats(media_jobs_deduplicated=1)
+            return self._row_dict(existing, deduplicated=True)
+
+        endpoint = WayGPTClient._MEDIA_GENERATION_ENDPOINTS[kind]
+        try:
+            response = cast(
+                Dict[str, Any], self.client._make_request("POST", endpoint, {**data, "idempotency_key": idempotency_key})
+            )
+        except WayGPTError as e:
+            if e.status_code is not None and 400 <= e.status_code < 500:
+                # Сервер отклонил запрос — задача точно не создана
+                self._update(row_id, status="failed", error=str(e), finished=True)
+            else:
+                # Задача могла быть создана: выясняется сверкой при опросе
+                self._update(row_id, status="unknown", error=str(e))
+                self._wake.set()
+            raise
+
+        job_id = (response.get("job_id") or response.get("id")) if isinstance(response, dict) else None
+        if job_id:
+            status = str(response.get("status") or "queued").lower()
+        else:
+            status = "completed"  # синхронный ответ (например, изображения)
+        self._update(row_id, job_id=job_id, status=status, response=response, finished=self._is_final(status))
+        with self._lock:
+            self._counters["submitted"] += 1
+        self._wake.set()
+        return self._row_dict(self._get(row_id))
+
+    def video_generations(self, prompt: str, model: Optional[str] = None, duration: Optional[int] = None, **kwargs: Any) -> Dict[str, Any]:
+        """
+        Генерация видео с записью в журнал (параметры как у WayGPTClient.video_generations)
+
+        Returns:
+            Запись журнала: id, job_id, status, request, response, submitted_at, deduplicated
+        """
+        return self._submit("video", WayGPTClient._video_generation_data(prompt, model, duration, **kwargs))
+
+    def image_generations(self, prompt: str, model: Optional[str] = None, size: str = "1024x1024", n: int = 1, **kwargs: Any) -> Dict[str, Any]:
+        """
+        Генерация изображений с записью в журнал (параметры как у WayGPTClient.image_generations)
+
+        Returns:
+            Запись журнала (см. video_generations)
+        """
+        return self._submit("image", WayGPTClient._image_generation_data(prompt, model, size, n, **kwargs))
+
+    # ---------- Хранилище ----------
+
+    @staticmethod
+    def _is_final(status: str) -> bool:
+        return (
+            status in WayGPTClient._MEDIA_JOB_DONE_STATUSES
+            or status in WayGPTClient._MEDIA_JOB_FAILED_STATUSES
+            or status == "lost"
+        )
+
+    def _update(
+        self,
+        row_id: int,
+        status: str,
+        job_id: Optional[str] = None,
+        response: Optional[Dict[str, Any]] = None,
+        error: Optional[str] = None,
+        finished: bool = False
+    ) -> None:
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "UPDATE media_jobs SET status = ?, job_id = COALESCE(?, job_id), "
+                "response = COALESCE(?, response), error = COALESCE(?, error), updated_at = ?, "
+                "finished_at = CASE WHEN ? THEN ? ELSE finished_at END WHERE id = ?",
+                (
+                    status, job_id, json.dumps(response, ensure_ascii=False) if response is not None else None,
+                    error, now, finished, now, row_id,
+                ),
+            )
+
+    def _get(self, row_id: int) -> Any:
+        with self._lock:
+            return self._db.execute("SELECT * FROM media_jobs WHERE id = ?", (row_id,)).fetchone()
+
+    def _pending(self) -> List[Any]:
+        with self._lock:
+            return self._db.execute(
+                "SELECT * FROM media_jobs WHERE finished_at IS NULL ORDER BY submitted_at"
+            ).fetchall()
+
+    @staticmethod
+    def _row_dict(row: Any, deduplicated: bool = False) -> Dict[str, Any]:
+        item = dict(row)
+        item["deduplicated"] = deduplicated
+        item["request"] = json.loads(item["request"])
+        item["response"] = json.loads(item["response"]) if item["response"] else None
+        return item
+
+    def jobs(self, unfinished: bool = False, limit: int = 100) -> List[Dict[str, Any]]:
+        """
+        Записи журнала (новые первыми)
+
+        Args:
+            unfinished: Только незавершённые
+            limit: Максимум записей
+        """
+        query = "SELECT * FROM media_jobs"
+        if unfinished:
+            query += " WHERE finished_at IS NULL"
+        with self._lock:
+            rows = self._db.execute(query + " ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+        return [self._row_dict(row) for row in rows]
+
+    # ---------- Отслеживание ----------
+
+    def poll(self) -> List[Dict[str, Any]]:
+        """
+        Один проход по незавершённым задачам через get_media_job
+
+        Returns:
+            Записи задач, завершившихся в этом проходе
+        """
+        finished: List[Dict[str, Any]] = []
+        now = time.time()
+        for row in self._pending():
+            if not row["job_id"]:
+                # Ответ на отправку не получен (ошибка сети или процесс упал во время отправки).
+                # Запись "submitting" моложе submit_timeout, возможно, ещё отправляется.
+                if row["status"] == "unknown" or now - row["submitted_at"] > self.submit_timeout:
+                    entry = self._reconcile(row)
+                    if entry is not None:
+                        finished.append(entry)
+                continue
+            try:
+                job = self.client.get_media_job(row["job_id"])
+            except WayGPTError as e:
+                with self._lock:
+                    self._counters["poll_errors"] += 1
+                if e.status_code == 404:
+                    self._update(row["id"], status="lost", error=str(e), finished=True)
+                continue
+            with self._lock:
+                self._counters["polls"] += 1
+            status = str(job.get("status", "")).lower() or row["status"]
+            final = self._is_final(status)
+            self._update(row["id"], status=status, response=job, finished=final)
+            if final:
+                finished.append(self._finish(row["id"]))
+        return finished
+
+    def _finish(self, row_id: int) -> Dict[str, Any]:
+        entry = self._row_dict(self._get(row_id))
+        if self.on_finish is not None:
+            self.on_finish(entry)
+        return entry
+
+    def _find_job(self, idempotency_key: str) -> Optional[Dict[str, Any]]:
+        """
+        Задача API с этим idempotency_key
+
+        Список задач с фильтром idempotency_key и поле idempotency_key в ответе не
+        описаны в документации API. Задача засчитывается, только если API вернул
+        её с тем же ключом; элементы без ключа ничего не подтверждают.
+
+        Returns:
+            Задача или None, если API её не подтвердил
+        """
+        found = self.client._make_request("GET", f"/api/v1/waygpt/media/jobs?{urlencode({'idempotency_key': idempotency_key})}")
+        items = found if isinstance(found, list) else (found.get("data") or found.get("jobs") or []) if isinstance(found, dict) else []
+        for item in items:
+            if isinstance(item, dict) and item.get("idempotency_key") == idempotency_key:
+                return item
+        return None
+
+    def _reconcile(self, row: Any) -> Optional[Dict[str, Any]]:
+        """
+        Сверка записи без job_id со списком задач API
+
+        Returns:
+            Запись журнала, если она завершилась в результате сверки
+        """
+        key = row["idempotency_key"]
+        unavailable: Optional[str] = None
+        job: Optional[Dict[str, Any]] = None
+        if not key:
+            unavailable = "у записи нет idempotency_key"
+        else:
+            try:
+                job = self._find_job(key)
+            except WayGPTError as e:
+                with self._lock:
+                    self._counters["poll_errors"] += 1
+                if e.status_code not in (404, 405, 501):
+                    return None  # повторим при следующем опросе
+                unavailable = str(e)
+            if job is None and unavailable is None:
+                # Пустой или нефильтрованный список не доказывает, что задача не создана
+                unavailable = "API не вернул задачу с этим idempotency_key"
+        if unavailable is not None:
+            # Сверка невозможна — решение о повторной отправке остаётся за пользователем;
+            # запись "unknown" продолжает объединять повторы, чтобы не оплатить задачу дважды
+            with self._lock:
+                self._counters["unconfirmed"] += 1
+            self._update(row["id"], status="unknown", error=f"Не удалось проверить, создана ли задача: {unavailable}", finished=True)
+            return self._finish(row["id"])
+
+        assert job is not None
+        with self._lock:
+            self._counters["reconciled"] += 1
+        job_id = job.get("job_id") or job.get("id")
+        status = str(job.get("status") or "queued").lower()
+        final = self._is_final(status)
+        self._update(row["id"], status=status, job_id=str(job_id) if job_id else None, response=job, finished=final)
+        return self._finish(row["id"]) if final else None
+
+    def wait(self, row_id: int, timeout: Optional[float] = None) -> Dict[str, Any]:
+        """
+        Ожидание завершения задачи из журнала
+
+        Args:
+            row_id: id записи журнала
+            timeout: Максимальное время ожидания (None — без ограничения)
+
+        Returns:
+            Запись журнала завершённой задачи
+        """
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            row = self._get(row_id)
+            if row is None:
+                raise WayGPTError(f"Запись {row_id} не найдена в журнале")
+            if row["finished_at"] is not None:
+                return self._row_dict(row)
+            if deadline is not None and time.monotonic() >= deadline:
+                raise WayGPTError(f"Задача {row['job_id']} не завершилась за {timeout} с", response=self._row_dict(row))
+            if self._thread is None:
+                self.poll()
+            time.sleep(self.poll_interval)
+
+    def _run(self) -> None:
+        while not self._closed:
+            try:
+                self.poll()
+            except Exception:  # noqa: BLE001 — фоновый поток не должен падать
+                with self._lock:
+                    self._counters["poll_errors"] += 1
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    def start(self) -> "MediaJobJournal":
+        """Фоновое отслеживание незавершённых задач (в том числе оставшихся с прошлого запуска)"""
+        with self._lock:
+            if self._thread is None and not self._closed:
+                self._thread = threading.Thread(target=self._run, name="waygpt-media-journal", daemon=True)
+                self._thread.start()
+        return self
+
+    def close(self) -> None:
+        """Остановка отслеживания и закрытие базы (незавершённые задачи остаются в журнале)"""
+        self._closed = True
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+        with self._lock:
+            self._db.close()
+
+    def __enter__(self) -> "MediaJobJournal":
+        return self.start()
+
+    def __exit__(self, *exc: Any) -> None:
+        self.close()
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Метрики журнала
+
+        Returns:
+            Dict: queue_depth (незавершённые задачи), oldest_pending_age и
+            avg_pending_age (секунды), statuses (число записей по статусам),
+            submitted, deduplicated, resumed (незавершённые при открытии), polls, poll_errors,
+            reconciled (записи "unknown", сверенные по idempotency_key),
+            unconfirmed (записи, оставленные "unknown": API не подтвердил задачу)
+        """
+        now = time.time()
+        with self._lock:
+            depth, oldest, total_age = self._db.execute(
+                "SELECT COUNT(*), MIN(submitted_at), SUM(? - submitted_at) FROM media_jobs WHERE finished_at IS NULL",
+                (now,),
+            ).fetchone()
+            statuses = dict(self._db.execute("SELECT status, COUNT(*) FROM media_jobs GROUP BY status").fetchall())
+            counters = dict(self._counters)
+        return {
+            "queue_depth": depth,
+            "oldest_pending_age": now - oldest if oldest is not None else 0.0,
+            "avg_pending_age": total_age / depth if depth else 0.0,
+            "statuses": statuses,
+            **counters,
+        }
+
+
+class _MetadataSnapshot:
+    """Отображённый в память снимок метаданных одной версии"""
+
+    __slots__ = ("identity", "version", "generated_at", "index", "base", "buf", "decoded", "readers", "retired")
+
+    def __init__(
+        self,
+        identity: Tuple[int, int, int],
+        version: int,
+        generated_at: float,
+        index: Dict[str, List[int]],
+        base: int,
+        buf: mmap.mmap
+    ) -> None:
+        self.identity = identity
+        self.version = version
+        self.generated_at = generated_at
+        self.index = index
+        self.base = base
+        self.buf = buf
+        self.decoded: Dict[str, Any] = {}
+        # Потоки, читающие buf прямо сейчас; заменённый снимок закрывается после последнего
+        self.readers = 0
+        self.retired = False
+
+
+class SharedMetadataCache:
+    """
+    Общий для воркеров хоста кеш метаданных: модели, сценарии, настройки проектов
+
+    Снимок лежит в файле path и отображается в память (mmap) каждым процессом:
+    сырые байты хранятся в page cache один раз на хост, а секция разбирается в
+    объекты Python только при первом обращении к ней в данной версии снимка.
+    Обновляет снимок один процесс — захвативший flock на path + ".lock" (только
+    Unix; на других ОС — каждый процесс сам). Новая версия пишется во временный
+    файл и подменяется через os.replace, поэтому чтение идёт без блокировок:
+    воркеры замечают новую версию по stat() не чаще раза в check_interval.
+
+    Объекты, которые возвращают get(), models(), use_cases() и project(), общие
+    для потоков процесса — не изменяйте их. Методы клиента (get_models_full() и др.)
+    возвращают копии. Если первое обновление не удалось, чтение до retry_interval
+    повторяет его ошибку, а не возвращает пустой результат.
+    """
+
+    _MAGIC = b"WGMETA01"
+    _HEADER = struct.Struct("<8sQdQ")  # magic, версия, время создания, длина индекса
+
+    def __init__(
+        self,
+        client: WayGPTClient,
+        path: str,
+        ttl: float = 300.0,
+        check_interval: float = 1.0,
+        retry_interval: float = 30.0,
+        jwt_token: Optional[str] = None,
+        project_ids: Sequence[str] = (),
+        loaders: Optional[Dict[str, Callable[[], Any]]] = None
+    ) -> None:
+        """
+        Args:
+            client: Клиент WayGPT (загрузка метаданных)
+            path: Файл снимка, общий для процессов хоста
+            ttl: Возраст снимка, после которого он обновляется, секунды
+            check_interval: Как часто проверять появление новой версии файла, секунды
+            retry_interval: Пауза перед повтором после ошибки обновления, секунды
+            jwt_token: JWT для client_get_project (секции "project:<id>")
+            project_ids: Проекты, настройки которых входят в снимок
+            loaders: Дополнительные секции: имя → функция загрузки (результат сериализуется в JSON)
+        """
+        if project_ids and not jwt_token:
+            raise ValueError("Для project_ids укажите jwt_token")
+        self.client = client
+        self.path = path
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.retry_interval = retry_interval
+
+        # Загрузка идёт мимо кеша: методы клиента сами читают этот снимок
+        self._loaders: Dict[str, Callable[[], Any]] = {
+            "models": client._fetch_models_full,
+            "use_cases": lambda: client._fetch_use_cases(detailed=True),
+        }
+        for project_id in project_ids:
+            self._loaders[f"project:{project_id}"] = (
+                lambda pid=project_id: client._fetch_project(pid, cast(str, jwt_token))
+            )
+        self._jwt_token = jwt_token
+        self._project_ids = frozenset(project_ids)
+        self._loaders.update(loaders or {})
+
+        self._snapshot: Optional[_MetadataSnapshot] = None
+        self._checked_at = 0.0
+        self._retry_at = 0.0
+        # Ошибка последнего обновления: без снимка чтение до _retry_at повторяет её
+        self._refresh_error: Optional[WayGPTError] = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._lock_fd: Optional[int] = None
+        self._counters: Dict[str, int] = {"refreshes": 0, "refresh_errors": 0, "reloads": 0, "decodes": 0}
+
+    # ---- файл снимка ----
+
+    def _identity(self) -> Optional[Tuple[int, int, int]]:
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _map(self) -> Optional[_MetadataSnapshot]:
+        """Отображение текущего файла снимка (None — файла нет или он не в нашем формате)"""
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except FileNotFoundError:
+            return None
+        try:
+            st = os.fstat(fd)
+            if st.st_size < self._HEADER.size:
+                return None
+            buf = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        magic, version, generated_at, index_len = self._HEADER.unpack_from(buf, 0)
+        if magic != self._MAGIC:
+            buf.close()
+            return None
+        base = self._HEADER.size + index_len
+        index = _json_loads(buf[self._HEADER.size:base])
+        return _MetadataSnapshot((st.st_ino, st.st_mtime_ns, st.st_size), version, generated_at, index, base, buf)
+
+    def _reload(self) -> Optional[_MetadataSnapshot]:
+        """Переотображение файла, если его подменил другой процесс"""
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None or self._identity() != snapshot.identity:
+                mapped = self._map()
+                if mapped is not None:
+                    if snapshot is not None:
+                        self._retire(snapshot)
+                    self._snapshot = snapshot = mapped
+                    self._counters["reloads"] += 1
+            return snapshot
+
+    @staticmethod
+    def _retire(snapshot: _MetadataSnapshot) -> None:
+        """Снимок заменён: mmap закрывается сразу или после последнего читателя (под _lock)"""
+        snapshot.retired = True
+        if snapshot.readers == 0:
+            snapshot.buf.close()
+
+    def _write(self, sections: Dict[str, bytes], version: int) -> None:
+        index: Dict[str, List[int]] = {}
+        offset = 0
+        for name, blob in sections.items():
+            index[name] = [offset, len(blob)]
+            offset += len(blob)
+        index_bytes = json.dumps(index, ensure_ascii=False).encode("utf-8")
+        tmp = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp, "wb") as fh:
+                fh.write(self._HEADER.pack(self._MAGIC, version, time.time(), len(index_bytes)))
+                fh.write(index_bytes)
+                for blob in sections.values():
+                    fh.write(blob)
+            os.replace(tmp, self.path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    # ---- обновление ----
+
+    def _is_fresh(self, snapshot: Optional[_MetadataSnapshot]) -> bool:
+        return snapshot is not None and time.time() - snapshot.generated_at < self.ttl
+
+    def refresh(self, force: bool = False, wait: bool = True) -> bool:
+        """
+        Загрузка метаданных из API и запись новой версии снимка
+
+        Одновременно обновляет только один процесс хоста; остальные либо ждут
+        его (wait=True) и читают записанную им версию, либо сразу выходят.
+
+        Args:
+            force: Обновить, даже если снимок ещё свежий
+            wait: Ждать, если обновление уже идёт в другом потоке или процессе
+
+        Returns:
+            True, если новую версию записал этот процесс
+        """
+        if not self._refresh_lock.acquire(blocking=wait):
+            return False
+        try:
+            if fcntl is not None:
+                if self._lock_fd is None:
+                    self._lock_fd = os.open(self.path + ".lock", os.O_RDWR | os.O_CREAT, 0o600)
+                try:
+                    fcntl.flock(self._lock_fd, fcntl.LOCK_EX if wait else fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return False
+            try:
+                # Пока ждали блокировку, снимок мог обновить другой процесс
+                current = self._reload()
+                if not force and self._is_fresh(current):
+                    return False
+                try:
+                    sections = {
+                        name: json.dumps(load(), ensure_ascii=False).encode("utf-8")
+                        for name, load in self._loaders.items()
+                    }
+                except WayGPTError as e:
+                    with self._lock:
+                        self._counters["refresh_errors"] += 1
+                    self._refresh_error = e
+                    self._retry_at = time.monotonic() + self.retry_interval
+                    raise
+                self._refresh_error = None
+                self._write(sections, (current.version if current is not None else 0) + 1)
+                with self._lock:
+                    self._counters["refreshes"] += 1
+                self._reload()
+                return True
+            finally:
+                if self._lock_fd is not None:
+                    fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+        finally:
+            self._refresh_lock.release()
+
+    def _current(self) -> Optional[_MetadataSnapshot]:
+        """Снимок для чтения; раз в check_interval — проверка новой версии и возраста"""
+        snapshot = self._snapshot
+        now = time.monotonic()
+        if snapshot is not None and now - self._checked_at < self.check_interval:
+            return snapshot
+        self._checked_at = now
+        snapshot = self._reload()
+        if self._is_fresh(snapshot):
+            return snapshot
+        if now >= self._retry_at:
+            try:
+                # Без снимка ждём того, кто его пишет; со старым — не блокируемся
+                self.refresh(wait=snapshot is None)
+            except WayGPTError:
+                if snapshot is None:
+                    raise
+            snapshot = self._snapshot
+        error = self._refresh_error
+        if snapshot is None and error is not None:
+            # Данных нет, повтор ещё рано: пустой результат скрыл бы ошибку
+            raise WayGPTError(
+                f"Метаданные недоступны: {error.message}", status_code=error.status_code, response=error.response
+            ) from error
+        return snapshot
+
+    # ---- чтение ----
+
+    def get(self, name: str, default: Any = None) -> Any:
+        """
+        Секция снимка (разбирается из общей памяти при первом обращении к версии)
+
+        Args:
+            name: Имя секции ("models", "use_cases", "project:<id>" или из loaders)
+            default: Значение, если секции нет
+
+        Returns:
+            Объект секции или default
+        """
+        snapshot = self._current()
+        while snapshot is not None:
+            try:
+                return snapshot.decoded[name]
+            except KeyError:
+                pass
+            entry = snapshot.index.get(name)
+            if entry is None:
+                return default
+            with self._lock:
+                if snapshot.retired:
+                    # Снимок успели заменить (и, возможно, закрыть) — читаем текущий
+                    snapshot = self._snapshot
+                    continue
+                snapshot.readers += 1
+            try:
+                start = snapshot.base + entry[0]
+                raw = snapshot.buf[start:start + entry[1]]
+            finally:
+                with self._lock:
+                    snapshot.readers -= 1
+                    if snapshot.retired and snapshot.readers == 0:
+                        snapshot.buf.close()
+            value = _json_loads(raw)
+            snapshot.decoded[name] = value
+            with self._lock:
+                self._counters["decodes"] += 1
+            return value
+        return default
+
+    def models(self) -> List[Dict[str, Any]]:
+        """Модели (get_models_full) из снимка"""
+        return cast(List[Dict[str, Any]], self.get("models", []))
+
+    def use_cases(self) -> List[Dict[str, Any]]:
+        """Сценарии (get_use_cases(detailed=True)) из снимка"""
+        return cast(List[Dict[str, Any]], self.get("use_cases", []))
+
+    def project(self, project_id: str) -> Optional[Dict[str, Any]]:
+        """Настройки проекта (client_get_project) из снимка; None — проект не входит в снимок"""
+        return cast(Optional[Dict[str, Any]], self.get(f"project:{project_id}"))
+
+    def covers_project(self, project_id: str, jwt_token: str) -> bool:
+        """Входит ли проект в снимок, загруженный с этим jwt_token"""
+        return project_id in self._project_ids and jwt_token == self._jwt_token
+
+    @property
+    def version(self) -> int:
+        """Версия текущего снимка (0 — снимка ещё нет)"""
+        snapshot = self._current()
+        return snapshot.version if snapshot is not None else 0
+
+    def close(self) -> None:
+        """Освобождение mmap и файла блокировки (сам снимок остаётся для других процессов)"""
+        with self._lock:
+            snapshot, self._snapshot = self._snapshot, None
+            if snapshot is not None:
+                self._retire(snapshot)
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Состояние кеша в этом процессе
+
+        Returns:
+            Dict: version, age (возраст снимка, с), bytes (размер файла), sections,
+            decoded (разобранные в процессе секции), refreshes, refresh_errors, reloads, decodes
+        """
+        with self._lock:
+            snapshot = self._snapshot
+            counters = dict(self._counters)
+        return {
+            "version": snapshot.version if snapshot is not None else 0,
+            "age": time.time() - snapshot.generated_at if snapshot is not None else None,
+            "bytes": len(snapshot.buf) if snapshot is not None else 0,
+            "sections": sorted(snapshot.index) if snapshot is not None else [],
+            "decoded": len(snapshot.decoded) if snapshot is not None else 0,
+            **counters,
+        }
+
+
+class ClientSnapshot:
+    """
+    Снимок проектов пользователя с настройками и сценариями (см. client_snapshot)
+
+    projects — project_id → {"project": элемент списка, "settings": client_get_project,
+    "use_cases": client_list_use_cases}. Проекты, которые не удалось загрузить,
+    перечислены в errors; если они были в предыдущем снимке, в projects остаются
+    прежние данные. Исключение, отличное от WayGPTError (например, ошибка разбора
+    ответа), записывается как WayGPTError с исходным исключением в __cause__.
+    """
+
+    __slots__ = ("projects", "errors", "refetched", "reused", "elapsed")
+
+    def __init__(self) -> None:
+        self.projects: Dict[str, Dict[str, Any]] = {}
+        self.errors: Dict[str, WayGPTError] = {}
+        self.refetched: List[str] = []
+        self.reused: List[str] = []
+        self.elapsed = 0.0
+
+    @property
+    def ok(self) -> bool:
+        """Все проекты загружены без ошибок"""
+        return not self.errors
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "projects": self.projects,
+            "errors": {pid: {"message": e.message, "status_code": e.status_code} for pid, e in self.errors.items()},
+            "refetched": list(self.refetched),
+            "reused": list(self.reused),
+            "elapsed": self.elapsed,
+        }
+
+    def __repr__(self) -> str:
+        return f"ClientSnapshot(projects={len(self.projects)}, errors={len(self.errors)}, refetched={len(self.refetched)})"
+
+
+class _SchedulerTicket:
+    """Место в очереди RequestScheduler"""
+
+    __slots__ = ("priority", "use_case", "enqueued", "granted", "cancelled", "released")
+
+    def __init__(self, priority: str, use_case: str) -> None:
+        self.priority = priority
+        self.use_case = use_case
+        self.enqueued = time.monotonic()
+        self.granted = False
+        self.cancelled = False
+        self.released = False
+
+
+class _PriorityScope:
+    """Контекст with scheduler.priority(...): класс приоритета для вызовов внутри"""
+
+    def __init__(self, priority: str) -> None:
+        self._priority = priority
+        self._token: Optional[contextvars.Token] = None
+
+    def __enter__(self) -> None:
+        self._token = _request_priority.set(self._priority)
+
+    def __exit__(self, *exc: Any) -> None:
+        if self._token is not None:
+            _request_priority.reset(self._token)
+
+
+_request_priority: "contextvars.ContextVar[Optional[str]]" = contextvars.ContextVar("waygpt_priority", default=None)
+
+
+class RequestScheduler:
+    """
+    Очередь запросов клиента с приоритетами и справедливым разделением по use_case
+
+    Не больше max_concurrency запросов выполняются одновременно (стрим занимает место
+    до закрытия). Классы приоритета обслуживаются строго по порядку: ожидающий
+    интерактивный запрос обгоняет всю очередь пакетных. Для первого класса
+    зарезервировано reserved мест, которые пакетные запросы не занимают. Внутри
+    класса use_case получают места пропорционально весам (справедливая очередь
+    с виртуальным временем). Уже отправленные запросы не прерываются.
+
+    Пример:
+        scheduler = client.enable_scheduler(
+            max_concurrency=8, reserved=2,
+            use_case_priorities={"support_chat": "interactive"},
+            weights={"catalog_extract": 1, "reports": 3}
+        )
+        with scheduler.priority("interactive"):
+            client.chat_completions(messages=[...])
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 8,
+        reserved: int = 2,
+        classes: Sequence[str] = ("interactive", "batch"),
+        use_case_priorities: Optional[Dict[str, str]] = None,
+        default_priority: Optional[str] = None,
+        weights: Optional[Dict[str, float]] = None,
+        queue_timeout: Optional[float] = None
+    ) -> None:
+        """
+        Args:
+            max_concurrency: Максимум одновременных запросов клиента
+            reserved: Мест, доступных только первому (самому приоритетному) классу
+            classes: Классы приоритета, от высшего к низшему
+            use_case_priorities: Класс по ключу сценария {use_case: класс}
+            default_priority: Класс по умолчанию (по умолчанию — последний в classes)
+            weights: Веса use_case внутри класса (по умолчанию 1)
+            queue_timeout: Максимальное ожидание в очереди в секундах (None — без ограничения)
+        """
+        if not classes:
+            raise ValueError("classes не может быть пустым")
+        if not 0 <= reserved < max_concurrency:
+            raise ValueError("reserved должен быть от 0 до max_concurrency - 1")
+        self.max_concurrency = max_concurrency
+        self.reserved = reserved
+        self.classes = tuple(classes)
+        self.use_case_priorities = dict(use_case_priorities or {})
+        self.default_priority = default_priority or self.classes[-1]
+        self.weights = dict(weights or {})
+        self.queue_timeout = queue_timeout
+        for priority in (self.default_priority, *self.use_case_priorities.values()):
+            if priority not in self.classes:
+                raise ValueError(f"Неизвестный класс приоритета: {priority}")
+
+        self._cond = threading.Condition()
+        self._seq = 0
+        self._running = 0
+        self._running_by_class: Dict[str, int] = {c: 0 for c in self.classes}
+        # Очередь класса: куча (виртуальное время окончания, порядковый номер, билет)
+        self._queues: Dict[str, List[Tuple[float, int, _SchedulerTicket]]] = {c: [] for c in self.classes}
+        self._virtual_time: Dict[str, float] = {c: 0.0 for c in self.classes}
+        # Последняя метка use_case в классе; отставшие от виртуального времени удаляются
+        self._last_tag: Dict[str, Dict[str, float]] = {c: {} for c in self.classes}
+        self._waiting: Dict[str, int] = {c: 0 for c in self.classes}
+        self._waits: Dict[str, Deque[float]] = {c: deque(maxlen=1024) for c in self.classes}
+        self._counters: Dict[str, Dict[str, float]] = {
+            c: {"admitted": 0, "timeouts": 0, "wait_seconds": 0.0, "preempted": 0} for c in self.classes
+        }
+
+    def priority(self, priority: str) -> _PriorityScope:
+        """
+        Класс приоритета для вызовов клиента внутри with (важнее use_case_priorities)
+
+        Args:
+            priority: Класс из classes
+        """
+        if priority not in self.classes:
+            raise ValueError(f"Неизвестный класс приоритета: {priority}")
+        return _PriorityScope(priority)
+
+    def _resolve(self, use_case: Optional[str]) -> str:
+        priority = _request_priority.get()
+        if priority is None:
+            priority = self.use_case_priorities.get(use_case or "", self.default_priority)
+        return priority
+
+    def _can_admit(self, priority: str) -> bool:
+        if self._running >= self.max_concurrency:
+            return False
+        if priority == self.classes[0]:
+            return True
+        others = self._running - self._running_by_class[self.classes[0]]
+        return others < self.max_concurrency - self.reserved
+
+    def _dispatch(self) -> None:
+        """Выдача освободившихся мест (вызывается под _cond)"""
+        granted = False
+        for i, priority in enumerate(self.classes):
+            queue = self._queues[priority]
+            virtual_time = self._virtual_time[priority]
+            while queue and self._can_admit(priority):
+                tag, _, ticket = heapq.heappop(queue)
+                if ticket.cancelled:
+                    continue
+                ticket.granted = True
+                self._waiting[priority] -= 1
+                self._running += 1
+                self._running_by_class[priority] += 1
+                self._virtual_time[priority] = tag
+                granted = True
+                if any(self._waiting[lower] for lower in self.classes[i + 1:]):
+                    self._counters[priority]["preempted"] += 1
+            if self._virtual_time[priority] != virtual_time:
+                self._prune_tags(priority)
+            if self._waiting[priority]:
+                # Строгий приоритет: пока ждёт более важный класс, младшие не запускаются
+                break
+        if granted:
+            self._cond.notify_all()
+
+    def _prune_tags(self, priority: str) -> None:
+        """Удаление меток use_case, которые не опережают виртуальное время (вызывается под _cond)"""
+        last_tag = self._last_tag[priority]
+        virtual_time = self._virtual_time[priority]
+        for key in [key for key, tag in last_tag.items() if tag <= virtual_time]:
+            del last_tag[key]
+
+    def acquire(self, use_case: Optional[str] = None) -> _SchedulerTicket:
+        """
+        Ожидание места для запроса
+
+        Args:
+            use_case: Ключ сценария запроса
+
+        Returns:
+            Билет, который нужно вернуть через release()
+
+        Raises:
+            WayGPTError: Если место не получено за queue_timeout
+        """
+        priority = self._resolve(use_case)
+        key = use_case or ""
+        ticket = _SchedulerTicket(priority, key)
+        weight = float(self.weights.get(key, 1.0))
+        with self._cond:
+            tag = max(self._virtual_time[priority], self._last_tag[priority].get(key, 0.0)) + 1.0 / weight
+            self._last_tag[priority][key] = tag
+            self._seq += 1
+            heapq.heappush(self._queues[priority], (tag, self._seq, ticket))
+            self._waiting[priority] += 1
+            self._dispatch()
+            deadline = ticket.enqueued + self.queue_timeout if self.queue_timeout is not None else None
+            while not ticket.granted:
+                remaining = deadline - time.monotonic() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    ticket.cancelled = True
+                    self._waiting[priority] -= 1
+                    self._counters[priority]["timeouts"] += 1
+                    raise WayGPTError(
+                        f"Запрос ({priority}, {key or 'без use_case'}) не дождался очереди за {self.queue_timeout} с"
+                    )
+                self._cond.wait(timeout=remaining)
+            waited = time.monotonic() - ticket.enqueued
+            self._waits[priority].append(waited)
+            self._counters[priority]["admitted"] += 1
+            self._counters[priority]["wait_seconds"] += waited
+        return ticket
+
+    def release(self, ticket: _SchedulerTicket) -> None:
+        """Освобождение места (повторный вызов ничего не делает)"""
+        with self._cond:
+            if ticket.released or not ticket.granted:
+                return
+            ticket.released = True
+            self._running -= 1
+            self._running_by_class[ticket.priority] -= 1
+            self._dispatch()
+
+    def run(self, use_case: Optional[str], call: Callable[[], _T]) -> _T:
+        """Выполнение call() на выделенном месте"""
+        ticket = self.acquire(use_case)
+        try:
+            return call()
+        finally:
+            self.release(ticket)
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """
+        Метрики по классам приоритета
+
+        Returns:
+            Dict {класс: {queued, running, admitted, timeouts, preempted (запущено раньше
+            ожидавших запросов младших классов), wait_avg, wait_p95, wait_max}} —
+            время ожидания в секундах (p95 и max по последним 1024)
+        """
+        with self._cond:
+            result: Dict[str, Dict[str, Any]] = {}
+            for priority in self.classes:
+                counters = self._counters[priority]
+                waits = sorted(self._waits[priority])
+                admitted = int(counters["admitted"])
+                result[priority] = {
+                    "queued": self._waiting[priority],
+                    "running": self._running_by_class[priority],
+                    "admitted": admitted,
+                    "timeouts": int(counters["timeouts"]),
+                    "preempted": int(counters["preempted"]),
+                    "wait_avg": counters["wait_seconds"] / admitted if admitted else 0.0,
+                    "wait_p95": waits[min(len(waits) - 1, int(len(waits) * 0.95))] if waits else 0.0,
+                    "wait_max": waits[-1] if waits else 0.0,
+                }
+            return result
+
+
+def merge_chat_chunks(older: Any, newer: Any) -> Any:
+    """
+    Слияние двух чанков стрима chat completions в один
+
+    Текст delta.content склеивается, остальные поля берутся из более нового чанка.
+    Чанки типизированного стрима (StreamDelta) сливаются так же. Исходные чанки
+    не изменяются. Используется политикой backpressure="coalesce" в StreamMulticast.
+    """
+    if isinstance(older, StreamDelta) and isinstance(newer, StreamDelta):
+        return StreamDelta(older.content + newer.content, newer.finish_reason or older.finish_reason)
+    try:
+        old_choice = older["choices"][0]
+        new_choice = newer["choices"][0]
+    except (KeyError, IndexError, TypeError):
+        return newer
+    merged_delta = dict(new_choice.get("delta") or {})
+    merged_delta["content"] = ((old_choice.get("delta") or {}).get("content") or "") + (merged_delta.get("content") or "")
+    merged_choice = dict(new_choice)
+    merged_choice["delta"] = merged_delta
+    merged = dict(newer)
+    merged["choices"] = [merged_choice] + list(newer["choices"][1:])
+    return merged
+
+
+class StreamSubscription:
+    """
+    Подписка на StreamMulticast
+
+    Итерируется синхронно (for chunk in sub) и асинхронно (async for chunk in sub).
+    """
+
+    def __init__(self, multicast: "StreamMulticast", maxsize: int) -> None:
+        self._multicast = multicast
+        self._maxsize = maxsize
+        self._queue: Deque[Dict[str, Any]] = deque()
+        self._cond = threading.Condition()
+        self._async_waiter: Optional[Tuple[asyncio.AbstractEventLoop, "asyncio.Future[None]"]] = None
+        self._finished = False
+        self._error: Optional[BaseException] = None
+        # Пропущенные начальные чанки (не поместились в буфер повтора)
+        self.missed_prefix = False
+        self.dropped = False
+        self.coalesced = 0
+        self.discarded = 0
+
+    def _wake(self) -> None:
+        """Пробуждение ожидающих (вызывается под self._cond)"""
+        self._cond.notify_all()
+        if self._async_waiter is not None:
+            loop, fut = self._async_waiter
+            self._async_waiter = None
+            try:
+                loop.call_soon_threadsafe(lambda: fut.done() or fut.set_result(None))
+            except RuntimeError:
+                # Event loop подписчика уже закрыт — читать некому, подписчик отключается
+                self.dropped = True
+                self._finished = True
+                self._queue.clear()
+
+    def _offer(self, chunk: Dict[str, Any], policy: str, merge: Callable[[Dict[str, Any], Dict[str, Any]], Dict[str, Any]]) -> None:
+        """Неблокирующая доставка чанка (из потока чтения upstream)"""
+        with self._cond:
+            if self._finished:
+                return
+            if len(self._queue) >= self._maxsize:
+                if policy == "disconnect":
+                    self.dropped = True
+                    self._queue.clear()
+                    self._finish(WayGPTError("Подписчик отключён: не успевает читать поток"))
+                    return
+                if policy == "coalesce":
+                    self._queue[-1] = merge(self._queue[-1], chunk)
+                    self.coalesced += 1
+                    self._wake()
+                    return
+                self._queue.popleft()
+                self.discarded += 1
+            self._queue.append(chunk)
+            self._wake()
+
+    def _finish(self, error: Optional[BaseException] = None) -> None:
+        with self._cond:
+            if not self._finished:
+                self._finished = True
+                self._error = error
+            self._wake()
+
+    def _take(self) -> Optional[Dict[str, Any]]:
+        """Следующий чанк или None, если ждать нечего (под self._cond)"""
+        if self._queue:
+            return self._queue.popleft()
+        if self._finished:
+            if self._error is not None:
+                raise self._error
+            raise StopIteration
+        return None
+
+    def __iter__(self) -> "StreamSubscription":
+        return self
+
+    def __next__(self) -> Dict[str, Any]:
+        with self._cond:
+            while True:
+                chunk = self._take()
+                if chunk is not None:
+                    return chunk
+                self._cond.wait()
+
+    def __aiter__(self) -> "StreamSubscription":
+        return self
+
+    async def __anext__(self) -> Dict[str, Any]:
+        while True:
+            with self._cond:
+                try:
+                    chunk = self._take()
+                except StopIteration:
+                    raise StopAsyncIteration
+                if chunk is not None:
+                    return chunk
+                loop = asyncio.get_running_loop()
+                fut: "asyncio.Future[None]" = loop.create_future()
+                self._async_waiter = (loop, fut)
+            await fut
+
+    def close(self) -> None:
+        """Отписка"""
+        self._multicast._unsubscribe(self)
+        self._finish()
+        with self._cond:
+            self._queue.clear()
+
+
+class StreamMulticast:
+    """
+    Раздача одного стрима (например, chat_completions_stream) многим подписчикам
+
+    Upstream читается в отдельном потоке и никогда не ждёт подписчиков: у каждого
+    своя ограниченная очередь, а при её переполнении действует политика backpressure:
+    - "coalesce" — новый чанк сливается с последним в очереди (merge_chat_chunks);
+    - "drop_oldest" — самый старый чанк в очереди отбрасывается;
+    - "disconnect" — подписчик отключается с WayGPTError.
+
+    Поздно подключившиеся получают последние replay_size чанков. Подписчик,
+    чей event loop закрылся во время ожидания, отключается.
+
+    Чанки общие для всех подписчиков (не копируются) — изменять их нельзя;
+    слияние при "coalesce" создаёт новый чанк.
+
+    Пример:
+        mc = client.chat_completions_multicast(messages=[...])
+        for chunk in mc.subscribe():          # или: async for chunk in mc.subscribe()
+            ...
+    """
+
+    BACKPRESSURE_POLICIES = ("coalesce", "drop_oldest", "disconnect")
+
+    def __init__(
+        self,
+        source: Iterator[Dict[str, Any]],
+        replay_size: int = 256,
+        subscriber_buffer: int = 1024,
+        backpressure: str = "coalesce",
+        merge: Callable[[Dict[str, Any], Dict[str, Any]], Dict[str, Any]] = merge_chat_chunks
+    ) -> None:
+        """
+        Args:
+            source: Итератор чанков upstream
+            replay_size: Размер кольцевого буфера для поздно подключившихся
+            subscriber_buffer: Размер очереди одного подписчика
+            backpressure: Политика для медленных подписчиков (см. BACKPRESSURE_POLICIES)
+            merge: Функция слияния чанков для политики "coalesce"
+        """
+        if backpressure not in self.BACKPRESSURE_POLICIES:
+            raise ValueError(f"Неизвестная политика backpressure: {backpressure}")
+        self._source = source
+        self._replay: Deque[Dict[str, Any]] = deque(maxlen=max(0, replay_size))
+        self._subscriber_buffer = max(1, subscriber_buffer)
+        self._policy = backpressure
+        self._merge = merge
+        self._lock = threading.Lock()
+        self._subscribers: List[StreamSubscription] = []
+        self._thread: Optional[threading.Thread] = None
+        self._closed = False
+        self._finished = False
+        self._error: Optional[BaseException] = None
+        self._chunks = 0
+        self._dropped_subscribers = 0
+
+    def start(self) -> "StreamMulticast":
+        """Запуск чтения upstream (повторный вызов ничего не делает)"""
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._pump, name="waygpt-stream-multicast", daemon=True)
+                self._thread.start()
+        return self
+
+    def _pump(self) -> None:
+        error: Optional[BaseException] = None
+        try:
+            for chunk in self._source:
+                with self._lock:
+                    if self._closed:
+                        break
+                    self._chunks += 1
+                    self._replay.append(chunk)
+                    subscribers = list(self._subscribers)
+                for sub in subscribers:
+                    sub._offer(chunk, self._policy, self._merge)
+                    if sub.dropped:
+                        self._unsubscribe(sub)
+                        with self._lock:
+                            self._dropped_subscribers += 1
+        except Exception as e:
+            error = e
+        finally:
+            close = getattr(self._source, "close", None)
+            if close is not None:
+                close()
+            with self._lock:
+                self._finished = True
+                self._error = error
+                subscribers = list(self._subscribers)
+            for sub in subscribers:
+                sub._finish(error)
+
+    def subscribe(self, replay: bool = True) -> StreamSubscription:
+        """
+        Новый подписчик
+
+        Args:
+            replay: Получить уже прошедшие чанки из буфера повтора
+
+        Returns:
+            StreamSubscription (итерируется sync и async)
+        """
+        sub = StreamSubscription(self, self._subscriber_buffer)
+        with self._lock:
+            if replay:
+                sub.missed_prefix = self._chunks > len(self._replay)
+                for chunk in self._replay:
+                    sub._offer(chunk, self._policy, self._merge)
+            if self._finished:
+                sub._finish(self._error)
+            else:
+                self._subscribers.append(sub)
+        self.start()
+        return sub
+
+    def _unsubscribe(self, sub: StreamSubscription) -> None:
+        with self._lock:
+            if sub in self._subscribers:
+                self._subscribers.remove(sub)
+
+    def close(self) -> None:
+        """Остановка чтения upstream и завершение всех подписок"""
+        with self._lock:
+            self._closed = True
+            subscribers = list(self._subscribers)
+        # ChatCompletionStream закрывает соединение сразу, не дожидаясь следующего чанка
+        cancel = getattr(self._source, "cancel", None)
+        if cancel is not None:
+            cancel()
+        for sub in subscribers:
+            sub._finish()
+
+    def stats(self) -> Dict[str, Any]:
+        """Метрики: chunks, subscribers, dropped_subscribers, coalesced, discarded, finished"""
+        with self._lock:
+            subscribers = list(self._subscribers)
+            return {
+                "chunks": self._chunks,
+                "subscribers": len(subscribers),
+                "dropped_subscribers": self._dropped_subscribers,
+                "coalesced": sum(sub.coalesced for sub in subscribers),
+                "discarded": sum(sub.discarded for sub in subscribers),
+                "finished": self._finished,
+            }
+
+
+class ProxyRequestPolicy:
+    """
+    Allowlist тела запроса браузера для WSGIStreamProxy / ASGIStreamProxy
+
+    Прокси подписывает запрос ключом проекта, поэтому без проверки браузер мог бы
+    выбрать любую модель, сценарий, системный промпт и max_tokens за счёт проекта.
+    Политика пропускает только перечисленные поля, ограничивает max_tokens,
+    фиксирует use_case и допускает только разрешённые модели и роли сообщений.
+    Число сообщений, их длина и content parts (число и типы) тоже ограничены.
+    Используется прокси по умолчанию (если prepare_request не задан).
+
+    Пример:
+        ASGIStreamProxy(client, prepare_request=ProxyRequestPolicy(use_case="support_chat", max_tokens=512))
+    """
+
+    FIELDS = ("messages", "model", "max_tokens", "temperature", "top_p", "stop")
+
+    def __init__(
+        self,
+        use_case: Optional[str] = None,
+        models: Sequence[str] = (),
+        max_tokens: int = 1024,
+        roles: Sequence[str] = ("user", "assistant"),
+        fields: Sequence[str] = FIELDS,
+        max_messages: int = 50,
+        max_message_chars: int = 8000,
+        max_parts: int = 8,
+        part_types: Sequence[str] = ("text",)
+    ) -> None:
+        """
+        Args:
+            use_case: Сценарий, который подставляется в каждый запрос (браузер его не выбирает)
+            models: Модели, которые браузер может указать; пусто — только "auto"
+            max_tokens: Потолок max_tokens (подставляется, если браузер не указал или указал больше)
+            roles: Допустимые роли сообщений (по умолчанию без "system")
+            fields: Поля тела запроса, которые передаются upstream; остальные отбрасываются
+            max_messages: Максимум сообщений в запросе
+            max_message_chars: Максимум символов текста в одном сообщении (строка или сумма text-частей)
+            max_parts: Максимум content parts в одном сообщении
+            part_types: Допустимые типы content parts (по умолчанию только "text";
+                например, ("text", "image_url"), чтобы разрешить картинки)
+        """
+        self.use_case = use_case
+        self.models = frozenset(models)
+        self.max_tokens = max_tokens
+        self.roles = frozenset(roles)
+        self.fields = tuple(fields)
+        self.max_messages = max_messages
+        self.max_message_chars = max_message_chars
+        self.max_parts = max_parts
+        self.part_types = frozenset(part_types)
+
+    def __call__(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        data = {name: body[name] for name in self.fields if name in body}
+
+        messages = data.get("messages")
+        if not isinstance(messages, list) or not messages:
+            raise WayGPTError("Поле messages должно быть непустым списком", status_code=400)
+        if len(messages) > self.max_messages:
+            raise WayGPTError(f"Больше {self.max_messages} сообщений в запросе", status_code=413)
+        for message in messages:
+            if not isinstance(message, dict) or message.get("role") not in self.roles:
+                raise WayGPTError("Недопустимая роль сообщения", status_code=403)
+            self._check_content(message.get("content"))
+
+        model = data.get("model", "auto")
+        if model != "auto" and model not in self.models:
+            raise WayGPTError(f"Модель {model} недоступна", status_code=403)
+        data["model"] = model
+
+        requested = data.get("max_tokens")
+        if not isinstance(requested, int) or isinstance(requested, bool) or not 0 < requested <= self.max_tokens:
+            data["max_tokens"] = self.max_tokens
+
+        if self.use_case is not None:
+            data["use_case"] = self.use_case
+        return data
+
+    def _check_content(self, content: Any) -> None:
+        """Проверка content сообщения: строка или список разрешённых content parts"""
+        if isinstance(content, str):
+            chars = len(content)
+        elif isinstance(content, list):
+            if len(content) > self.max_parts:
+                raise WayGPTError(f"Больше {self.max_parts} частей в сообщении", status_code=413)
+            chars = 0
+            for part in content:
+                if not isinstance(part, dict):
+                    raise WayGPTError("Часть сообщения должна быть объектом", status_code=400)
+                if part.get("type") not in self.part_types:
+                    raise WayGPTError(f"Недопустимый тип части сообщения: {part.get('type')}", status_code=403)
+                if part["type"] == "text":
+                    if not isinstance(part.get("text"), str):
+                        raise WayGPTError("Поле text должно быть строкой", status_code=400)
+                    chars += len(part["text"])
+        else:
+            raise WayGPTError("Поле content должно быть строкой или списком частей", status_code=400)
+        if chars > self.max_message_chars:
+            raise WayGPTError(f"Сообщение длиннее {self.max_message_chars} символов", status_code=413)
+
+
+class _StreamProxyBase:
+    """Общая часть WSGI/ASGI прокси стрима chat completions"""
+
+    # Заголовки ответа браузеру: без кеширования и буферизации на nginx
+    RESPONSE_HEADERS = [
+        ("Cache-Control", "no-cache"),
+        ("X-Accel-Buffering", "no"),
+    ]
+
+    def __init__(
+        self,
+        client: WayGPTClient,
+        endpoint: str = "/api/v1/waygpt/chat/completions",
+        prepare_request: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None,
+        taps: Sequence[Callable[[bytes], Optional[bytes]]] = (),
+        max_body_bytes: int = 256 * 1024
+    ) -> None:
+        """
+        Args:
+            client: Клиент WayGPT (ключ проекта остаётся на сервере)
+            endpoint: Endpoint upstream
+            prepare_request: Хук для тела запроса браузера; возвращает тело для upstream или
+                бросает WayGPTError, чтобы отклонить запрос. По умолчанию — ProxyRequestPolicy()
+                (только messages/model/max_tokens/..., модель "auto", max_tokens <= 1024).
+                Свой хук отвечает за то же: всё, что он пропустит, оплачивает проект
+            taps: Хуки для байтов ответа (метрики, фильтрация). Получают блок байтов
+                (границы не совпадают с SSE-событиями), возвращают блок или None, чтобы его пропустить
+            max_body_bytes: Максимальный размер тела запроса браузера; больше — ответ 413
+                без чтения остатка тела
+        """
+        self.client = client
+        self.endpoint = endpoint
+        self.prepare_request = prepare_request if prepare_request is not None else ProxyRequestPolicy()
+        self.taps = list(taps)
+        self.max_body_bytes = max_body_bytes
+
+    def _check_body_size(self, size: int) -> None:
+        if size > self.max_body_bytes:
+            raise WayGPTError(f"Тело запроса больше {self.max_body_bytes} байт", status_code=413)
+
+    def _declared_length(self, value: Optional[str]) -> Optional[int]:
+        """Content-Length запроса (проверенный по max_body_bytes) или None"""
+        if not value:
+            return None
+        try:
+            length = int(value)
+        except ValueError:
+            raise WayGPTError("Некорректный Content-Length", status_code=400)
+        self._check_body_size(length)
+        return length
+
+    def _open_upstream(self, body: bytes) -> requests.Response:
+        """Подписанный запрос к upstream; возвращает открытый потоковый ответ"""
+        try:
+            data = json.loads(body or b"{}")
+        except ValueError:
+            raise WayGPTError("Некорректный JSON в теле запроса", status_code=400)
+        if not isinstance(data, dict):
+            raise WayGPTError("Тело запроса должно быть JSON-объектом", status_code=400)
+        data = self.prepare_request(data)
+        data["stream"] = True
+        resp = self.client._make_request("POST", self.endpoint, data, stream=True)
+        assert isinstance(resp, requests.Response)
+        self.client._record_stats(proxy_streams=1)
+        return resp
+
+    def _iter_upstream(self, resp: requests.Response) -> Iterator[bytes]:
+        """Байты upstream как есть (после taps), без разбора SSE"""
+        for chunk in resp.iter_content(chunk_size=self.client._STREAM_CHUNK_SIZE):
+            for tap in self.taps:
+                if chunk is None:
+                    break
+                chunk = tap(chunk)
+            if chunk:
+                self.client._record_stats(proxy_bytes=len(chunk))
+                yield chunk
+
+    @staticmethod
+    def _error_body(error: WayGPTError) -> Tuple[int, bytes]:
+        status = error.status_code if error.status_code and error.status_code >= 400 else 502
+        payload = error.response if isinstance(error.response, dict) else {"detail": error.message}
+        return status, json.dumps(payload, ensure_ascii=False).encode("utf-8")
+
+    @staticmethod
+    def _status_line(status: int) -> str:
+        try:
+            return f"{status} {http.HTTPStatus(status).phrase}"
+        except ValueError:
+            return str(status)
+
+
+class WSGIStreamProxy(_StreamProxyBase):
+    """
+    WSGI-приложение: проксирует стрим chat completions браузеру без разбора SSE
+
+    Тело запроса браузера подписывается клиентом (project key, HMAC) и уходит
+    upstream; байты ответа передаются как есть. Когда браузер отключается,
+    WSGI-сервер вызывает close() у ответа — upstream-соединение закрывается сразу.
+
+    Пример (Flask / werkzeug):
+        app.wsgi_app = DispatcherMiddleware(app.wsgi_app, {"/ai/stream": WSGIStreamProxy(client)})
+    """
+
+    def __call__(self, environ: Dict[str, Any], start_response: Callable[..., Any]) -> Iterable[bytes]:
+        if environ.get("REQUEST_METHOD") != "POST":
+            start_response(self._status_line(405), [("Allow", "POST"), ("Content-Type", "application/json")])
+            return [b'{"detail": "Method Not Allowed"}']
+
+        try:
+            resp = self._open_upstream(self._read_body(environ))
+        except WayGPTError as e:
+            status, payload = self._error_body(e)
+            start_response(self._status_line(status), [("Content-Type", "application/json")])
+            return [payload]
+
+        headers = [("Content-Type", resp.headers.get("Content-Type", "text/event-stream"))] + self.RESPONSE_HEADERS
+        start_response(self._status_line(200), headers)
+        return self._relay(resp)
+
+    def _read_body(self, environ: Dict[str, Any]) -> bytes:
+        """Тело запроса не больше max_body_bytes"""
+        stream = environ["wsgi.input"]
+        length = self._declared_length(environ.get("CONTENT_LENGTH"))
+        if length is not None:
+            return cast(bytes, stream.read(length))
+        if not environ.get("wsgi.input_terminated"):
+            return b""
+        body = stream.read(self.max_body_bytes + 1)
+        self._check_body_size(len(body))
+        return cast(bytes, body)
+
+    def _relay(self, resp: requests.Response) -> Iterator[bytes]:
+        completed = False
+        try:
+            yield from self._iter_upstream(resp)
+            completed = True
+        finally:
+            if not completed:
+                self.client._record_stats(proxy_disconnects=1)
+            resp.close()
+
+
+class ASGIStreamProxy(_StreamProxyBase):
+    """
+    ASGI-приложение: проксирует стрим chat completions браузеру без разбора SSE
+
+    Чтение upstream выполняется в пуле потоков. При http.disconnect от клиента
+    upstream-соединение закрывается сразу, и генерация прекращается.
+
+    Пример (Starlette/FastAPI):
+        app.mount("/ai/stream", ASGIStreamProxy(client))
+    """
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable[[], Awaitable[Dict[str, Any]]], send: Callable[[Dict[str, Any]], Awaitable[None]]) -> None:
+        if scope["type"] != "http":
+            return
+        if scope.get("method") != "POST":
+            await self._send_simple(send, 405, b'{"detail": "Method Not Allowed"}', [(b"allow", b"POST")])
+            return
+
+        loop = asyncio.get_running_loop()
+        # run_in_executor не переносит contextvars: приоритет scheduler.priority(...)
+        # и span трассировки передаются в поток через копию контекста
+        context = contextvars.copy_context()
+        try:
+            body = await self._read_body(scope, receive)
+            if body is None:
+                return
+            resp = await loop.run_in_executor(None, context.run, self._open_upstream, body)
+        except WayGPTError as e:
+            status, payload = self._error_body(e)
+            await self._send_simple(send, status, payload)
+            return
+
+        disconnected = asyncio.Event()
+
+        async def watch_disconnect() -> None:
+            while True:
+                message = await receive()
+                if message["type"] == "http.disconnect":
+                    disconnected.set()
+                    # Закрытие сокета прерывает чтение upstream в потоке
+                    _abort_response(resp)
+                    return
+
+        watcher = asyncio.ensure_future(watch_disconnect())
+        chunks = self._iter_upstream(resp)
+        try:
+            headers = [(b"content-type", resp.headers.get("Content-Type", "text/event-stream").encode("latin-1"))]
+            headers += [(k.lower().encode("latin-1"), v.encode("latin-1")) for k, v in self.RESPONSE_HEADERS]
+            await send({"type": "http.response.start", "status": 200, "headers": headers})
+            while not disconnected.is_set():
+                try:
+                    chunk = await loop.run_in_executor(None, context.run, next, chunks, None)
+                except Exception:
+                    if disconnected.is_set():
+                        break
+                    raise
+                if chunk is None:
+                    break
+                await send({"type": "http.response.body", "body": chunk, "more_body": True})
+            if not disconnected.is_set():
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+        except OSError:
+            disconnected.set()
+        finally:
+            watcher.cancel()
+            if disconnected.is_set():
+                self.client._record_stats(proxy_disconnects=1)
+            resp.close()
+
+    async def _read_body(
+        self, scope: Dict[str, Any], receive: Callable[[], Awaitable[Dict[str, Any]]]
+    ) -> Optional[bytes]:
+        """Тело запроса не больше max_body_bytes; None — клиент отключился"""
+        headers = dict(scope.get("headers") or [])
+        self._declared_length(headers.get(b"content-length", b"").decode("latin-1"))
+        parts: List[bytes] = []
+        size = 0
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                return None
+            part = message.get("body", b"")
+            size += len(part)
+            self._check_body_size(size)
+            parts.append(part)
+            if not message.get("more_body"):
+                return b"".join(parts)
+
+    async def _send_simple(
+        self,
+        send: Callable[[Dict[str, Any]], Awaitable[None]],
+        status: int,
+        payload: bytes,
+        extra_headers: Sequence[Tuple[bytes, bytes]] = ()
+    ) -> None:
+        await send({
+            "type": "http.response.start",
+            "status": status,
+            "headers": [(b"content-type", b"application/json")] + list(extra_headers),
+        })
+        await send({"type": "http.response.body", "body": payload, "more_body": False})
+
+
+class RotatingNonceCache:
+    """
+    Кеш nonce для защиты от повторов: множества по корзинам подписанного времени
+
+    Nonce кладётся в корзину по timestamp запроса. Timestamp входит в подпись,
+    поэтому повтор всегда попадает в ту же корзину. Корзина отбрасывается целиком,
+    когда все её timestamp старше now - window: такой запрос уже не пройдёт
+    проверку времени. Так nonce хранится всё время, пока подпись действительна,
+    в том числе для timestamp «из будущего» (до now + max_skew). Память
+    ограничена числом запросов за 2 * window. Только для одного процесса.
+    """
+
+    def __init__(self, window: float = 300.0) -> None:
+        """
+        Args:
+            window: Ширина корзины в секундах (не меньше допустимого расхождения времени)
+        """
+        self.window = window
+        self._lock = threading.Lock()
+        self._buckets: Dict[int, set] = {}
+        self._oldest = 0
+
+    def check_and_add(self, nonce: str, timestamp: Optional[float] = None) -> bool:
+        """
+        Args:
+            nonce: Nonce запроса
+            timestamp: Подписанное время запроса (None — время получения; тогда
+                проверяются текущая и предыдущая корзины)
+
+        Returns:
+            True, если nonce новый (и теперь запомнен); False — повтор
+        """
+        now = time.time()
+        epoch = int((now if timestamp is None else timestamp) // self.window)
+        oldest = int((now - self.window) // self.window)
+        with self._lock:
+            if oldest != self._oldest:
+                for stale in [e for e in self._buckets if e < oldest]:
+                    del self._buckets[stale]
+                self._oldest = oldest
+            if epoch < oldest:
+                # Запрос старше окна: запомнить nonce на нужный срок нельзя
+                return False
+            lookup = (epoch,) if timestamp is not None else (epoch - 1, epoch)
+            if any(nonce in self._buckets.get(e, ()) for e in lookup):
+                return False
+            self._buckets.setdefault(epoch, set()).add(nonce)
+            return True
+
+    def __len__(self) -> int:
+        with self._lock:
+            return sum(len(bucket) for bucket in self._buckets.values())
+
+
+class BloomNonceCache:
+    """
+    Кеш nonce фиксированного размера: колесо Bloom-фильтров по временным корзинам
+
+    Память не зависит от нагрузки: slots фильтров по capacity элементов с долей
+    ложных срабатываний error_rate (ложное срабатывание — отклонение нового nonce).
+    Корзины, как и в RotatingNonceCache, выбираются по подписанному timestamp.
+    С path фильтры лежат в общем mmap-файле, и проверку разделяют все воркеры
+    хоста (gunicorn и т.п.); атомарность — через flock (только Unix).
+    """
+
+    _HEADER = 8  # на слот: номер временной корзины (int64)
+
+    def __init__(
+        self,
+        window: float = 300.0,
+        capacity: int = 1_000_000,
+        error_rate: float = 1e-6,
+        slots: int = 3,
+        path: Optional[str] = None
+    ) -> None:
+        """
+        Args:
+            window: Ширина корзины в секундах (не меньше допустимого расхождения времени)
+            capacity: Ожидаемое число nonce за window
+            error_rate: Допустимая доля ложных срабатываний
+            slots: Число корзин в колесе (не меньше 3: timestamp в пределах ±window
+                попадают в предыдущую, текущую или следующую корзину)
+            path: Файл для общего между процессами кеша (None — память процесса)
+        """
+        import math
+
+        self.window = window
+        self.slots = max(3, slots)
+        self.bits = max(64, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.bits += (-self.bits) % 8
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self._slot_bytes = self.bits // 8
+        self._lock = threading.Lock()
+        self._fd: Optional[int] = None
+        size = self.slots * (self._HEADER + self._slot_bytes)
+
+        self._buf: Union[bytearray, mmap.mmap]
+        if path is None:
+            self._buf = bytearray(size)
+        else:
+            if fcntl is None:
+                raise ValueError("Общий кеш nonce (path) поддерживается только на Unix")
+            self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self._fd).st_size != size:
+                    os.ftruncate(self._fd, size)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+            self._buf = mmap.mmap(self._fd, size)
+
+    def _positions(self, nonce: str) -> List[int]:
+        digest = hashlib.blake2b(nonce.encode("utf-8"), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def _slot_offset(self, epoch: int) -> Optional[int]:
+        """Смещение слота корзины epoch; устаревший слот очищается (None — слот занят более новой корзиной)"""
+        offset = (epoch % self.slots) * (self._HEADER + self._slot_bytes)
+        stored = int.from_bytes(self._buf[offset:offset + self._HEADER], "little", signed=True)
+        if stored > epoch:
+            return None
+        if stored != epoch:
+            self._buf[offset:offset + self._HEADER + self._slot_bytes] = (
+                epoch.to_bytes(self._HEADER, "little", signed=True) + bytes(self._slot_bytes)
+            )
+        return offset + self._HEADER
+
+    def _contains(self, base: Optional[int], positions: List[int]) -> bool:
+        if base is None:
+            return False
+        buf = self._buf
+        return all(buf[base + (p >> 3)] & (1 << (p & 7)) for p in positions)
+
+    def check_and_add(self, nonce: str, timestamp: Optional[float] = None) -> bool:
+        """
+        Args:
+            nonce: Nonce запроса
+            timestamp: Подписанное время запроса (None — время получения; тогда
+                проверяются текущая и предыдущая корзины)
+
+        Returns:
+            True, если nonce новый (и теперь запомнен); False — повтор (или ложное срабатывание)
+        """
+        positions = self._positions(nonce)
+        now = time.time()
+        epoch = int((now if timestamp is None else timestamp) // self.window)
+        if epoch < int((now - self.window) // self.window):
+            return False
+        with self._lock:
+            if self._fd is not None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                current = self._slot_offset(epoch)
+                if current is None or self._contains(current, positions):
+                    return False
+                if timestamp is None and self._contains(self._slot_offset(epoch - 1), positions):
+                    return False
+                buf = self._buf
+                for p in positions:
+                    buf[current + (p >> 3)] |= 1 << (p & 7)
+                return True
+            finally:
+                if self._fd is not None:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def close(self) -> None:
+        """Освобождение mmap и файла (для общего кеша)"""
+        if isinstance(self._buf, mmap.mmap):
+            self._buf.close()
+        if self._fd is not None:
+            os.close(self._fd)
+            self._fd = None
+
+
+class HMACVerifier:
+    """
+    Проверка HMAC-подписи входящих запросов (формат WayGPTClient)
+
+    Проверяет окно времени X-MB-Timestamp, подпись X-MB-Signature (сравнение
+    за постоянное время) и одноразовость X-MB-Nonce. Nonce запоминается только
+    после успешной проверки подписи, поэтому мусорные запросы не засоряют кеш.
+
+    Пример:
+        verifier = HMACVerifier({"project-uuid": "secret"})
+        project_id = verifier.verify("POST", "/api/orders", body, request.headers)
+    """
+
+    HEADER_TIMESTAMP = "X-MB-Timestamp"
+    HEADER_NONCE = "X-MB-Nonce"
+    HEADER_SIGNATURE = "X-MB-Signature"
+    HEADER_PROJECT = "X-MB-Project"
+
+    def __init__(
+        self,
+        secrets_by_project: Union[Dict[str, str], Callable[[str], Optional[str]]],
+        max_skew: float = 300.0,
+        nonce_cache: Optional[Union[RotatingNonceCache, BloomNonceCache]] = None,
+        key_ttl: float = 60.0,
+        max_cached_keys: int = 1024
+    ) -> None:
+        """
+        Args:
+            secrets_by_project: {project_id: hmac_secret} или функция project_id -> secret
+            max_skew: Допустимое расхождение времени в секундах
+            nonce_cache: Кеш nonce (по умолчанию RotatingNonceCache(window=max_skew));
+                его window должно быть не меньше max_skew
+            key_ttl: Сколько секунд секрет проекта берётся из кеша без повторного запроса
+                к secrets_by_project. При неверной подписи секрет перечитывается раньше
+                (не чаще раза в секунду), поэтому смена секрета подхватывается сразу
+            max_cached_keys: Максимум проектов в кеше секретов (LRU)
+        """
+        if nonce_cache is not None and nonce_cache.window < max_skew:
+            raise ValueError("window кеша nonce должно быть не меньше max_skew")
+        self._lookup: Callable[[str], Optional[str]] = (
+            secrets_by_project.get if isinstance(secrets_by_project, dict) else secrets_by_project
+        )
+        self._single_project: Optional[str] = (
+            next(iter(secrets_by_project)) if isinstance(secrets_by_project, dict) and len(secrets_by_project) == 1 else None
+        )
+        # project_id -> (ключ, время получения секрета)
+        self._keys: "OrderedDict[str, Tuple[bytes, float]]" = OrderedDict()
+        self._keys_lock = threading.Lock()
+        self.key_ttl = key_ttl
+        self.max_cached_keys = max(1, max_cached_keys)
+        self.max_skew = max_skew
+        self.nonce_cache = nonce_cache if nonce_cache is not None else RotatingNonceCache(window=max_skew)
+
+    @staticmethod
+    def _header(headers: Any, name: str) -> Optional[str]:
+        value = headers.get(name)
+        if value is None:
+            value = headers.get(name.lower())
+        if value is None:
+            # WSGI environ: HTTP_X_MB_TIMESTAMP
+            value = headers.get("HTTP_" + name.upper().replace("-", "_"))
+        return value
+
+    # Не чаще, чем раз в столько секунд, неверная подпись перечитывает секрет проекта
+    _KEY_RECHECK_SECONDS = 1.0
+
+    def _key(self, project_id: str, max_age: Optional[float] = None) -> Optional[bytes]:
+        """Ключ проекта из кеша, если он получен не раньше max_age секунд назад (по умолчанию key_ttl)"""
+        now = time.monotonic()
+        with self._keys_lock:
+            entry = self._keys.get(project_id)
+            if entry is not None and now - entry[1] < (self.key_ttl if max_age is None else max_age):
+                self._keys.move_to_end(project_id)
+                return entry[0]
+        secret = self._lookup(project_id)
+        with self._keys_lock:
+            if secret is None:
+                self._keys.pop(project_id, None)
+                return None
+            key = secret.encode("utf-8")
+            self._keys[project_id] = (key, now)
+            self._keys.move_to_end(project_id)
+            while len(self._keys) > self.max_cached_keys:
+                self._keys.popitem(last=False)
+        return key
+
+    @staticmethod
+    def _signature_matches(key: bytes, canonical: bytes, signature: str) -> bool:
+        expected = hmac.new(key, canonical, hashlib.sha256).hexdigest().encode("ascii")
+        # compare_digest не принимает str с не-ASCII символами — сравниваем байты
+        return hmac.compare_digest(expected, signature.encode("utf-8", "replace"))
+
+    def verify(
+        self,
+        method: str,
+        path: str,
+        body: Optional[bytes],
+        headers: Any,
+        project_id: Optional[str] = None
+    ) -> str:
+        """
+        Проверка запроса
+
+        Args:
+            method: HTTP метод
+            path: Путь с query string, как его подписал клиент
+            body: Тело запроса (bytes, как получено)
+            headers: Заголовки (dict, заголовки фреймворка или WSGI environ)
+            project_id: ID проекта (по умолчанию из X-MB-Project или единственный в словаре)
+
+        Returns:
+            project_id проверенного запроса
+
+        Raises:
+            WayGPTError: status_code=401 при любой ошибке проверки
+        """
+        timestamp = self._header(headers, self.HEADER_TIMESTAMP)
+        nonce = self._header(headers, self.HEADER_NONCE)
+        signature = self._header(headers, self.HEADER_SIGNATURE)
+        if not timestamp or not nonce or not signature:
+            raise WayGPTError("Нет заголовков HMAC подписи", status_code=401)
+
+        try:
+            ts = int(timestamp)
+        except ValueError:
+            raise WayGPTError("Некорректный X-MB-Timestamp", status_code=401)
+        if abs(time.time() - ts) > self.max_skew:
+            raise WayGPTError("Подпись устарела или время рассинхронизировано", status_code=401)
+
+        project = project_id or self._header(headers, self.HEADER_PROJECT) or self._single_project
+        key = self._key(project) if project else None
+        if key is None:
+            raise WayGPTError("Неизвестный проект", status_code=401)
+
+        canonical = build_hmac_canonical(
+            method, path, hashlib.sha256(body or b"").hexdigest(), timestamp, nonce, project
+        ).encode("utf-8")
+        if not self._signature_matches(key, canonical, signature):
+            # Секрет мог смениться: перечитываем его и проверяем ещё раз
+            fresh = self._key(cast(str, project), max_age=self._KEY_RECHECK_SECONDS)
+            if fresh is None or fresh == key or not self._signature_matches(fresh, canonical, signature):
+                raise WayGPTError("Неверная подпись", status_code=401)
+
+        # Корзина — по подписанному времени: повтор с timestamp «из будущего»
+        # отклоняется, пока подпись действительна (до ts + max_skew)
+        if not self.nonce_cache.check_and_add(f"{project}:{nonce}", ts):
+            raise WayGPTError("Повтор запроса (nonce уже использован)", status_code=401)
+        return cast(str, project)
@@ -0,0 +1,210 @@
+"""
+Общие фикстуры тестов Python SDK
+
+StandInServer — локальная заглушка WayGPT API на http.server: маршруты задаются
+в тесте, все запросы записываются (заголовки, сырое и распакованное тело).
+Ответ маршрута — dict/list (JSON 200) или Reply, в том числе потоковый (SSE).
+"""
+
+import gzip
+import json
+import os
+import sys
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "../../src/python"))
+
+from waygpt_client import WayGPTClient  # noqa: E402
+
+
+class Recorded:
+    """Запрос, полученный заглушкой"""
+
+    def __init__(self, method: str, path: str, headers: Dict[str, str], raw: bytes, body: bytes) -> None:
+        self.method = method
+        self.path = path
+        self.headers = headers
+        self.raw = raw
+        self.body = body
+
+    def json(self) -> Any:
+        return json.loads(self.body)
+
+
+class Reply:
+    """
+    Ответ заглушки
+
+    chunks — потоковый ответ (chunked): каждый кусок отправляется отдельно,
+    с паузой delay между кусками; вместо bytes кусок может быть функцией без
+    аргументов (например, ожидание события теста).
+    """
+
+    def __init__(
+        self,
+        status: int = 200,
+        body: Any = None,
+        chunks: Optional[Iterable[Any]] = None,
+        headers: Optional[Dict[str, str]] = None,
+        gzip: bool = False,
+        delay: float = 0.0
+    ) -> None:
+        self.status = status
+        self.body = body
+        self.chunks = chunks
+        self.headers = headers or {}
+        self.gzip = gzip
+        self.delay = delay
+
+
+def sse(*contents: str, done: bool = True) -> List[bytes]:
+    """SSE-события chat.completion.chunk с заданными кусками текста"""
+    events = [
+        b"data: " + json.dumps({"choices": [{"index": 0, "delta": {"content": c}, "finish_reason": None}]}).encode() + b"\n\n"
+        for c in contents
+    ]
+    if done:
+        events.append(b"data: [DONE]\n\n")
+    return events
+
+
+class StandInServer:
+    """Локальная заглушка WayGPT API"""
+
+    def __init__(self) -> None:
+        self.routes: Dict[Tuple[str, str], Callable[[Recorded], Any]] = {}
+        self.requests: List[Recorded] = []
+        self.disconnects = 0
+        self._httpd = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self._httpd.server_address[1]}"
+        threading.Thread(target=self._httpd.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True).start()
+
+    def route(self, method: str, path: str, handler: Any) -> None:
+        """Маршрут: path точный или с "*" на конце (префикс); handler — функция или готовый ответ"""
+        self.routes[(method, path)] = handler if callable(handler) else (lambda request: handler)
+
+    def close(self) -> None:
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def _find(self, method: str, path: str) -> Optional[Callable[[Recorded], Any]]:
+        handler = self.routes.get((method, path))
+        if handler is not None:
+            return handler
+        for (m, p), h in self.routes.items():
+            if m == method and p.endswith("*") and path.startswith(p[:-1]):
+                return h
+        return None
+
+    def _handler(self) -> type:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+            def _read_body(self) -> bytes:
+                if self.headers.get("Transfer-Encoding", "").lower() == "chunked":
+                    raw = b""
+                    while True:
+                        size = int(self.rfile.readline().strip(), 16)
+                        if size == 0:
+                            self.rfile.readline()
+                            return raw
+                        raw += self.rfile.read(size)
+                        self.rfile.readline()
+                length = int(self.headers.get("Content-Length") or 0)
+                return self.rfile.read(length) if length else b""
+
+            def _handle(self) -> None:
+                raw = self._read_body()
+                body = gzip.decompress(raw) if self.headers.get("Content-Encoding") == "gzip" else raw
+                request = Recorded(self.command, self.path, dict(self.headers), raw, body)
+                server.requests.append(request)
+                handler = server._find(self.command, self.path.split("?")[0])
+                result = handler(request) if handler is not None else Reply(404, {"detail": "not found"})
+                self._reply(result if isinstance(result, Reply) else Reply(body=result))
+
+            def _reply(self, reply: Reply) -> None:
+                self.send_response(reply.status)
+                for name, value in reply.headers.items():
+                    if name != "Content-Type":  # отправляется ниже
+                        self.send_header(name, value)
+                if reply.chunks is None:
+                    body = reply.body if isinstance(reply.body, bytes) else json.dumps(reply.body).encode()
+                    if reply.gzip:
+                        body = gzip.compress(body)
+                        self.send_header("Content-Encoding", "gzip")
+                    self.send_header("Content-Type", reply.headers.get("Content-Type", "application/json"))
+                    self.send_header("Content-Length", str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+
+                self.send_header("Content-Type", reply.headers.get("Content-Type", "text/event-stream"))
+                self.send_header("Transfer-Encoding", "chunked")
+                if reply.gzip:
+                    self.send_header("Content-Encoding", "gzip")
+                self.end_headers()
+                compressor = zlib.compressobj(wbits=31) if reply.gzip else None
+                try:
+                    for piece in reply.chunks:
+                        if callable(piece):
+                            piece()
+                            continue
+                        if compressor is not None:
+                            piece = compressor.compress(piece) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                        self._write_chunk(piece)
+                        if reply.delay:
+                            time.sleep(reply.delay)
+                    if compressor is not None:
+                        self._write_chunk(compressor.flush())
+                    self.wfile.write(b"0\r\n\r\n")
+                    self.wfile.flush()
+                except (BrokenPipeError, ConnectionResetError):
+                    server.disconnects += 1
+                    self.close_connection = True
+
+            def _write_chunk(self, data: bytes) -> None:
+                if data:
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                    self.wfile.flush()
+
+            do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+        return Handler
+
+
+@pytest.fixture
+def server() -> Iterable[StandInServer]:
+    srv = StandInServer()
+    yield srv
+    srv.close()
+
+
+@pytest.fixture
+def make_client(server: StandInServer) -> Callable[..., WayGPTClient]:
+    """Фабрика клиентов, направленных на заглушку (без retry)"""
+
+    def factory(**kwargs: Any) -> WayGPTClient:
+        kwargs.setdefault("api_url", server.url)
+        kwargs.setdefault("project_key", "test-project-key")
+        kwargs.setdefault("max_retries", 0)
+        kwargs.setdefault("timeout", 5)
+        return WayGPTClient(**kwargs)
+
+    return factory
+
+
+@pytest.fixture
+def client(make_client: Callable[..., WayGPTClient]) -> WayGPTClient:
+    return make_client()
@@ -0,0 +1,158 @@
+"""Несколько зеркал API: учёт стримов, фоновая проверка, скачивание медиа"""
+
+import threading
+import time
+
+import pytest
+
+from conftest import Reply, StandInServer, sse
+from waygpt_client import WayGPTError, _EndpointBalancer
+
+CHAT = "/api/v1/waygpt/chat/completions"
+IMAGES = "/api/v1/waygpt/images/generations"
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+@pytest.fixture
+def mirrors():
+    servers = [StandInServer(), StandInServer()]
+    yield servers
+    for srv in servers:
+        srv.close()
+
+
+def outstanding(client):
+    return {ep["url"]: ep["outstanding"] for ep in client.endpoint_stats()}
+
+
+def test_stream_occupies_endpoint_until_closed(mirrors, make_client):
+    release = threading.Event()
+    for srv in mirrors:
+        events = sse("a", "b")
+        srv.route("POST", CHAT, Reply(chunks=[events[0], lambda: release.wait(5)] + events[1:]))
+    client = make_client(api_url=[srv.url for srv in mirrors])
+
+    stream = client.chat_completions_stream(messages=MESSAGES)
+    next(stream)
+    serving = next(srv.url for srv in mirrors if srv.requests)
+
+    assert outstanding(client)[serving] == 1
+    release.set()
+    assert [c["choices"][0]["delta"]["content"] for c in stream] == ["b"]
+    assert outstanding(client)[serving] == 0
+    stream.close()
+    assert outstanding(client)[serving] == 0
+
+
+def test_close_stops_health_checks(mirrors, make_client):
+    client = make_client(api_url=[srv.url for srv in mirrors], health_check_interval=0.05)
+    thread = client._balancer._health_thread
+    assert thread.is_alive()
+
+    with client:
+        pass
+
+    assert not thread.is_alive()
+    checks = sum(len(srv.requests) for srv in mirrors)
+    threading.Event().wait(0.2)
+    assert sum(len(srv.requests) for srv in mirrors) == checks
+
+
+def test_relative_media_url_is_downloaded_from_serving_mirror(mirrors, make_client, tmp_path):
+    for i, srv in enumerate(mirrors):
+        srv.route("POST", IMAGES, {"data": [{"url": "/files/image.png"}]})
+        srv.route("GET", "/files/image.png", Reply(body=b"mirror-%d" % i, headers={"Content-Type": "image/png"}))
+    client = make_client(api_url=[srv.url for srv in mirrors])
+
+    for attempt in range(6):
+        result = client.image_generations(prompt="кот")
+        serving = next(i for i, srv in enumerate(mirrors) if any(r.path == IMAGES for r in srv.requests))
+        path, = client.save_media(result, str(tmp_path / str(attempt)))
+
+        with open(path, "rb") as fh:
+            assert fh.read() == b"mirror-%d" % serving
+        assert result == {"data": [{"url": "/files/image.png"}]}
+        for srv in mirrors:
+            srv.requests.clear()
+
+
+def submit_until_down_is_hit(client, down, up, **kwargs):
+    """
+    Отправка генерации, пока случайный выбор не попадёт на недоступное зеркало
+
+    Returns:
+        (ошибка или None, сколько запросов этого вызова получило второе зеркало)
+    """
+    for _ in range(50):
+        before, up_before = len(down.requests), len(up.requests)
+        try:
+            client.image_generations("кот", **kwargs)
+        except WayGPTError as e:
+            assert len(down.requests) > before
+            return e, len(up.requests) - up_before
+        if len(down.requests) > before:
+            return None, len(up.requests) - up_before
+    pytest.fail("недоступное зеркало не выбрано")
+
+
+def test_post_is_not_resent_after_ambiguous_error(mirrors, make_client):
+    down, up = mirrors
+    down.route("POST", IMAGES, Reply(503, {"detail": "down"}))
+    up.route("POST", IMAGES, {"data": []})
+    client = make_client(api_url=[down.url, up.url])
+
+    error, resent = submit_until_down_is_hit(client, down, up)
+
+    # Генерация могла начаться на недоступном зеркале — повтор оплатил бы её дважды
+    assert error is not None and resent == 0
+    assert "endpoint_failovers" not in client.get_stats()
+
+
+def test_post_with_idempotency_key_fails_over(mirrors, make_client):
+    down, up = mirrors
+    down.route("POST", IMAGES, Reply(503, {"detail": "down"}))
+    up.route("POST", IMAGES, {"data": []})
+    client = make_client(api_url=[down.url, up.url])
+
+    error, resent = submit_until_down_is_hit(client, down, up, idempotency_key="job-1")
+
+    assert error is None and resent == 1
+    assert up.requests[-1].json()["idempotency_key"] == "job-1"
+    assert client.get_stats()["endpoint_failovers"] == 1
+
+
+def test_post_fails_over_on_connection_error(mirrors, make_client):
+    closed = StandInServer()
+    closed.close()  # порт свободен — соединение отклоняется до отправки запроса
+    up = mirrors[0]
+    up.route("POST", IMAGES, {"data": []})
+    client = make_client(api_url=[closed.url, up.url])
+
+    for _ in range(20):
+        client.image_generations("кот")
+
+    assert len(up.requests) == 20
+    assert client.get_stats().get("endpoint_failovers", 0) >= 1
+
+
+def test_failed_probe_after_ejection_ejects_again_with_longer_period():
+    balancer = _EndpointBalancer([("http://a", 1.0), ("http://b", 1.0)], eject_after=3, eject_seconds=10)
+    ep = balancer.endpoints[0]
+    for _ in range(3):
+        balancer.release(balancer.acquire(exclude=[balancer.endpoints[1]]), 0.1, failed=True)
+    first_period = ep.ejected_until - time.monotonic()
+
+    # Ошибки запросов, ещё бывших в работе, срок исключения не продлевают
+    balancer._record(ep, 0.1, failed=True)
+    assert ep.ejections == 1
+
+    ep.ejected_until = time.monotonic() - 1  # срок вышел, зеркало получает пробный запрос
+    balancer.release(balancer.acquire(exclude=[balancer.endpoints[1]]), 0.1, failed=True)
+
+    assert ep.ejections == 2
+    assert 9 < first_period <= 10
+    assert 19 < ep.ejected_until - time.monotonic() <= 20
+
+    ep.ejected_until = time.monotonic() - 1
+    balancer.release(balancer.acquire(exclude=[balancer.endpoints[1]]), 0.1, failed=False)
+    assert (ep.failures, ep.ejections, ep.ejected_until) == (0, 0, 0.0)
@@ -0,0 +1,97 @@
+"""client_snapshot: параллельная загрузка проектов, частичные ошибки, инкрементальное обновление"""
+
+import pytest
+
+from conftest import Reply
+from waygpt_client import WayGPTError
+
+PROJECTS = "/api/v1/client/projects"
+
+
+@pytest.fixture
+def api(server):
+    """Два проекта; ответы на settings и use-cases можно переопределить в api.replies"""
+    replies = {}
+
+    def handler(request):
+        pid, resource = request.path[len(PROJECTS) + 1:].split("/")
+        return replies.get((pid, resource), {"id": pid} if resource == "settings" else [{"key": f"{pid}-uc"}])
+
+    server.route("GET", PROJECTS, [{"id": "p1", "updated_at": "t1"}, {"id": "p2", "updated_at": "t1"}])
+    server.route("GET", PROJECTS + "/*", handler)
+    handler.replies = replies
+    return handler
+
+
+def project_requests(server):
+    return sorted(r.path for r in server.requests if r.path != PROJECTS)
+
+
+def test_snapshot_loads_all_projects(server, client, api):
+    snapshot = client.client_snapshot("jwt", max_workers=4)
+
+    assert snapshot.ok
+    assert list(snapshot.projects) == ["p1", "p2"]
+    assert snapshot.projects["p2"] == {
+        "project": {"id": "p2", "updated_at": "t1"}, "settings": {"id": "p2"}, "use_cases": [{"key": "p2-uc"}],
+    }
+    assert snapshot.refetched == ["p1", "p2"]
+    assert all(r.headers["Authorization"] == "Bearer jwt" for r in server.requests)
+
+
+def test_partial_failure_keeps_other_projects(client, api):
+    api.replies[("p2", "settings")] = Reply(403, {"detail": "нет доступа"})
+
+    snapshot = client.client_snapshot("jwt")
+
+    assert not snapshot.ok
+    assert list(snapshot.projects) == ["p1"]
+    assert snapshot.errors["p2"].status_code == 403
+    assert snapshot.refetched == ["p1"]
+    assert snapshot.to_dict()["errors"] == {"p2": {"message": "нет доступа", "status_code": 403}}
+
+
+def test_unexpected_exception_is_recorded_per_project(client, api, monkeypatch):
+    list_use_cases = client.client_list_use_cases
+
+    def broken(project_id, jwt_token):
+        if project_id == "p1":
+            raise KeyError("config")
+        return list_use_cases(project_id, jwt_token)
+
+    monkeypatch.setattr(client, "client_list_use_cases", broken)
+
+    snapshot = client.client_snapshot("jwt")
+
+    assert list(snapshot.projects) == ["p2"]
+    error = snapshot.errors["p1"]
+    assert isinstance(error, WayGPTError) and isinstance(error.__cause__, KeyError)
+    assert "p1" in error.message and error.status_code is None
+
+
+def test_failed_project_keeps_previous_data(server, client, api):
+    previous = client.client_snapshot("jwt")
+    server.route("GET", PROJECTS, [{"id": "p1", "updated_at": "t2"}, {"id": "p2", "updated_at": "t1"}])
+    api.replies[("p1", "use-cases")] = Reply(404, {"detail": "not found"})
+    server.requests.clear()
+
+    snapshot = client.client_snapshot("jwt", previous=previous)
+
+    assert snapshot.projects["p1"] is previous.projects["p1"]
+    assert snapshot.errors["p1"].status_code == 404
+    # p2 не изменился: взят из прошлого снимка без запросов
+    assert snapshot.reused == ["p2"] and snapshot.refetched == []
+    assert project_requests(server) == [f"{PROJECTS}/p1/settings", f"{PROJECTS}/p1/use-cases"]
+
+
+def test_project_with_error_is_refetched_next_time(server, client, api):
+    api.replies[("p2", "settings")] = Reply(403, {"detail": "нет доступа"})
+    previous = client.client_snapshot("jwt")
+    del api.replies[("p2", "settings")]
+    server.requests.clear()
+
+    snapshot = client.client_snapshot("jwt", previous=previous)
+
+    assert snapshot.ok
+    assert snapshot.reused == ["p1"] and snapshot.refetched == ["p2"]
+    assert project_requests(server) == [f"{PROJECTS}/p2/settings", f"{PROJECTS}/p2/use-cases"]
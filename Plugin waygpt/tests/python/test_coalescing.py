@@ -0,0 +1,157 @@
+"""Объединение одновременных одинаковых запросов (coalesce_requests, SingleFlight)"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from conftest import Reply
+from waygpt_client import SingleFlight, WayGPTError
+
+MODELS = "/api/v1/waygpt/models"
+CHAT = "/api/v1/waygpt/chat/completions"
+
+
+def run_together(calls):
+    """Запуск вызовов в потоках; возвращает результаты или исключения в порядке calls"""
+    results = [None] * len(calls)
+
+    def run(i):
+        try:
+            results[i] = calls[i]()
+        except Exception as e:
+            results[i] = e
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(len(calls))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(timeout=10)
+    return results
+
+
+def held(server, reply, requests_expected=1):
+    """Ответ, который отдаётся только после release(); сервер ждёт, пока подтянутся все вызовы"""
+    release = threading.Event()
+
+    def handler(request):
+        release.wait(timeout=5)
+        return reply
+
+    def release_when_started():
+        deadline = time.monotonic() + 5
+        while len(server.requests) < requests_expected and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.2)  # остальные вызовы успевают присоединиться к выполняющемуся
+        release.set()
+
+    threading.Thread(target=release_when_started, daemon=True).start()
+    return handler
+
+
+def test_identical_gets_are_sent_once(server, make_client):
+    client = make_client(coalesce_requests=True)
+    server.route("GET", MODELS, held(server, ["m1"]))
+
+    results = run_together([client.get_models] * 5)
+
+    assert results == [["m1"]] * 5
+    assert len(server.requests) == 1
+    assert client.get_stats()["requests_coalesced"] == 4
+
+
+def test_every_caller_gets_its_own_copy(server, make_client):
+    client = make_client(coalesce_requests=True)
+    server.route("GET", "/api/v1/waygpt/use-cases", held(server, [{"id": "chat"}]))
+
+    results = run_together([lambda: client.get_use_cases(detailed=True)] * 3)
+
+    assert len(server.requests) == 1
+    assert len({id(r) for r in results}) == 3
+    results[0][0]["id"] = "changed"
+    assert results[1][0]["id"] == results[2][0]["id"] == "chat"
+
+
+def test_followers_get_leader_exception(server, make_client):
+    client = make_client(coalesce_requests=True)
+    server.route("GET", MODELS, held(server, Reply(403, {"detail": "forbidden"})))
+
+    results = run_together([client.get_models] * 3)
+
+    assert len(server.requests) == 1
+    assert all(isinstance(r, WayGPTError) and r.status_code == 403 for r in results)
+    assert client.get_stats()["requests_coalesced"] == 2
+
+
+def test_requests_with_different_keys_are_not_merged(server, make_client):
+    first = make_client(coalesce_requests=True, project_key="key-a")
+    second = make_client(coalesce_requests=True, project_key="key-b")
+    second._single_flight = first._single_flight  # общий SingleFlight: изолирует только ключ
+    server.route("GET", MODELS, held(server, ["m1"], requests_expected=2))
+
+    run_together([first.get_models, second.get_models])
+
+    assert sorted(r.headers["x-project-key"] for r in server.requests) == ["key-a", "key-b"]
+    assert "requests_coalesced" not in first.get_stats()
+
+
+def test_client_api_requests_are_keyed_by_jwt(server, make_client):
+    client = make_client(coalesce_requests=True)
+    server.route("GET", "/api/v1/client/projects", held(server, [], requests_expected=2))
+
+    run_together([
+        lambda: client.client_list_projects("jwt-a"),
+        lambda: client.client_list_projects("jwt-a"),
+        lambda: client.client_list_projects("jwt-b"),
+    ])
+
+    assert sorted(r.headers["Authorization"] for r in server.requests) == ["Bearer jwt-a", "Bearer jwt-b"]
+    assert client.get_stats()["requests_coalesced"] == 1
+
+
+@pytest.mark.parametrize("temperature, expected_requests", [(0, 1), (0.7, 2), (None, 2)])
+def test_only_deterministic_chat_is_merged(server, make_client, temperature, expected_requests):
+    client = make_client(coalesce_requests=True)
+    server.route("POST", CHAT, held(server, {"choices": [{"message": {"content": "ok"}}]}, expected_requests))
+    kwargs = {} if temperature is None else {"temperature": temperature}
+
+    run_together([lambda: client.chat_completions(messages=[{"role": "user", "content": "hi"}], **kwargs)] * 2)
+
+    assert len(server.requests) == expected_requests
+
+
+def test_do_async_merges_calls_in_one_loop():
+    flight = SingleFlight()
+    calls = []
+
+    async def fetch():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return {"value": 1}
+
+    async def main():
+        return await asyncio.gather(*(flight.do_async("key", fetch) for _ in range(3)))
+
+    results = asyncio.run(main())
+
+    assert calls == [1]
+    assert [shared for _, shared in results] == [False, True, True]
+    assert all(result == {"value": 1} for result, _ in results)
+    assert flight.in_flight() == 0
+
+
+def test_do_async_followers_get_leader_exception():
+    flight = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.05)
+        raise WayGPTError("boom")
+
+    async def main():
+        return await asyncio.gather(*(flight.do_async("key", fail) for _ in range(3)), return_exceptions=True)
+
+    results = asyncio.run(main())
+
+    assert all(isinstance(r, WayGPTError) and r.message == "boom" for r in results)
+    assert flight.in_flight() == 0
@@ -0,0 +1,127 @@
+"""Файлы в content parts: потоковое тело запроса, подпись HMAC, повторная отправка"""
+
+import base64
+import io
+
+import pytest
+
+from conftest import Reply
+from waygpt_client import FilePart, HMACVerifier
+
+CHAT = "/api/v1/waygpt/chat/completions"
+PROJECT = "project-uuid"
+SECRET = "hmac-secret"
+
+
+@pytest.fixture
+def hmac_client(make_client):
+    return make_client(project_id=PROJECT, hmac_secret=SECRET, use_hmac=True)
+
+
+def test_signature_covers_streamed_file_body(server, hmac_client):
+    verifier = HMACVerifier({PROJECT: SECRET})
+    verified = []
+
+    def handler(request):
+        verified.append(verifier.verify(request.method, request.path, request.raw, request.headers))
+        return {"choices": [{"message": {"content": "ok"}}]}
+
+    server.route("POST", CHAT, handler)
+    data = bytes(range(256)) * 1000  # больше блока чтения FilePart
+    content = [
+        {"type": "text", "text": "Что на фото?"},
+        FilePart(io.BytesIO(data), mime_type="image/png", filename="photo.png"),
+    ]
+
+    hmac_client.chat_completions(messages=[{"role": "user", "content": content}])
+
+    assert verified == [PROJECT]
+    sent = server.requests[0].json()["messages"][0]["content"][1]["image_url"]["url"]
+    assert sent.startswith("data:image/png;base64,")
+
+
+def pipe_with(data):
+    """Поток без seek (pipe), в который данные пишет отдельный поток"""
+    import os
+    import threading
+
+    r, w = os.pipe()
+
+    def writer():
+        with os.fdopen(w, "wb") as fh:
+            fh.write(data)
+
+    threading.Thread(target=writer, daemon=True).start()
+    return os.fdopen(r, "rb")
+
+
+def test_signed_request_with_non_seekable_file(server, hmac_client):
+    verifier = HMACVerifier({PROJECT: SECRET})
+    verified = []
+
+    def handler(request):
+        verified.append(verifier.verify(request.method, request.path, request.raw, request.headers))
+        return {"choices": [{"message": {"content": "ok"}}]}
+
+    server.route("POST", CHAT, handler)
+    data = bytes(range(256)) * 1000
+    part = FilePart(pipe_with(data), mime_type="image/png", filename="photo.png")
+    messages = [{"role": "user", "content": [part]}]
+
+    hmac_client.chat_completions(messages=messages)
+    # Тело читается заново и при повторной отправке того же FilePart
+    hmac_client.chat_completions(messages=messages)
+
+    assert verified == [PROJECT, PROJECT]
+    first, second = (r.json()["messages"][0]["content"][0]["image_url"]["url"] for r in server.requests)
+    assert first == second == "data:image/png;base64," + base64.b64encode(data).decode()
+    assert "Content-Length" in server.requests[0].headers
+
+
+def test_non_seekable_file_is_resent_after_failover(make_client):
+    from conftest import StandInServer
+
+    down, up = StandInServer(), StandInServer()
+    try:
+        down.route("POST", CHAT, Reply(503, {"detail": "down"}))
+        up.route("POST", CHAT, {"choices": [{"message": {"content": "ok"}}]})
+        client = make_client(api_url=f"{down.url},{up.url}", project_id=PROJECT, hmac_secret=SECRET, use_hmac=True)
+        data = b"x" * 100_000
+        part = FilePart(pipe_with(data), mime_type="image/png")
+
+        # Зеркало выбирается случайно — отправляем, пока не попадём на недоступное.
+        # POST после 503 повторяется на другом зеркале только с idempotency_key
+        for i in range(30):
+            client.chat_completions(messages=[{"role": "user", "content": [part]}], idempotency_key=f"req-{i}")
+            if down.requests:
+                break
+
+        assert down.requests
+        for request in up.requests:
+            HMACVerifier({PROJECT: SECRET}).verify(request.method, request.path, request.raw, request.headers)
+            assert request.json()["messages"][0]["content"][0]["image_url"]["url"].endswith(
+                base64.b64encode(data).decode())
+    finally:
+        down.close()
+        up.close()
+
+
+def test_text_mode_file_is_rejected(tmp_path, client):
+    path = tmp_path / "note.txt"
+    path.write_text("hello")
+
+    with open(path) as fh:
+        with pytest.raises(ValueError, match="текстовом режиме"):
+            FilePart(fh)
+        with pytest.raises(ValueError, match="текстовом режиме"):
+            client.chat_completions(messages=[{"role": "user", "content": [fh]}])
+
+
+def test_each_request_gets_fresh_nonce(server, hmac_client):
+    server.route("GET", "/api/v1/waygpt/models", ["m1"])
+
+    hmac_client.get_models()
+    hmac_client.get_models()
+
+    nonces = [r.headers["X-MB-Nonce"] for r in server.requests]
+    assert len(set(nonces)) == 2
@@ -0,0 +1,228 @@
+"""HMACVerifier: проверка подписи входящих запросов, кеш секретов, кеши nonce"""
+
+import hashlib
+import hmac
+import time
+
+import pytest
+
+from waygpt_client import BloomNonceCache, HMACVerifier, RotatingNonceCache, WayGPTError, build_hmac_canonical
+
+CHAT = "/api/v1/waygpt/chat/completions"
+PROJECT = "project-uuid"
+SECRET = "hmac-secret"
+
+
+def signed_headers(body=b"", ts=None, nonce="nonce-1", path=CHAT, secret=SECRET, project=PROJECT):
+    ts = int(time.time()) if ts is None else ts
+    canonical = build_hmac_canonical("POST", path, hashlib.sha256(body).hexdigest(), ts, nonce, project)
+    signature = hmac.new(secret.encode(), canonical.encode(), hashlib.sha256).hexdigest()
+    return {"X-MB-Timestamp": str(ts), "X-MB-Nonce": nonce, "X-MB-Signature": signature, "X-MB-Project": project}
+
+
+def test_verifier_accepts_valid_request():
+    verifier = HMACVerifier({PROJECT: SECRET})
+
+    assert verifier.verify("POST", CHAT, b"{}", signed_headers(b"{}")) == PROJECT
+
+
+def test_verifier_reads_wsgi_environ_headers():
+    verifier = HMACVerifier({PROJECT: SECRET})
+    environ = {"HTTP_" + k.upper().replace("-", "_"): v for k, v in signed_headers(b"{}").items()}
+
+    assert verifier.verify("POST", CHAT, b"{}", environ) == PROJECT
+
+
+def test_verifier_rejects_replay():
+    verifier = HMACVerifier({PROJECT: SECRET})
+    headers = signed_headers(b"{}")
+    verifier.verify("POST", CHAT, b"{}", headers)
+
+    with pytest.raises(WayGPTError) as info:
+        verifier.verify("POST", CHAT, b"{}", headers)
+
+    assert info.value.status_code == 401
+
+
+@pytest.mark.parametrize("mutate", [
+    lambda h: {**h, "X-MB-Signature": "0" * 64},
+    lambda h: {**h, "X-MB-Nonce": "other"},
+    lambda h: {k: v for k, v in h.items() if k != "X-MB-Nonce"},
+])
+def test_verifier_rejects_tampered_headers(mutate):
+    verifier = HMACVerifier({PROJECT: SECRET})
+
+    with pytest.raises(WayGPTError) as info:
+        verifier.verify("POST", CHAT, b"{}", mutate(signed_headers(b"{}")))
+
+    assert info.value.status_code == 401
+
+
+def test_verifier_rejects_tampered_body():
+    verifier = HMACVerifier({PROJECT: SECRET})
+
+    with pytest.raises(WayGPTError):
+        verifier.verify("POST", CHAT, b'{"model": "expensive"}', signed_headers(b"{}"))
+
+
+def test_verifier_rejects_stale_timestamp():
+    verifier = HMACVerifier({PROJECT: SECRET}, max_skew=300)
+
+    with pytest.raises(WayGPTError):
+        verifier.verify("POST", CHAT, b"{}", signed_headers(b"{}", ts=int(time.time()) - 301))
+
+
+def test_invalid_signature_does_not_burn_nonce():
+    verifier = HMACVerifier({PROJECT: SECRET})
+    with pytest.raises(WayGPTError):
+        verifier.verify("POST", CHAT, b"{}", signed_headers(b"{}", secret="wrong"))
+
+    assert verifier.verify("POST", CHAT, b"{}", signed_headers(b"{}")) == PROJECT
+
+
+class Clock:
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    # Конец корзины: запрос, пришедший в последнюю секунду окна
+    fake = Clock(300.0 * 5_000_000 + 299)
+    monkeypatch.setattr(time, "time", fake)
+    return fake
+
+
+@pytest.fixture(params=["rotating", "bloom", "bloom-shared"])
+def nonce_cache(request, tmp_path):
+    if request.param == "rotating":
+        return RotatingNonceCache(window=300)
+    path = str(tmp_path / "nonces") if request.param == "bloom-shared" else None
+    cache = BloomNonceCache(window=300, capacity=10_000, path=path)
+    request.addfinalizer(cache.close)
+    return cache
+
+
+@pytest.mark.parametrize("replay_after", [1, 302, 590])
+def test_replay_with_future_timestamp_rejected_until_signature_expires(clock, nonce_cache, replay_after):
+    verifier = HMACVerifier({PROJECT: SECRET}, max_skew=300, nonce_cache=nonce_cache)
+    # Часы клиента спешат на 290 с: подпись действительна до ts + 300 = now + 590
+    headers = signed_headers(b"{}", ts=int(clock.now) + 290)
+    verifier.verify("POST", CHAT, b"{}", headers)
+
+    clock.now += replay_after
+    with pytest.raises(WayGPTError) as info:
+        verifier.verify("POST", CHAT, b"{}", headers)
+
+    assert "nonce" in info.value.message
+
+
+def test_replay_after_signature_expiry_fails_on_time_check(clock, nonce_cache):
+    verifier = HMACVerifier({PROJECT: SECRET}, max_skew=300, nonce_cache=nonce_cache)
+    headers = signed_headers(b"{}", ts=int(clock.now) + 290)
+    verifier.verify("POST", CHAT, b"{}", headers)
+
+    clock.now += 591
+    with pytest.raises(WayGPTError, match="устарела"):
+        verifier.verify("POST", CHAT, b"{}", headers)
+
+
+def test_nonce_cache_memory_is_released_after_window(clock):
+    cache = RotatingNonceCache(window=300)
+    for i in range(100):
+        assert cache.check_and_add(f"n{i}", clock.now)
+
+    clock.now += 700
+    cache.check_and_add("fresh", clock.now)
+
+    assert len(cache) == 1
+
+
+def test_shared_bloom_cache_rejects_replay_from_other_worker(tmp_path):
+    path = str(tmp_path / "nonces")
+    first, second = BloomNonceCache(path=path, capacity=10_000), BloomNonceCache(path=path, capacity=10_000)
+    try:
+        now = time.time()
+        assert first.check_and_add("nonce", now)
+        assert not second.check_and_add("nonce", now)
+    finally:
+        first.close()
+        second.close()
+
+
+def test_nonce_cache_window_must_cover_max_skew():
+    with pytest.raises(ValueError):
+        HMACVerifier({PROJECT: SECRET}, max_skew=300, nonce_cache=RotatingNonceCache(window=60))
+
+
+@pytest.mark.parametrize("signature", ["подпись", "é" * 64, "\udcff" * 64], ids=["cyrillic", "latin1", "surrogate"])
+def test_non_ascii_signature_is_rejected(signature):
+    verifier = HMACVerifier({PROJECT: SECRET})
+
+    with pytest.raises(WayGPTError) as info:
+        verifier.verify("POST", CHAT, b"{}", {**signed_headers(b"{}"), "X-MB-Signature": signature})
+
+    assert info.value.status_code == 401
+
+
+class Secrets:
+    """Хранилище секретов с подсчётом обращений"""
+
+    def __init__(self, secrets):
+        self.secrets = dict(secrets)
+        self.lookups = 0
+
+    def __call__(self, project_id):
+        self.lookups += 1
+        return self.secrets.get(project_id)
+
+
+def test_rotated_secret_is_picked_up_on_mismatch():
+    store = Secrets({PROJECT: SECRET})
+    verifier = HMACVerifier(store)
+    verifier.verify("POST", CHAT, b"{}", signed_headers(b"{}", nonce="n1"))
+
+    store.secrets[PROJECT] = "rotated"
+    time.sleep(HMACVerifier._KEY_RECHECK_SECONDS)
+
+    assert verifier.verify("POST", CHAT, b"{}", signed_headers(b"{}", nonce="n2", secret="rotated")) == PROJECT
+    # Старый ключ больше не в кеше
+    with pytest.raises(WayGPTError):
+        verifier.verify("POST", CHAT, b"{}", signed_headers(b"{}", nonce="n3"))
+
+
+def test_bad_signatures_do_not_hammer_secret_lookup():
+    store = Secrets({PROJECT: SECRET})
+    verifier = HMACVerifier(store)
+
+    for i in range(50):
+        with pytest.raises(WayGPTError):
+            verifier.verify("POST", CHAT, b"{}", signed_headers(b"{}", nonce=f"n{i}", secret="wrong"))
+
+    assert store.lookups <= 2
+
+
+def test_secret_is_reread_after_key_ttl():
+    store = Secrets({PROJECT: SECRET})
+    verifier = HMACVerifier(store, key_ttl=0.05)
+    verifier.verify("POST", CHAT, b"{}", signed_headers(b"{}", nonce="n1"))
+    verifier.verify("POST", CHAT, b"{}", signed_headers(b"{}", nonce="n2"))
+    assert store.lookups == 1
+
+    time.sleep(0.06)
+    verifier.verify("POST", CHAT, b"{}", signed_headers(b"{}", nonce="n3"))
+
+    assert store.lookups == 2
+
+
+def test_key_cache_is_bounded():
+    store = Secrets({f"p{i}": f"s{i}" for i in range(10)})
+    verifier = HMACVerifier(store, max_cached_keys=3)
+
+    for i in range(10):
+        verifier.verify("POST", CHAT, b"{}", signed_headers(b"{}", secret=f"s{i}", project=f"p{i}"))
+
+    assert list(verifier._keys) == ["p7", "p8", "p9"]
@@ -0,0 +1,127 @@
+"""IncrementalJSONParser и ChatCompletionStream.json_events()"""
+
+import json
+
+import pytest
+
+from conftest import Reply, sse
+from waygpt_client import IncrementalJSONParser, JSONEvent
+
+CHAT = "/api/v1/waygpt/chat/completions"
+
+
+def feed_all(parser, pieces):
+    events = []
+    for piece in pieces:
+        events.extend(parser.feed(piece))
+    parser.close()
+    return events
+
+
+def by_char(text):
+    return list(text)
+
+
+def test_array_items_emitted_when_closed():
+    parser = IncrementalJSONParser()
+
+    assert parser.feed('[{"id": 1}, {"i') == [JSONEvent("item", 0, {"id": 1})]
+    assert parser.feed('d": 2}]') == [JSONEvent("item", 1, {"id": 2})]
+    parser.close()
+
+
+def test_every_split_point_gives_same_events():
+    doc = [{"name": "a \"quoted\" ]}, [brace", "tags": ["x", "y"]}, "строка\\n", 3.5, None, {"nested": {"deep": [1, [2]]}}]
+    text = json.dumps(doc, ensure_ascii=False)
+
+    for i in range(len(text) + 1):
+        events = feed_all(IncrementalJSONParser(), [text[:i], text[i:]])
+        assert [e.value for e in events] == doc, i
+
+
+def test_escape_split_between_pieces():
+    events = feed_all(IncrementalJSONParser(), ['["a\\', '"b"]'])
+
+    assert events == [JSONEvent("item", 0, 'a"b')]
+
+
+def test_object_fields_emitted_one_by_one():
+    parser = IncrementalJSONParser()
+    text = '{"title": "Каталог", "count": 2, "meta": {"a": [1, 2]}}'
+
+    events = feed_all(parser, by_char(text))
+
+    assert events == [
+        JSONEvent("field", "title", "Каталог"),
+        JSONEvent("field", "count", 2),
+        JSONEvent("field", "meta", {"a": [1, 2]}),
+    ]
+
+
+def test_items_key_streams_array_elements():
+    text = '{"total": 2, "products": [{"sku": "A"}, {"sku": "B"}], "next": null}'
+
+    events = feed_all(IncrementalJSONParser(items_key="products"), by_char(text))
+
+    assert events == [
+        JSONEvent("field", "total", 2),
+        JSONEvent("item", 0, {"sku": "A"}),
+        JSONEvent("item", 1, {"sku": "B"}),
+        JSONEvent("field", "next", None),
+    ]
+
+
+def test_prefix_before_json_is_skipped():
+    events = feed_all(IncrementalJSONParser(), ["```json\n", "[1, 2]", "\n```"])
+
+    assert [e.value for e in events] == [1, 2]
+
+
+def test_close_on_unfinished_json_raises():
+    parser = IncrementalJSONParser()
+    parser.feed('[{"id": 1}, ')
+
+    with pytest.raises(ValueError):
+        parser.close()
+
+
+def test_json_events_from_stream(server, client):
+    text = '[{"sku": "A"}, {"sku": "B"}]'
+    server.route("POST", CHAT, Reply(chunks=sse(*[text[i:i + 5] for i in range(0, len(text), 5)])))
+
+    stream = client.chat_completions_stream(messages=[{"role": "user", "content": "каталог"}])
+    events = list(stream.json_events())
+
+    assert [e.value for e in events] == [{"sku": "A"}, {"sku": "B"}]
+
+
+def test_items_key_keeps_only_current_item_in_memory():
+    products = [{"sku": f"A{i}", "name": "товар \"в кавычках\" [скобки]"} for i in range(2000)]
+    text = json.dumps({"total": 2000, "products": products, "done": True}, ensure_ascii=False)
+    largest = max(len(json.dumps(p, ensure_ascii=False)) for p in products)
+    parser = IncrementalJSONParser(items_key="products")
+
+    events, retained = [], 0
+    for i in range(0, len(text), 13):
+        events.extend(parser.feed(text[i:i + 13]))
+        retained = max(retained, sum(len(part) for part in parser._parts))
+    parser.close()
+
+    assert [e.value for e in events if e.kind == "item"] == products
+    assert events[-1] == JSONEvent("field", "done", True)
+    # В памяти — не больше одного элемента (плюс разделитель), а не весь массив
+    assert retained <= largest + 2
+
+
+def test_random_split_points_with_escapes():
+    import random
+
+    rng = random.Random(34)
+    doc = {"meta": {"q": "a\\b\"c"}, "items": [{"t": "\\u0416 \\\" ] } ,", "n": [1, {"x": "\\"}]} for _ in range(20)]}
+    text = json.dumps(doc)
+    for _ in range(200):
+        cuts = sorted(rng.sample(range(1, len(text)), 30))
+        pieces = [text[a:b] for a, b in zip([0] + cuts, cuts + [len(text)])]
+        events = feed_all(IncrementalJSONParser(items_key="items"), pieces)
+        assert [e.value for e in events if e.kind == "item"] == doc["items"]
+        assert [e for e in events if e.kind == "field"] == [JSONEvent("field", "meta", doc["meta"])]
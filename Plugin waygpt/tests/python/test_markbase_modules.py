@@ -0,0 +1,146 @@
+"""MarkBaseModules: загрузка plugin.json, разбор эндпоинтов, вызовы модулей"""
+
+import json
+
+import pytest
+
+from conftest import Reply
+from waygpt_client import MarkBaseModules, WayGPTError
+
+
+def contract(slug, **endpoints):
+    return {
+        "slug": slug,
+        "name": slug.title(),
+        "version": "1.0.0",
+        "api_base": f"https://{slug}.markbase.ru/api/{slug}/v1",
+        "endpoints": endpoints,
+    }
+
+
+def write_plugin(root, directory, content):
+    (root / directory).mkdir()
+    path = root / directory / "plugin.json"
+    path.write_text(content if isinstance(content, str) else json.dumps(content), encoding="utf-8")
+    return path
+
+
+@pytest.fixture
+def crm(server, client):
+    """Реестр с модулем crm, направленным на тестовый сервер"""
+    return MarkBaseModules(
+        client,
+        [contract(
+            "crm",
+            client_get="GET /api/crm/v1/clients/:id — Карточка клиента",
+            clients_list="GET /api/crm/v1/clients?limit=&offset=",
+            note_add="POST /api/crm/v1/clients/{client_id}/notes/{kind}",
+        )],
+        api_key="mk_test",
+        base_urls={"crm": server.url},
+    )
+
+
+def test_directory_discovery_loads_plugin_json_only(tmp_path, client):
+    write_plugin(tmp_path, "wallet", contract("wallet", balance="GET /api/wallet/v1/balance"))
+    write_plugin(tmp_path, "crm", contract("crm", client_get="GET /api/crm/v1/clients/:id"))
+    (tmp_path / "docs").mkdir()  # каталог без plugin.json
+    (tmp_path / "README.md").write_text("not a plugin")
+
+    modules = client.markbase_modules(str(tmp_path))
+
+    # Каталоги обходятся в отсортированном порядке, независимо от файловой системы
+    assert list(modules.modules) == ["crm", "wallet"]
+    assert modules.crm.base_url == "https://crm.markbase.ru"
+    assert modules["wallet"].version == "1.0.0"
+
+
+def test_plugins_dir_from_environment(tmp_path, client, monkeypatch):
+    write_plugin(tmp_path, "crm", contract("crm", client_get="GET /api/crm/v1/clients/:id"))
+    monkeypatch.setenv("MARKBASE_PLUGINS_DIR", str(tmp_path))
+
+    assert list(client.markbase_modules().modules) == ["crm"]
+
+
+def test_missing_plugins_dir_is_rejected(client, monkeypatch):
+    monkeypatch.delenv("MARKBASE_PLUGINS_DIR", raising=False)
+
+    with pytest.raises(ValueError, match="MARKBASE_PLUGINS_DIR"):
+        client.markbase_modules()
+
+
+@pytest.mark.parametrize("content", ["{broken", "[1, 2]"], ids=["invalid_json", "not_object"])
+def test_broken_plugin_json_names_the_file(tmp_path, client, content):
+    write_plugin(tmp_path, "crm", contract("crm", client_get="GET /api/crm/v1/clients/:id"))
+    write_plugin(tmp_path, "orders", content)
+
+    with pytest.raises(ValueError, match="orders"):
+        client.markbase_modules(str(tmp_path))
+
+
+def test_contracts_without_api_are_skipped(client):
+    modules = MarkBaseModules(client, [
+        {"slug": "landing", "name": "Без API"},
+        {"api_base": "https://x.markbase.ru", "endpoints": {}},
+        {"slug": "widget", "api_base": "https://w.markbase.ru", "endpoints": ["GET /x"]},
+        "not a contract",
+        contract("crm", client_get="GET /api/crm/v1/clients/:id", docs="См. README", relative="GET clients"),
+    ])
+
+    assert list(modules.modules) == ["crm"]
+    assert list(modules.crm.endpoints) == ["client_get"]
+    with pytest.raises(AttributeError, match="landing"):
+        modules.landing
+
+
+def test_endpoint_spec_is_parsed(crm):
+    endpoints = crm.crm.endpoints
+
+    assert endpoints["client_get"].params == ("id",)
+    assert endpoints["client_get"].description == "Карточка клиента"
+    assert endpoints["clients_list"].path == "/api/crm/v1/clients"
+    assert endpoints["clients_list"].query == ("limit", "offset")
+    assert endpoints["note_add"].params == ("client_id", "kind")
+    assert crm.crm.client_get.__doc__ == "GET /api/crm/v1/clients/:id — Карточка клиента"
+
+
+def test_call_builds_path_and_headers(server, crm):
+    server.route("GET", "/api/crm/v1/clients/*", {"id": "a/b"})
+
+    assert crm.crm.client_get("a/b", params={"full": 1}, jwt_token="jwt") == {"id": "a/b"}
+
+    request = server.requests[0]
+    assert request.path == "/api/crm/v1/clients/a%2Fb?full=1"
+    assert request.headers["X-Api-Key"] == "mk_test"
+    assert request.headers["Authorization"] == "Bearer jwt"
+
+
+def test_named_path_params_and_body(server, crm):
+    server.route("POST", "/api/crm/v1/clients/42/notes/call", Reply(204, b""))
+
+    assert crm.crm.call("note_add", "42", kind="call", data={"text": "перезвонить"}) is None
+
+    assert server.requests[0].json() == {"text": "перезвонить"}
+
+
+@pytest.mark.parametrize("args, kwargs, message", [
+    ((), {}, "не указан параметр пути 'id'"),
+    (("1", "2"), {}, "лишние параметры пути"),
+    (("1",), {"unknown": 1}, "неизвестные параметры"),
+])
+def test_wrong_path_params_are_rejected(server, crm, args, kwargs, message):
+    with pytest.raises(TypeError, match=message):
+        crm.crm.client_get(*args, **kwargs)
+    assert server.requests == []
+
+
+def test_module_errors_are_counted(server, client, crm):
+    server.route("GET", "/api/crm/v1/clients/*", Reply(404, {"detail": "Клиент не найден"}))
+
+    with pytest.raises(WayGPTError, match="Клиент не найден") as error:
+        crm.crm.client_get("1")
+
+    assert error.value.status_code == 404
+    assert crm.stats()["crm.client_get"]["errors"] == 1
+    stats = client.get_stats()
+    assert (stats["module_requests"], stats["module_errors"]) == (1, 1)
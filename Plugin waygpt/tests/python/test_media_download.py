@@ -0,0 +1,115 @@
+"""Сохранение медиа на диск: скачивание по URL, base64, докачка .part"""
+
+import base64
+import os
+
+import pytest
+
+from conftest import Reply
+from waygpt_client import WayGPTError
+
+DATA = bytes(range(256)) * 400
+
+
+def serve_file(server, path, data=DATA):
+    """Файл с поддержкой Range: bytes=N-"""
+
+    def handler(request):
+        requested = request.headers.get("Range")
+        if not requested:
+            return Reply(body=data, headers={"Content-Type": "image/png"})
+        offset = int(requested.split("=")[1].rstrip("-"))
+        if offset >= len(data):
+            return Reply(416, b"", headers={"Content-Range": f"bytes */{len(data)}"})
+        return Reply(206, data[offset:], headers={
+            "Content-Type": "image/png",
+            "Content-Range": f"bytes {offset}-{len(data) - 1}/{len(data)}",
+        })
+
+    server.route("GET", path, handler)
+
+
+def test_save_media_downloads_all_items(server, client, tmp_path):
+    serve_file(server, "/files/a.png")
+    serve_file(server, "/files/b", DATA[::-1])
+    result = {"data": [{"url": f"{server.url}/files/a.png"}, {"url": f"{server.url}/files/b"}]}
+
+    paths = client.save_media(result, str(tmp_path), prefix="img")
+
+    assert [os.path.basename(p) for p in paths] == ["img_0.png", "img_1.png"]
+    assert open(paths[0], "rb").read() == DATA
+    assert open(paths[1], "rb").read() == DATA[::-1]
+    assert not [name for name in os.listdir(tmp_path) if name.endswith(".part")]
+    assert client.get_stats()["media_files_saved"] == 2
+
+
+def test_relative_url_is_fetched_with_project_auth(server, client, tmp_path):
+    serve_file(server, "/api/v1/waygpt/media/files/1.png")
+
+    client.save_media({"url": "/api/v1/waygpt/media/files/1.png"}, str(tmp_path))
+
+    assert server.requests[0].headers["x-project-key"] == "test-project-key"
+
+
+@pytest.mark.parametrize("wrap", [0, 76, 3])
+def test_b64_with_line_breaks_is_decoded(client, tmp_path, wrap):
+    encoded = base64.b64encode(DATA[:1001]).decode()
+    if wrap:
+        encoded = "\n".join(encoded[i:i + wrap] for i in range(0, len(encoded), wrap)) + "\r\n"
+    client._MEDIA_CHUNK_SIZE = 1000  # границы блоков внутри строк и четвёрок символов
+
+    [path] = client.save_media({"b64_json": "data:image/png;base64," + encoded}, str(tmp_path))
+
+    assert path.endswith(".png")
+    assert open(path, "rb").read() == DATA[:1001]
+
+
+def test_truncated_b64_is_rejected(client, tmp_path):
+    encoded = base64.b64encode(DATA[:1000]).decode()[:-1]
+
+    with pytest.raises(WayGPTError, match="base64"):
+        client.save_media({"b64_json": encoded}, str(tmp_path))
+
+
+def test_partial_file_is_resumed(server, client, tmp_path):
+    serve_file(server, "/files/a.png")
+    (tmp_path / "media_0.part").write_bytes(DATA[:5000])
+
+    [path] = client.save_media({"url": f"{server.url}/files/a.png"}, str(tmp_path))
+
+    assert server.requests[0].headers["Range"] == "bytes=5000-"
+    assert open(path, "rb").read() == DATA
+    assert client.get_stats()["media_resumed"] == 1
+
+
+def test_complete_partial_file_is_accepted_on_416(server, client, tmp_path):
+    serve_file(server, "/files/a.png")
+    (tmp_path / "media_0.part").write_bytes(DATA)
+
+    [path] = client.save_media({"url": f"{server.url}/files/a.png"}, str(tmp_path))
+
+    assert len(server.requests) == 1
+    assert open(path, "rb").read() == DATA
+
+
+def test_oversized_partial_file_is_downloaded_again_on_416(server, client, tmp_path):
+    # .part от другого (большего) файла: 416 не подтверждает его размер
+    serve_file(server, "/files/a.png")
+    (tmp_path / "media_0.part").write_bytes(DATA + b"junk")
+
+    [path] = client.save_media({"url": f"{server.url}/files/a.png"}, str(tmp_path))
+
+    assert [r.headers.get("Range") for r in server.requests] == [f"bytes={len(DATA) + 4}-", None]
+    assert open(path, "rb").read() == DATA
+
+
+def test_incomplete_download_keeps_part_file(server, client, tmp_path):
+    server.route("GET", "/files/a.png", Reply(206, DATA[100:200], headers={
+        "Content-Range": f"bytes 100-199/{len(DATA)}",
+    }))
+    (tmp_path / "media_0.part").write_bytes(DATA[:100])
+
+    with pytest.raises(WayGPTError, match="не полностью"):
+        client.save_media({"url": f"{server.url}/files/a.png"}, str(tmp_path))
+
+    assert (tmp_path / "media_0.part").read_bytes() == DATA[:200]
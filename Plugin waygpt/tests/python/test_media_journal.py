@@ -0,0 +1,157 @@
+"""MediaJobJournal: отправка задач медиа с журналом и сверкой неизвестного результата"""
+
+import sqlite3
+import time
+
+import pytest
+
+from conftest import Reply
+from waygpt_client import MediaJobJournal, WayGPTError
+
+VIDEOS = "/api/v1/waygpt/videos/generations"
+JOBS = "/api/v1/waygpt/media/jobs"
+
+
+@pytest.fixture
+def journal(client, tmp_path):
+    # Без фонового потока: опрос выполняет сам тест (poll/wait)
+    journal = MediaJobJournal(client, str(tmp_path / "jobs.sqlite3"), poll_interval=0.01)
+    yield journal
+    journal.close()
+
+
+def posts(server):
+    return [r for r in server.requests if r.method == "POST"]
+
+
+def test_request_matches_client_and_carries_idempotency_key(server, client, journal):
+    server.route("POST", VIDEOS, {"job_id": "job-1", "status": "queued"})
+
+    client.video_generations(prompt="Закат", model="veo", duration=5, fps=24)
+    entry = journal.video_generations(prompt="Закат", model="veo", duration=5, fps=24)
+
+    direct, journaled = (r.json() for r in posts(server))
+    key = journaled.pop("idempotency_key")
+    assert journaled == direct
+    assert entry["idempotency_key"] == key and entry["request"] == direct
+    assert entry["job_id"] == "job-1" and entry["status"] == "queued"
+
+
+def test_client_error_marks_failed(server, journal):
+    server.route("POST", VIDEOS, Reply(422, {"detail": "bad duration"}))
+
+    with pytest.raises(WayGPTError):
+        journal.video_generations(prompt="Закат")
+    with pytest.raises(WayGPTError):
+        journal.video_generations(prompt="Закат")
+
+    assert [j["status"] for j in journal.jobs()] == ["failed", "failed"]
+    assert len(posts(server)) == 2  # неудачная отправка не объединяется
+
+
+def test_server_error_is_unknown_and_reconciled(server, journal):
+    server.route("POST", VIDEOS, Reply(500, {"detail": "upstream timeout"}))
+
+    with pytest.raises(WayGPTError):
+        journal.video_generations(prompt="Закат")
+
+    entry, = journal.jobs()
+    assert entry["status"] == "unknown" and entry["finished_at"] is None
+    # Повтор тех же параметров не создаёт вторую (платную) задачу
+    assert journal.video_generations(prompt="Закат")["deduplicated"] is True
+    assert len(posts(server)) == 1
+
+    key = posts(server)[0].json()["idempotency_key"]
+    server.route("GET", JOBS, lambda request: [{"id": "job-7", "status": "processing", "idempotency_key": key}]
+                 if key in request.path else [])
+    server.route("GET", JOBS + "/job-7", {"id": "job-7", "status": "completed", "data": [{"url": "/f.mp4"}]})
+
+    journal.poll()
+    entry, = journal.jobs()
+    assert (entry["job_id"], entry["status"]) == ("job-7", "processing")
+
+    done = journal.wait(entry["id"], timeout=5)
+    assert done["status"] == "completed"
+    assert journal.stats()["reconciled"] == 1
+
+
+def submit_unknown(server, journal):
+    """Отправка, после которой неизвестно, создана ли задача"""
+    server.route("POST", VIDEOS, Reply(503, {"detail": "busy"}))
+    with pytest.raises(WayGPTError):
+        journal.video_generations(prompt="Закат")
+
+
+@pytest.mark.parametrize("listed", [
+    {"data": []},
+    # Фильтр не поддерживается: API вернул чужие задачи без idempotency_key
+    [{"id": "job-1", "status": "completed"}, {"id": "job-2", "status": "processing"}],
+    [{"id": "job-3", "status": "completed", "idempotency_key": "other"}],
+], ids=["empty", "without_key", "other_key"])
+def test_unconfirmed_job_stays_unknown(server, client, tmp_path, listed):
+    reported = []
+    journal = MediaJobJournal(client, str(tmp_path / "jobs.sqlite3"), on_finish=reported.append)
+    submit_unknown(server, journal)
+    server.route("GET", JOBS, listed)
+
+    finished = journal.poll()
+
+    assert [(e["status"], e["job_id"]) for e in finished] == [("unknown", None)]
+    assert "idempotency_key" in finished[0]["error"]
+    assert reported == finished
+    stats = journal.stats()
+    assert (stats["reconciled"], stats["unconfirmed"]) == (0, 1)
+    # Повтор не отправляется: задача могла быть создана и оплачена
+    assert journal.video_generations(prompt="Закат")["deduplicated"] is True
+    journal.close()
+
+
+def test_reconcile_unsupported_keeps_unknown(server, journal):
+    server.route("POST", VIDEOS, Reply(500, {"detail": "boom"}))
+    with pytest.raises(WayGPTError):
+        journal.video_generations(prompt="Закат")
+
+    finished = journal.poll()  # список задач не поддерживается: 404
+
+    assert [e["status"] for e in finished] == ["unknown"]
+    assert finished[0]["finished_at"] is not None
+    assert journal.video_generations(prompt="Закат")["deduplicated"] is True
+
+
+def test_crashed_submission_is_reconciled_after_timeout(server, client, tmp_path):
+    path = str(tmp_path / "jobs.sqlite3")
+    with MediaJobJournal(client, path, submit_timeout=0) as journal:
+        journal._db.execute(
+            "INSERT INTO media_jobs (kind, request_hash, request, status, submitted_at, updated_at, idempotency_key) "
+            "VALUES ('video', 'h', '{}', 'submitting', ?, ?, 'k1')",
+            (time.time() - 1, time.time() - 1),
+        )
+        server.route("GET", JOBS, [{"job_id": "job-9", "status": "completed", "idempotency_key": "k1"}])
+
+        finished = journal.poll()
+
+    assert [(e["job_id"], e["status"]) for e in finished] == [("job-9", "completed")]
+
+
+def test_opens_journal_of_previous_version(client, tmp_path):
+    path = str(tmp_path / "old.sqlite3")
+    db = sqlite3.connect(path)
+    db.execute(
+        "CREATE TABLE media_jobs (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, request_hash TEXT NOT NULL, "
+        "request TEXT NOT NULL, job_id TEXT, status TEXT NOT NULL, response TEXT, error TEXT, "
+        "submitted_at REAL NOT NULL, updated_at REAL NOT NULL, finished_at REAL)"
+    )
+    db.execute(
+        "INSERT INTO media_jobs (kind, request_hash, request, status, submitted_at, updated_at) "
+        "VALUES ('video', 'h', '{}', 'submitting', 0, 0)"
+    )
+    db.commit()
+    db.close()
+
+    journal = MediaJobJournal(client, path, submit_timeout=0)
+    try:
+        finished = journal.poll()
+    finally:
+        journal.close()
+
+    assert [e["status"] for e in finished] == ["unknown"]
@@ -0,0 +1,124 @@
+"""ModelRouter: выбор модели для model="auto" по метрикам и политике"""
+
+import threading
+import time
+
+import pytest
+
+from conftest import Reply, sse
+from waygpt_client import WayGPTError
+
+CHAT = "/api/v1/waygpt/chat/completions"
+MODELS = "/api/v1/waygpt/models/full"
+USE_CASES = "/api/v1/waygpt/use-cases"
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+@pytest.fixture
+def metadata(server):
+    server.route("GET", MODELS, [{"id": "cheap", "price": 1}, {"id": "pricey", "price": 10}])
+    server.route("GET", USE_CASES, [])
+    return server
+
+
+def chat_requests(server):
+    return [r for r in server.requests if r.path == CHAT]
+
+
+def test_cost_ceiling_without_candidates_raises(metadata, client):
+    client.enable_model_router(policy="cost_ceiling", max_cost=0.5)
+
+    with pytest.raises(WayGPTError, match="max_cost"):
+        client.chat_completions(messages=MESSAGES, model="auto")
+    with pytest.raises(WayGPTError, match="max_cost"):
+        client.chat_completions_stream(messages=MESSAGES, model="auto")
+
+    assert chat_requests(metadata) == []
+
+
+def test_cost_ceiling_picks_allowed_model(metadata, client):
+    metadata.route("POST", CHAT, {"choices": [{"message": {"content": "ok"}}]})
+    client.enable_model_router(policy="cost_ceiling", max_cost=5)
+
+    client.chat_completions(messages=MESSAGES, model="auto")
+
+    assert chat_requests(metadata)[0].json()["model"] == "cheap"
+
+
+def test_client_errors_do_not_count_against_model(metadata, client):
+    router = client.enable_model_router(max_attempts=1)
+    metadata.route("POST", CHAT, Reply(400, {"detail": "bad request"}))
+
+    for call in (client.chat_completions, lambda **kw: list(client.chat_completions_stream(**kw))):
+        with pytest.raises(WayGPTError):
+            call(messages=MESSAGES, model="auto")
+
+    assert router.stats()["models"] == {}
+
+    metadata.route("POST", CHAT, Reply(500, {"detail": "boom"}))
+    with pytest.raises(WayGPTError):
+        client.chat_completions(messages=MESSAGES, model="auto")
+
+    (model, health), = router.stats()["models"].items()
+    assert health["error_rate"] > 0
+
+
+def test_streams_rank_by_ttft_and_calls_by_latency(metadata, client):
+    router = client.enable_model_router(explore_every=0)
+    router.observe("cheap", latency=5.0, ttft=0.1)
+    router.observe("pricey", latency=1.0, ttft=0.5)
+
+    assert router.rank(stream=True) == ["cheap", "pricey"]
+    assert router.rank(stream=False) == ["pricey", "cheap"]
+
+
+def test_stream_observation_feeds_ttft(metadata, client):
+    router = client.enable_model_router(max_attempts=1)
+    metadata.route("POST", CHAT, Reply(chunks=sse("a", "b")))
+
+    list(client.chat_completions_stream(messages=MESSAGES, model="auto"))
+
+    (model, health), = router.stats()["models"].items()
+    assert health["ttft"] is not None and health["error_rate"] == 0
+
+
+def test_concurrent_refresh_is_single_flight(server, client):
+    def models(request):
+        time.sleep(0.2)
+        return [{"id": "m1"}]
+
+    server.route("GET", MODELS, models)
+    server.route("GET", USE_CASES, [])
+    router = client.enable_model_router(refresh_interval=60)
+
+    def count():
+        return sum(r.path == MODELS for r in server.requests)
+
+    # Первая загрузка: все ждут один запрос
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(router.candidates())) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert results == [["m1"]] * 8
+    assert count() == 1
+
+    # Устаревшие метаданные: обновляет один поток, остальные сразу получают старые
+    router._loaded_at -= 120
+    started = time.monotonic()
+    waits = []
+
+    def timed():
+        t0 = time.monotonic()
+        router.candidates()
+        waits.append(time.monotonic() - t0)
+
+    threads = [threading.Thread(target=timed) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert count() == 2
+    assert sorted(waits)[-2] < 0.1
+    assert time.monotonic() - started < 1.0
@@ -0,0 +1,160 @@
+"""StreamMulticast: буфер повтора, политики backpressure, отключение подписчиков"""
+
+import asyncio
+import contextlib
+import threading
+
+import pytest
+
+from conftest import Reply, sse
+from waygpt_client import StreamDelta, StreamMulticast, WayGPTError, merge_chat_chunks
+
+CHAT = "/api/v1/waygpt/chat/completions"
+
+
+def chunk(text, finish_reason=None):
+    return {"choices": [{"index": 0, "delta": {"content": text}, "finish_reason": finish_reason}]}
+
+
+def texts(chunks):
+    return [c["choices"][0]["delta"]["content"] for c in chunks]
+
+
+def pumped(source, **kwargs):
+    """Подписчик, который начинает читать только после того, как upstream прочитан целиком"""
+    mc = StreamMulticast(iter(source), **kwargs)
+    sub = mc.subscribe()
+    mc._thread.join(timeout=5)
+    return mc, sub
+
+
+def test_all_subscribers_get_every_chunk(server, client):
+    server.route("POST", CHAT, Reply(chunks=sse("a", "b", "c")))
+
+    mc = client.chat_completions_multicast(messages=[{"role": "user", "content": "hi"}])
+    first, second = mc.subscribe(), mc.subscribe()
+
+    assert texts(first) == texts(second) == ["a", "b", "c"]
+    assert len(server.requests) == 1
+
+
+def test_late_subscriber_gets_replay_buffer():
+    mc, _ = pumped([chunk(t) for t in "abcde"], replay_size=3)
+
+    late = mc.subscribe()
+
+    assert texts(late) == ["c", "d", "e"]
+    assert late.missed_prefix
+
+
+def test_coalesce_merges_overflow_into_last_chunk():
+    source = [chunk(t) for t in "abcde"]
+    mc, sub = pumped(source, subscriber_buffer=2, backpressure="coalesce")
+
+    assert texts(sub) == ["a", "bcde"]
+    assert mc.stats()["coalesced"] == 3
+    # Общие чанки не меняются при слиянии: их видят другие подписчики и буфер повтора
+    assert texts(source) == list("abcde")
+
+
+def test_coalesce_merges_typed_deltas(server, client):
+    finish = b'data: {"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}\n\n'
+    server.route("POST", CHAT, Reply(chunks=sse("a", "b", "c", done=False) + [finish, b"data: [DONE]\n\n"]))
+
+    mc = client.chat_completions_multicast(
+        messages=[{"role": "user", "content": "hi"}], typed=True, subscriber_buffer=1,
+    )
+    mc._thread.join(timeout=5)
+    # Буфер повтора (4 чанка) не помещается в очередь из одного чанка и сливается
+    received = list(mc.subscribe())
+
+    assert [(d.content, d.finish_reason) for d in received] == [("abc", "stop")]
+
+
+def test_merge_typed_deltas():
+    merged = merge_chat_chunks(StreamDelta("Прив"), StreamDelta("ет", "stop"))
+
+    assert (merged.content, merged.finish_reason) == ("Привет", "stop")
+
+
+def test_drop_oldest_discards_old_chunks():
+    mc, sub = pumped([chunk(t) for t in "abcde"], subscriber_buffer=2, backpressure="drop_oldest")
+
+    assert texts(sub) == ["d", "e"]
+    assert mc.stats()["discarded"] == 3
+
+
+def test_disconnect_drops_slow_subscriber():
+    mc, sub = pumped([chunk(t) for t in "abcde"], subscriber_buffer=2, backpressure="disconnect")
+
+    with pytest.raises(WayGPTError, match="не успевает"):
+        list(sub)
+    assert mc.stats()["dropped_subscribers"] == 1
+
+
+def test_unknown_policy_is_rejected():
+    with pytest.raises(ValueError):
+        StreamMulticast(iter([]), backpressure="block")
+
+
+def gated_source(gate):
+    yield chunk("a")
+    gate.wait(timeout=5)
+    yield chunk("b")
+    yield chunk("c")
+
+
+def test_subscriber_can_leave_mid_stream():
+    gate = threading.Event()
+    mc = StreamMulticast(gated_source(gate))
+    leaving, staying = mc.subscribe(), mc.subscribe()
+
+    assert texts([next(leaving)]) == ["a"]
+    leaving.close()
+    gate.set()
+
+    assert texts(staying) == ["a", "b", "c"]
+    assert list(leaving) == []
+    assert mc.stats()["subscribers"] == 1
+
+
+def test_subscriber_with_closed_event_loop_is_detached():
+    gate = threading.Event()
+    mc = StreamMulticast(gated_source(gate))
+    abandoned, staying = mc.subscribe(), mc.subscribe()
+
+    async def read_then_give_up():
+        await abandoned.__anext__()
+        # Ожидание следующего чанка прерывается, и loop закрывается вместе с asyncio.run
+        with contextlib.suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(abandoned.__anext__(), 0.05)
+
+    asyncio.run(read_then_give_up())
+    gate.set()
+
+    assert texts(staying) == ["a", "b", "c"]
+    stats = mc.stats()
+    assert stats["dropped_subscribers"] == 1
+    assert stats["finished"]
+
+
+def test_async_subscriber_reads_stream(server, client):
+    server.route("POST", CHAT, Reply(chunks=sse("a", "b")))
+    mc = client.chat_completions_multicast(messages=[{"role": "user", "content": "hi"}])
+
+    async def read():
+        return [c async for c in mc.subscribe()]
+
+    assert texts(asyncio.run(read())) == ["a", "b"]
+
+
+def test_upstream_error_reaches_subscribers():
+    def failing():
+        yield chunk("a")
+        raise WayGPTError("upstream")
+
+    mc, sub = pumped(failing())
+
+    assert texts([next(sub)]) == ["a"]
+    with pytest.raises(WayGPTError, match="upstream"):
+        next(sub)
@@ -0,0 +1,155 @@
+"""RequestScheduler: строгий приоритет, справедливая очередь по use_case, резерв мест"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+from conftest import Reply, sse
+from waygpt_client import ASGIStreamProxy, RequestScheduler, WayGPTError
+
+CHAT = "/api/v1/waygpt/chat/completions"
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "условие не выполнилось"
+        time.sleep(0.005)
+
+
+def queue_in_order(scheduler, requests):
+    """
+    Ставит запросы в очередь по одному, пока место занято; после release() возвращает
+    порядок, в котором они получили место
+
+    Args:
+        requests: [(priority, use_case)]
+    """
+    admitted = []
+    holder = scheduler.acquire()
+
+    def request(priority, use_case):
+        with scheduler.priority(priority):
+            ticket = scheduler.acquire(use_case)
+        admitted.append(use_case or priority)
+        scheduler.release(ticket)
+
+    threads = []
+    for i, (priority, use_case) in enumerate(requests, start=1):
+        thread = threading.Thread(target=request, args=(priority, use_case))
+        thread.start()
+        threads.append(thread)
+        wait_for(lambda: sum(s["queued"] for s in scheduler.stats().values()) == i)
+    scheduler.release(holder)
+    for thread in threads:
+        thread.join(timeout=5)
+    return admitted
+
+
+def test_interactive_overtakes_queued_batch():
+    scheduler = RequestScheduler(max_concurrency=1, reserved=0)
+
+    admitted = queue_in_order(scheduler, [("batch", None)] * 3 + [("interactive", None)])
+
+    assert admitted == ["interactive", "batch", "batch", "batch"]
+    assert scheduler.stats()["interactive"]["preempted"] == 1
+
+
+def test_use_cases_share_slots_by_weight():
+    scheduler = RequestScheduler(max_concurrency=1, reserved=0, weights={"reports": 2})
+
+    admitted = queue_in_order(scheduler, [("batch", "extract")] * 4 + [("batch", "reports")] * 4)
+
+    # Виртуальное время после занявшего место запроса — 1. Метки окончания:
+    # extract 2, 3, 4, 5; reports 1.5, 2, 2.5, 3 (при равенстве раньше тот, кто встал раньше)
+    assert admitted == ["reports", "extract", "reports", "reports", "extract", "reports", "extract", "extract"]
+
+
+def test_flooding_use_case_does_not_starve_others():
+    scheduler = RequestScheduler(max_concurrency=1, reserved=0)
+
+    admitted = queue_in_order(scheduler, [("batch", "bulk")] * 6 + [("batch", "single")])
+
+    assert admitted.index("single") == 1
+
+
+def test_reserved_slots_are_kept_for_interactive():
+    scheduler = RequestScheduler(max_concurrency=2, reserved=1, queue_timeout=0.05)
+    batch = scheduler.acquire()
+
+    with pytest.raises(WayGPTError, match="не дождался"):
+        scheduler.acquire()
+    with scheduler.priority("interactive"):
+        interactive = scheduler.acquire()
+
+    stats = scheduler.stats()
+    assert (stats["batch"]["running"], stats["interactive"]["running"]) == (1, 1)
+    assert stats["batch"]["timeouts"] == 1
+    scheduler.release(batch)
+    scheduler.release(interactive)
+
+
+def test_use_case_priorities_and_unknown_class():
+    scheduler = RequestScheduler(use_case_priorities={"support_chat": "interactive"})
+
+    scheduler.release(scheduler.acquire("support_chat"))
+
+    assert scheduler.stats()["interactive"]["admitted"] == 1
+    with pytest.raises(ValueError):
+        scheduler.priority("urgent")
+    with pytest.raises(ValueError):
+        RequestScheduler(use_case_priorities={"x": "urgent"})
+
+
+def test_finished_use_cases_do_not_accumulate():
+    scheduler = RequestScheduler()
+
+    for i in range(100):
+        scheduler.release(scheduler.acquire(f"tenant-{i}"))
+
+    assert scheduler._last_tag == {"interactive": {}, "batch": {}}
+
+
+def test_client_requests_go_through_scheduler(server, client):
+    server.route("POST", CHAT, {"choices": [{"message": {"content": "ok"}}]})
+    scheduler = client.enable_scheduler(use_case_priorities={"support_chat": "interactive"})
+
+    client.chat_completions(messages=[{"role": "user", "content": "hi"}], use_case="support_chat")
+    with scheduler.priority("interactive"):
+        client.chat_completions(messages=[{"role": "user", "content": "hi"}], use_case="reports")
+    client.chat_completions(messages=[{"role": "user", "content": "hi"}], use_case="reports")
+
+    stats = scheduler.stats()
+    assert (stats["interactive"]["admitted"], stats["batch"]["admitted"]) == (2, 1)
+    assert stats["batch"]["running"] == stats["interactive"]["running"] == 0
+
+
+def test_asgi_proxy_keeps_request_priority(server, client):
+    server.route("POST", CHAT, Reply(chunks=sse("a", "b")))
+    scheduler = client.enable_scheduler()
+    proxy = ASGIStreamProxy(client)
+    sent = []
+
+    async def run():
+        messages = [{"type": "http.request", "body": b'{"messages": [{"role": "user", "content": "hi"}]}'}]
+
+        async def receive():
+            if messages:
+                return messages.pop(0)
+            await asyncio.sleep(10)
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+
+        # Приоритет задаёт middleware приложения до вызова прокси
+        with scheduler.priority("interactive"):
+            await proxy({"type": "http", "method": "POST", "headers": []}, receive, send)
+
+    asyncio.run(run())
+
+    assert sent[0]["status"] == 200
+    assert scheduler.stats()["interactive"]["admitted"] == 1
+    assert scheduler.stats()["batch"]["admitted"] == 0
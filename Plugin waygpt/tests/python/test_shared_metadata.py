@@ -0,0 +1,163 @@
+"""SharedMetadataCache: общий снимок метаданных для воркеров хоста"""
+
+import pytest
+
+from conftest import Reply
+from waygpt_client import WayGPTError
+
+MODELS = "/api/v1/waygpt/models/full"
+USE_CASES = "/api/v1/waygpt/use-cases"
+PROJECT = "/api/v1/client/projects/p1/settings"
+
+
+@pytest.fixture
+def routes(server):
+    server.route("GET", MODELS, [{"id": "m1", "input_price": 1}])
+    server.route("GET", USE_CASES, [{"key": "support", "config": {"models": [{"model_id": "m1"}]}}])
+    server.route("GET", PROJECT, {"id": "p1", "name": "Проект"})
+    return server
+
+
+def paths(server):
+    return [r.path.split("?")[0] for r in server.requests]
+
+
+def test_client_methods_read_the_snapshot(routes, make_client, tmp_path):
+    path = str(tmp_path / "meta")
+    workers = [make_client() for _ in range(3)]
+    caches = [w.shared_metadata(path, jwt_token="jwt", project_ids=["p1"]) for w in workers]
+    try:
+        for worker in workers:
+            assert worker.get_models_full() == [{"id": "m1", "input_price": 1}]
+            assert worker.get_use_cases(detailed=True)[0]["key"] == "support"
+            assert worker.client_get_project("p1", "jwt")["name"] == "Проект"
+            worker.enable_model_router()
+
+        # Снимок загрузил один воркер, остальные и роутеры читают его
+        assert sorted(paths(routes)) == sorted([MODELS, USE_CASES, PROJECT])
+
+        # Другой токен (другой пользователь) и краткий список сценариев — мимо снимка
+        workers[0].client_get_project("p1", "other-jwt")
+        workers[0].get_use_cases()
+        assert paths(routes)[3:] == [PROJECT, USE_CASES]
+        assert routes.requests[3].headers["Authorization"] == "Bearer other-jwt"
+    finally:
+        for cache in caches:
+            cache.close()
+
+
+def test_replaced_mapping_is_closed(routes, client, tmp_path):
+    cache = client.shared_metadata(str(tmp_path / "meta"), check_interval=0)
+    try:
+        cache.models()
+        old = cache._snapshot
+
+        cache.refresh(force=True)
+
+        assert cache._snapshot is not old
+        assert old.retired and old.buf.closed
+        assert cache.models() == [{"id": "m1", "input_price": 1}]
+    finally:
+        cache.close()
+    assert cache._snapshot is None
+
+
+class SlowBuffer:
+    """mmap, во время чтения которого выполняется on_read (подмена снимка другим процессом)"""
+
+    def __init__(self, buf, on_read):
+        self.buf = buf
+        self.on_read = on_read
+
+    def __getitem__(self, key):
+        self.on_read()
+        return self.buf[key]
+
+    def __len__(self):
+        return len(self.buf)
+
+    def close(self):
+        self.buf.close()
+
+    @property
+    def closed(self):
+        return self.buf.closed
+
+
+def test_mapping_in_use_is_closed_by_last_reader(routes, client, tmp_path, monkeypatch):
+    path = str(tmp_path / "meta")
+    cache = client.shared_metadata(path, check_interval=0)
+    other = client.shared_metadata(path, check_interval=0)
+    try:
+        cache.models()
+        old = cache._snapshot
+        seen = []
+
+        def replace_snapshot():
+            other.refresh(force=True)
+            cache._reload()
+            seen.append((old.readers, old.retired, old.buf.closed))
+
+        old.buf = SlowBuffer(old.buf, replace_snapshot)
+        old.decoded.clear()
+        monkeypatch.setattr(cache, "_current", lambda: old)
+
+        assert cache.get("models") == [{"id": "m1", "input_price": 1}]
+
+        # Во время чтения снимок заменён, но не закрыт; закрыл его сам читатель
+        assert seen == [(1, True, False)]
+        assert old.buf.closed
+    finally:
+        other.close()
+        cache.close()
+
+
+def test_client_methods_return_copies(routes, client, tmp_path):
+    cache = client.shared_metadata(str(tmp_path / "meta"), jwt_token="jwt", project_ids=["p1"])
+    try:
+        client.get_models_full()[0]["input_price"] = 100
+        client.get_use_cases(detailed=True).clear()
+        client.client_get_project("p1", "jwt")["name"] = "Изменён"
+
+        assert client.get_models_full() == [{"id": "m1", "input_price": 1}]
+        assert len(client.get_use_cases(detailed=True)) == 1
+        assert client.client_get_project("p1", "jwt")["name"] == "Проект"
+        # Сам кеш отдаёт общий (только для чтения) объект без копирования
+        assert cache.models() is cache.models()
+        assert client.get_models_full() is not cache.models()
+    finally:
+        cache.close()
+
+
+def test_failed_first_refresh_is_not_an_empty_snapshot(server, client, tmp_path):
+    server.route("GET", MODELS, Reply(403, {"detail": "forbidden"}))
+    cache = client.shared_metadata(str(tmp_path / "meta"), check_interval=0, retry_interval=60)
+    try:
+        with pytest.raises(WayGPTError) as first:
+            client.get_models_full()
+        # До retry_interval API не запрашивается, но ошибка не превращается в []
+        with pytest.raises(WayGPTError, match="Метаданные недоступны") as repeated:
+            client.get_models_full()
+        with pytest.raises(WayGPTError):
+            cache.get("use_cases", default={})
+
+        assert first.value.status_code == repeated.value.status_code == 403
+        assert len(server.requests) == 1
+        assert cache.stats()["refresh_errors"] == 1
+    finally:
+        cache.close()
+
+
+def test_refresh_is_retried_after_interval(server, client, tmp_path):
+    replies = iter([Reply(403, {"detail": "forbidden"})])
+    server.route("GET", MODELS, lambda request: next(replies, [{"id": "m1"}]))
+    server.route("GET", USE_CASES, [])
+    cache = client.shared_metadata(str(tmp_path / "meta"), check_interval=0, retry_interval=0)
+    try:
+        with pytest.raises(WayGPTError):
+            cache.models()
+
+        assert cache.models() == [{"id": "m1"}]
+        assert cache.version == 1
+    finally:
+        cache.close()
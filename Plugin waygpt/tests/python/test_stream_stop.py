@@ -0,0 +1,79 @@
+"""Досрочная остановка стрима: stop_sequences, stop_when, cancel()"""
+
+import threading
+import time
+
+import pytest
+
+from conftest import Reply, sse
+
+CHAT = "/api/v1/waygpt/chat/completions"
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+def contents(stream):
+    return [chunk["choices"][0]["delta"]["content"] for chunk in stream]
+
+
+@pytest.mark.parametrize("typed", [False, True])
+def test_stop_sequence_split_across_chunks_is_not_leaked(server, client, typed):
+    server.route("POST", CHAT, Reply(chunks=sse("ответ\n", "\n#", "##", " лишнее")))
+
+    stream = client.chat_completions_stream(messages=MESSAGES, stop_sequences=["\n\n###"], typed=typed)
+    texts = [c.content if typed else c["choices"][0]["delta"]["content"] for c in stream]
+
+    assert "".join(texts) == "ответ"
+    assert all("#" not in t and not t.endswith("\n") for t in texts)
+    assert stream.stop_reason == "stop_sequence"
+    assert stream.stats()["chars"] == len("ответ")
+
+
+def test_held_back_text_is_released(server, client):
+    # Начало stop-последовательности, которое ею не стало, отдаётся со следующим чанком или в конце
+    server.route("POST", CHAT, Reply(chunks=sse("a\n", "\nb", "c\n\n#")))
+
+    stream = client.chat_completions_stream(messages=MESSAGES, stop_sequences=["\n\n###"])
+    texts = contents(stream)
+
+    assert texts == ["a", "\n\nb", "c", "\n\n#"]
+    assert stream.stop_reason == "done"
+
+
+def test_held_back_text_goes_into_finish_chunk(server, client):
+    finish = b'data: {"choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}\n\n'
+    server.route("POST", CHAT, Reply(chunks=sse("end#", done=False) + [finish, b"data: [DONE]\n\n"]))
+
+    chunks = list(client.chat_completions_stream(messages=MESSAGES, stop_sequences=["##"]))
+
+    assert [c["choices"][0]["delta"].get("content") for c in chunks] == ["end", "#"]
+    assert chunks[-1]["choices"][0]["finish_reason"] == "stop"
+
+
+def test_text_is_collected_only_for_stop_when(server, client):
+    server.route("POST", CHAT, Reply(chunks=sse('{"a"', ": 1}", "tail")))
+
+    plain = client.chat_completions_stream(messages=MESSAGES)
+    assert contents(plain) == ['{"a"', ": 1}", "tail"]
+    assert plain.text == ""
+    assert plain.stats()["chars"] == len('{"a": 1}tail')
+
+    stream = client.chat_completions_stream(messages=MESSAGES, stop_when=lambda text: text.endswith("}"))
+    assert contents(stream) == ['{"a"', ": 1}"]
+    assert stream.text == '{"a": 1}'
+    assert stream.stop_reason == "stop_when"
+
+
+def test_cancel_from_other_thread_closes_connection(server, client):
+    release = threading.Event()
+    server.route("POST", CHAT, Reply(chunks=sse("first", done=False) + [lambda: release.wait(5)] + sse("late")))
+
+    stream = client.chat_completions_stream(messages=MESSAGES, max_tokens=100)
+    assert contents([next(stream)]) == ["first"]
+    started = time.monotonic()
+    threading.Timer(0.1, stream.cancel).start()
+
+    assert list(stream) == []
+    assert time.monotonic() - started < 2
+    assert stream.stats()["stop_reason"] == "cancelled"
+    assert stream.stats()["tokens_saved"] == 99
+    release.set()
@@ -0,0 +1,142 @@
+"""Стриминг chat completions: разбор SSE, сжатие запросов и ответов"""
+
+import gzip
+import json
+import threading
+
+import pytest
+
+from conftest import Reply, sse
+from waygpt_client import WayGPTClient, WayGPTError
+
+CHAT = "/api/v1/waygpt/chat/completions"
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+def contents(stream):
+    return [chunk["choices"][0]["delta"]["content"] for chunk in stream]
+
+
+def test_sse_events_split_at_arbitrary_bytes(server, client):
+    payload = b"".join(sse("Привет", ", ", "мир"))
+    # Кусками по 7 байт: границы внутри "data: ", JSON и UTF-8 символов
+    server.route("POST", CHAT, Reply(chunks=[payload[i:i + 7] for i in range(0, len(payload), 7)]))
+
+    assert contents(client.chat_completions_stream(messages=MESSAGES)) == ["Привет", ", ", "мир"]
+
+
+def test_sse_crlf_comments_and_events_in_one_write(server, client):
+    events = sse("a", "b", done=False)
+    payload = (
+        b": keep-alive\r\n\r\n"
+        + events[0].replace(b"\n", b"\r\n")
+        + b"event: message\r\n"
+        + events[1]
+        + b"data: [DONE]\r\n\r\n"
+    )
+    server.route("POST", CHAT, Reply(chunks=[payload]))
+
+    assert contents(client.chat_completions_stream(messages=MESSAGES)) == ["a", "b"]
+
+
+def test_sse_stops_at_done(server, client):
+    server.route("POST", CHAT, Reply(chunks=sse("a") + sse("after-done", done=False)))
+
+    assert contents(client.chat_completions_stream(messages=MESSAGES)) == ["a"]
+
+
+def test_sse_long_line_across_many_reads(server, client):
+    text = "x" * 300_000
+    payload = b"".join(sse(text))
+    server.route("POST", CHAT, Reply(chunks=[payload[i:i + 1000] for i in range(0, len(payload), 1000)]))
+
+    assert contents(client.chat_completions_stream(messages=MESSAGES)) == [text]
+
+
+def test_gzip_stream_is_decoded_incrementally(server, client):
+    # Второе событие сервер отправит только после того, как клиент получит первое:
+    # если бы ответ буферизовался целиком, тест завис бы до таймаута
+    first_seen = threading.Event()
+    events = sse("first", "second")
+    server.route("POST", CHAT, Reply(
+        chunks=[events[0], lambda: first_seen.wait(5)] + events[1:],
+        gzip=True,
+    ))
+
+    received = []
+    for chunk in client.chat_completions_stream(messages=MESSAGES):
+        received.append(chunk["choices"][0]["delta"]["content"])
+        first_seen.set()
+
+    assert received == ["first", "second"]
+    assert server.requests[0].headers.get("Accept-Encoding", "").find("gzip") >= 0
+    stats = client.get_stats()
+    assert stats["responses_compressed"] == 1
+    assert stats["response_bytes_decoded"] == sum(len(e) for e in events)
+
+
+def test_request_body_compressed_over_threshold(server, make_client):
+    client = make_client(compression="gzip", compression_threshold=1024)
+    server.route("POST", CHAT, {"choices": [{"message": {"content": "ok"}}]})
+    big = [{"role": "user", "content": "каталог " * 2000}]
+
+    client.chat_completions(messages=big)
+    client.chat_completions(messages=MESSAGES)
+
+    compressed, plain = server.requests
+    assert compressed.headers["Content-Encoding"] == "gzip"
+    assert len(compressed.raw) < len(compressed.body)
+    assert compressed.json()["messages"] == big
+    assert "Content-Encoding" not in plain.headers
+    stats = client.get_stats()
+    assert stats["requests_compressed"] == 1
+    assert stats["request_compression_ratio"] > 10
+
+
+def test_compression_disabled_after_415(server, make_client):
+    client = make_client(compression="gzip", compression_threshold=0)
+
+    def handler(request):
+        if request.headers.get("Content-Encoding"):
+            return Reply(415, {"detail": "unsupported encoding"})
+        return {"choices": [{"message": {"content": "ok"}}]}
+
+    server.route("POST", CHAT, handler)
+    big = [{"role": "user", "content": "x" * 5000}]
+
+    client.chat_completions(messages=big)
+    client.chat_completions(messages=big)
+
+    assert [bool(r.headers.get("Content-Encoding")) for r in server.requests] == [True, False, False]
+    assert client.get_stats()["compression_rejected"] == 1
+
+
+def test_http_error_raises_waygpt_error(server, client):
+    server.route("POST", CHAT, Reply(400, {"detail": "bad model"}))
+
+    with pytest.raises(WayGPTError) as info:
+        list(client.chat_completions_stream(messages=MESSAGES))
+
+    assert info.value.status_code == 400
+    assert info.value.message == "bad model"
+
+
+def test_non_json_data_lines_are_skipped(server, client):
+    server.route("POST", CHAT, Reply(chunks=[b"data: not-json\n\n"] + sse("ok")))
+
+    assert contents(client.chat_completions_stream(messages=MESSAGES)) == ["ok"]
+    assert json.loads(server.requests[0].body)["stream"] is True
+
+
+def test_stream_decoder_handles_several_gzip_members():
+    decoder = WayGPTClient._stream_decoder("gzip")
+    data = gzip.compress(b"data: one\n") + gzip.compress(b"data: two\n")
+
+    assert decoder.decompress(data[:10]) + decoder.decompress(data[10:]) == b"data: one\ndata: two\n"
+
+
+def test_corrupted_gzip_stream_raises_waygpt_error(server, client):
+    server.route("POST", CHAT, Reply(chunks=[b"not gzip at all"], headers={"Content-Encoding": "gzip"}))
+
+    with pytest.raises(WayGPTError, match="распаковки"):
+        list(client.chat_completions_stream(messages=MESSAGES))
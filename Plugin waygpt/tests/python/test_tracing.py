@@ -0,0 +1,140 @@
+"""Трассировка: заголовок traceparent, иерархия span, повторы, выключенная трассировка"""
+
+import re
+
+import pytest
+from requests.adapters import HTTPAdapter
+
+from conftest import Reply, StandInServer, sse
+from waygpt_client import RecordingTracer, WayGPTError, _current_span, _TracingHTTPAdapter
+
+MODELS = "/api/v1/waygpt/models"
+CHAT = "/api/v1/waygpt/chat/completions"
+PROJECTS = "/api/v1/client/projects"
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-01$")
+
+
+@pytest.fixture
+def tracer():
+    return RecordingTracer()
+
+
+def traceparent(request):
+    match = TRACEPARENT.match(request.headers["traceparent"])
+    assert match, request.headers["traceparent"]
+    return match.groups()
+
+
+def test_traceparent_identifies_call_span(server, make_client, tracer):
+    server.route("GET", MODELS, ["m1"])
+    client = make_client(tracer=tracer)
+
+    client.get_models()
+
+    span, = tracer.spans()
+    assert traceparent(server.requests[0]) == (span["trace_id"], span["span_id"])
+    assert span["name"] == f"WayGPT GET {MODELS}"
+    assert span["parent_id"] is None and not span["error"]
+    assert [e["name"] for e in span["events"]] == ["send", "pool_acquire", "connect", "first_byte"]
+
+
+def test_separate_calls_are_separate_traces(server, make_client, tracer):
+    server.route("GET", MODELS, ["m1"])
+    client = make_client(tracer=tracer)
+
+    client.get_models()
+    client.get_models()
+
+    first, second = (traceparent(r) for r in server.requests)
+    assert first[0] != second[0]
+    assert [e["reused"] for s in tracer.spans() for e in s["events"] if e["name"] == "pool_acquire"] == [False, True]
+
+
+def test_nested_calls_are_child_spans(server, make_client, tracer):
+    server.route("GET", PROJECTS, [{"id": "p1"}, {"id": "p2"}])
+    server.route("GET", PROJECTS + "/*", lambda request: [] if request.path.endswith("use-cases") else {})
+    client = make_client(tracer=tracer)
+
+    client.client_snapshot("jwt")
+
+    spans = tracer.spans()
+    root = spans[-1]
+    children = spans[:-1]
+    assert root["name"] == "WayGPT client_snapshot" and root["parent_id"] is None
+    assert len(children) == 5
+    assert {s["parent_id"] for s in children} == {root["span_id"]}
+    assert {s["trace_id"] for s in children} == {root["trace_id"]}
+    # Запросы из потоков пула несут span своего вызова, а не корневой
+    sent = {traceparent(r) for r in server.requests}
+    assert sent == {(s["trace_id"], s["span_id"]) for s in children}
+
+
+def test_retries_stay_in_one_span(server, make_client, tracer):
+    replies = iter([Reply(503, {"detail": "busy"})])
+    server.route("GET", MODELS, lambda request: next(replies, ["m1"]))
+    client = make_client(tracer=tracer, max_retries=1)
+
+    assert client.get_models() == ["m1"]
+
+    span, = tracer.spans()
+    assert [traceparent(r) for r in server.requests] == [(span["trace_id"], span["span_id"])] * 2
+
+
+def test_failover_stays_in_one_span(make_client, tracer):
+    down, up = StandInServer(), StandInServer()
+    try:
+        down.route("GET", MODELS, Reply(503, {"detail": "busy"}))
+        up.route("GET", MODELS, ["m1"])
+        client = make_client(api_url=[down.url, up.url], tracer=tracer, health_check_interval=0)
+
+        for _ in range(50):  # зеркало выбирается случайно: ждём вызова, попавшего на down
+            client.get_models()
+            if down.requests:
+                break
+
+        span = tracer.spans()[-1]
+        sent = [traceparent(r) for r in down.requests[-1:] + up.requests[-1:]]
+        assert sent == [(span["trace_id"], span["span_id"])] * 2
+        assert [e["name"] for e in span["events"]].count("send") == 2
+        assert not span["error"]
+    finally:
+        down.close()
+        up.close()
+
+
+def test_failed_call_marks_span(server, make_client, tracer):
+    server.route("GET", MODELS, Reply(403, {"detail": "forbidden"}))
+    client = make_client(tracer=tracer)
+
+    with pytest.raises(WayGPTError):
+        client.get_models()
+
+    span, = tracer.spans()
+    assert span["error"]
+    assert span["events"][-1]["name"] == "exception"
+
+
+def test_stream_request_carries_stream_span(server, make_client, tracer):
+    server.route("POST", CHAT, Reply(chunks=sse("a", "b")))
+    client = make_client(tracer=tracer)
+
+    list(client.chat_completions_stream(messages=[{"role": "user", "content": "hi"}]))
+
+    span, = tracer.spans()
+    assert span["name"] == "WayGPT chat.completions stream"
+    assert traceparent(server.requests[0]) == (span["trace_id"], span["span_id"])
+    names = [e["name"] for e in span["events"]]
+    assert names.index("first_byte") < names.index("first_token") < names.index("stream_end")
+
+
+def test_disabled_tracing_adds_nothing(server, client):
+    server.route("GET", MODELS, ["m1"])
+    server.route("POST", CHAT, Reply(chunks=sse("a")))
+
+    client.get_models()
+    list(client.chat_completions_stream(messages=[{"role": "user", "content": "hi"}]))
+
+    assert all("traceparent" not in r.headers for r in server.requests)
+    adapter = client.session.get_adapter(server.url)
+    assert type(adapter) is HTTPAdapter and not isinstance(adapter, _TracingHTTPAdapter)
+    assert _current_span.get() is None
@@ -0,0 +1,95 @@
+"""Типизированный разбор чанков: поиск по байтам совпадает с полным разбором"""
+
+import json
+import random
+
+import pytest
+
+from conftest import Reply, sse
+from waygpt_client import ChatCompletion, StreamDelta, _decode_stream_delta_full, _decode_stream_delta_scan
+
+CHAT = "/api/v1/waygpt/chat/completions"
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+
+def as_tuple(delta):
+    return None if delta is None else (delta.content, delta.finish_reason)
+
+
+TRICKY = [
+    # content вне delta раньше настоящего
+    b'{"choices":[{"index":0,"logprobs":{"content":[{"token":"fp"}]},"delta":{"content":"real"},"finish_reason":null}]}',
+    b'{"content":"fp","choices":[{"delta":{"content":"real"}}]}',
+    b'{"choices":[{"delta":{"tool_calls":[{"function":{"arguments":"{\\"content\\":\\"fp\\"}"}}],"content":"real"}}]}',
+    # пробелы и переводы строк вокруг двоеточия
+    b'{"choices":[{"delta":{"content" : "hi"}}]}',
+    b'{"choices":[{"delta":{"content":\n"hi"}}]}',
+    b'{"choices": [{"delta": {"content": "hi"}, "finish_reason": null}]}',
+    b'{ "choices" : [ { "delta" : { "content" : "hi" } } ] }',
+    # role перед content, пустой delta, null
+    b'{"choices":[{"delta":{"role":"assistant","content":"hi"}}]}',
+    b'{"choices":[{"delta":{},"finish_reason":"stop"}]}',
+    b'{"choices":[{"delta":{"content":null},"finish_reason":"length"}]}',
+    # escape-последовательности и ключи внутри строк
+    b'{"choices":[{"delta":{"content":"a\\"b\\\\"}}]}',
+    b'{"choices":[{"delta":{"content":"\\"delta\\":{\\"content\\":\\"x\\"}"}}]}',
+    b'{"choices":[{"delta":{"content":"\\u043f\\u0440\\u0438"}}]}',
+    # несколько choices, finish_reason в другом месте
+    b'{"choices":[{"index":0,"delta":{"content":"a"}},{"index":1,"delta":{"content":"b"}}]}',
+    b'{"meta":{"finish_reason":"fake"},"choices":[{"delta":{"content":"a"},"finish_reason":null}]}',
+    # не чанк
+    b'{"error":{"message":"boom"}}',
+    b'{"choices":[]}',
+    b'not json',
+    "{\"choices\":[{\"delta\":{\"content\":\"Привет\"}}]}".encode(),
+]
+
+
+@pytest.mark.parametrize("payload", TRICKY)
+def test_scan_matches_full_parse(payload):
+    assert as_tuple(_decode_stream_delta_scan(payload)) == as_tuple(_decode_stream_delta_full(payload))
+
+
+def random_chunk(rng):
+    alphabet = ['a', ' ', '"', '\\', 'content', 'delta', '{', '}', ':', 'ж', '\n']
+    text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 6)))
+    delta = {}
+    if rng.random() < 0.3:
+        delta["role"] = "assistant"
+    if rng.random() < 0.9:
+        delta["content"] = text if rng.random() < 0.9 else None
+    choice = {"index": 0, "delta": delta}
+    if rng.random() < 0.3:
+        choice = {"logprobs": {"content": [{"token": text[::-1]}]}, **choice}
+    choice["finish_reason"] = rng.choice([None, "stop", "length"])
+    chunk = {"id": "c", "choices": [choice]}
+    if rng.random() < 0.2:
+        chunk["content"] = "outer"
+    separators = rng.choice([(",", ":"), (", ", ": "), (" , ", " : ")])
+    return json.dumps(chunk, ensure_ascii=rng.random() < 0.5, separators=separators).encode()
+
+
+def test_scan_matches_full_parse_on_random_chunks():
+    rng = random.Random(43)
+    for _ in range(5000):
+        payload = random_chunk(rng)
+        assert as_tuple(_decode_stream_delta_scan(payload)) == as_tuple(_decode_stream_delta_full(payload)), payload
+
+
+def test_chat_completion_from_dict():
+    reply = ChatCompletion.from_dict({
+        "id": "c1", "model": "m",
+        "choices": [{"message": {"content": "ok"}, "finish_reason": "stop"}],
+        "usage": {"total_tokens": 3},
+    })
+
+    assert (reply.id, reply.model, reply.content, reply.finish_reason, reply.usage) == ("c1", "m", "ok", "stop", {"total_tokens": 3})
+
+
+def test_typed_stream_yields_stream_delta(server, client):
+    server.route("POST", CHAT, Reply(chunks=sse("a", "b")))
+
+    deltas = list(client.chat_completions_stream(messages=MESSAGES, typed=True))
+
+    assert all(isinstance(d, StreamDelta) for d in deltas)
+    assert [d.content for d in deltas] == ["a", "b"]
@@ -0,0 +1,115 @@
+"""UAMSessionClient: кеш сессий, grace при сбоях UAM, немедленный отзыв сессии"""
+
+import time
+
+import pytest
+
+from conftest import Reply
+from waygpt_client import UAMSessionClient
+
+VALIDATE = "/api/uam/v1/session/validate"
+USER = {"user_id": "u1", "email": "user@example.com"}
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "условие не выполнилось"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def uam(server):
+    """UAM отвечает тем, что лежит в uam.reply (по умолчанию — пользователь)"""
+
+    def handler(request):
+        return handler.reply
+
+    handler.reply = USER
+    server.route("GET", VALIDATE, handler)
+    return handler
+
+
+@pytest.fixture
+def sessions(server):
+    sessions = UAMSessionClient(uam_url=server.url, fresh_ttl=0)
+    yield sessions
+    sessions.close()
+
+
+def revalidated(sessions, validations):
+    """Ждёт завершения фоновой проверки, запущенной validate() для устаревшей записи"""
+    wait_for(lambda: sessions.stats()["validations"] == validations and not sessions._refreshing)
+
+
+def test_valid_session_is_cached(server, uam):
+    sessions = UAMSessionClient(uam_url=server.url)
+
+    assert sessions.validate("cookie") == USER
+    assert sessions.validate("cookie") == USER
+
+    assert len(server.requests) == 1
+    assert server.requests[0].headers["Cookie"] == "uam_session=cookie"
+    assert sessions.stats()["hits"] == 1
+    sessions.close()
+
+
+def test_unknown_session_is_negatively_cached(server, uam, sessions):
+    uam.reply = Reply(401, {"reason": "not_found"})
+
+    assert sessions.validate("cookie") is None
+    assert sessions.validate("cookie") is None
+
+    assert len(server.requests) == 1
+    assert sessions.stats()["negative_hits"] == 1
+
+
+@pytest.mark.parametrize("reply", [
+    Reply(401, {"reason": "not_found"}),
+    Reply(401, {"reason": "expired"}),
+    Reply(503, {"detail": "unavailable"}),
+], ids=["not_found", "expired", "5xx"])
+def test_known_session_survives_uam_failure(uam, sessions, reply):
+    assert sessions.validate("cookie") == USER
+    uam.reply = reply
+
+    # Устаревшая запись отдаётся сразу, фоновая проверка не удаляет её из кеша
+    assert sessions.validate("cookie") == USER
+    revalidated(sessions, 2)
+
+    assert sessions.validate("cookie") == USER
+    revalidated(sessions, 3)
+    assert sessions.stats()["grace_hits"] == 2
+
+
+def test_revoked_session_is_dropped_immediately(server, uam, sessions):
+    assert sessions.validate("cookie") == USER
+    uam.reply = Reply(401, {"reason": "revoked"})
+
+    sessions.validate("cookie")
+    revalidated(sessions, 2)
+
+    assert sessions.validate("cookie") is None
+    assert len(server.requests) == 2
+    stats = sessions.stats()
+    assert (stats["grace_hits"], stats["negative_hits"]) == (0, 1)
+
+
+def test_grace_is_limited_by_max_age(server, uam):
+    sessions = UAMSessionClient(uam_url=server.url, fresh_ttl=0, max_age=0.05)
+    assert sessions.validate("cookie") == USER
+    uam.reply = Reply(401, {"reason": "not_found"})
+    time.sleep(0.1)
+
+    assert sessions.validate("cookie") is None
+    sessions.close()
+
+
+def test_uam_sessions_does_not_touch_client_session(server, client):
+    adapters = dict(client.session.adapters)
+
+    sessions = client.uam_sessions(uam_url=server.url)
+
+    assert client.session.adapters == adapters
+    assert sessions.session is not client.session
+    sessions.close()
@@ -0,0 +1,126 @@
+"""WidgetTokenPool: одноразовая выдача, фоновое пополнение, выпуск при промахе, остановка"""
+
+import itertools
+import time
+
+import pytest
+
+from conftest import Reply
+from waygpt_client import WidgetTokenPool
+
+TOKEN = "/api/v1/widget/token"
+
+
+def wait_for(condition, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline, "условие не выполнилось"
+        time.sleep(0.01)
+
+
+@pytest.fixture
+def minted(server):
+    """Выпускает токены t0, t1, ...; expires_in задаётся через minted.ttl"""
+    counter = itertools.count()
+
+    def handler(request):
+        return {"token": f"t{next(counter)}", "expires_in": handler.ttl}
+
+    handler.ttl = 600
+    server.route("POST", TOKEN, handler)
+    return handler
+
+
+def token_requests(server):
+    return [r for r in server.requests if r.path == TOKEN]
+
+
+def test_single_use_tokens_are_handed_out_once(server, client, minted):
+    pool = client.widget_token_pool("shop.example.com", size=3)
+    wait_for(lambda: pool.stats()["stock"] == 3)
+
+    tokens = [pool.get()["token"] for _ in range(3)]
+
+    assert len(set(tokens)) == 3
+    assert pool.stats()["hits"] == 3
+    assert token_requests(server)[0].json()["site_domain"] == "shop.example.com"
+    client.close()
+
+
+def test_stock_is_refilled_in_background(server, client, minted):
+    pool = client.widget_token_pool(size=2)
+    wait_for(lambda: pool.stats()["stock"] == 2)
+
+    pool.get()
+    pool.get()
+    wait_for(lambda: pool.stats()["stock"] == 2)
+
+    assert pool.stats()["misses"] == 0
+    assert len(token_requests(server)) == 4
+    client.close()
+
+
+def test_expiring_tokens_are_replaced(server, client, minted):
+    minted.ttl = 1
+    pool = WidgetTokenPool(client, ttl_seconds=1, size=1, refresh_margin=0.8).start()
+    wait_for(lambda: pool.stats()["stock"] == 1)
+
+    # Токен выдаётся 0.2 с, затем заменяется новым
+    wait_for(lambda: len(token_requests(server)) >= 3)
+
+    assert pool.get()["token"] != "t0"
+    pool.close()
+
+
+def test_token_is_minted_on_miss(server, client, minted):
+    pool = WidgetTokenPool(client, size=2)  # без фонового потока запас пуст
+
+    token = pool.get()
+
+    assert token["token"] == "t0"
+    stats = pool.stats()
+    assert (stats["hits"], stats["misses"], stats["stock"]) == (0, 1, 0)
+
+
+def test_shared_token_is_reused_until_expiry(server, client, minted):
+    pool = WidgetTokenPool(client, single_use=False)
+
+    assert pool.get()["token"] == pool.get()["token"] == "t0"
+    assert pool.stats()["misses"] == 1
+    assert len(token_requests(server)) == 1
+
+
+def test_one_pool_per_domain(client, minted):
+    assert client.widget_token_pool("a.example") is client.widget_token_pool("a.example")
+    assert client.widget_token_pool("a.example") is not client.widget_token_pool("b.example")
+    client.close()
+
+
+def test_close_stops_refill_and_drops_stock(server, client, minted):
+    pool = client.widget_token_pool(size=2)
+    wait_for(lambda: pool.stats()["stock"] == 2)
+
+    client.close()
+    minted_before = len(token_requests(server))
+
+    assert not pool._thread.is_alive()
+    assert pool.stats()["stock"] == 0
+    time.sleep(0.1)
+    assert len(token_requests(server)) == minted_before
+
+
+def test_refill_errors_are_counted_and_retried(server, client):
+    replies = iter([None, {"token": "ok", "expires_in": 600}])
+
+    def handler(request):
+        reply = next(replies, {"token": "more", "expires_in": 600})
+        return Reply(400, {"detail": "quota"}) if reply is None else reply
+
+    server.route("POST", TOKEN, handler)
+    pool = WidgetTokenPool(client, size=1).start()
+
+    wait_for(lambda: pool.stats()["stock"] == 1, timeout=5)
+
+    assert pool.stats()["refill_errors"] == 1
+    assert pool.get()["token"] == "ok"
+    pool.close()